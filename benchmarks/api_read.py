@@ -0,0 +1,85 @@
+"""
+Benchmark of the read endpoints of the API with 1000 devices.
+
+Measures the requests per second of `GET /api/devices` when the state changes
+between every request (the body is built and serialized each time), when the
+state does not change (served from the cached body) and when the client sends
+`If-None-Match` (304 responses).
+
+Run from the repository root:
+
+    python -m benchmarks.api_read
+"""
+
+import asyncio
+import os
+import time
+
+import aiohttp
+
+os.environ.setdefault("PORT", "18181")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+# pylint: disable=wrong-import-position
+from opensurplusmanager.core import Core  # noqa: E402
+
+DEVICES = 1000
+DURATION = 3
+
+
+def build_core() -> Core:
+    """Build a core with `DEVICES` switch devices."""
+    core = Core()
+    core.config = {
+        "devices": [
+            {
+                "name": f"device{i}",
+                "type": "switch",
+                "expected_consumption": 100 + i,
+                "consumption_integration": {"name": "none"},
+                "control_integration": {},
+            }
+            for i in range(DEVICES)
+        ]
+    }
+    core.load_config()
+    return core
+
+
+async def measure(session, url, core, mutate=False, conditional=False) -> float:
+    """Send requests sequentially for `DURATION` seconds and return the rate."""
+    headers = {}
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < DURATION:
+        if mutate:
+            device = core.get_device(f"device{count % DEVICES}")
+            device.consumption = device.consumption + 1
+        async with session.get(url, headers=headers) as response:
+            await response.read()
+            if conditional:
+                headers = {"If-None-Match": response.headers["ETag"]}
+        count += 1
+    return count / (time.perf_counter() - start)
+
+
+async def main():
+    """Run the benchmark."""
+    core = build_core()
+    api_task = asyncio.create_task(core.run())
+    await asyncio.sleep(0.5)
+    url = f"http://127.0.0.1:{os.environ['PORT']}/api/devices"
+    async with aiohttp.ClientSession() as session:
+        changing = await measure(session, url, core, mutate=True)
+        cached = await measure(session, url, core)
+        not_modified = await measure(session, url, core, conditional=True)
+    await core.api.close()
+    api_task.cancel()
+    print(f"GET /api/devices with {DEVICES} devices, sequential client")
+    print(f"  state changing every request: {changing:8.1f} req/s")
+    print(f"  cached body:                  {cached:8.1f} req/s")
+    print(f"  If-None-Match (304):          {not_modified:8.1f} req/s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
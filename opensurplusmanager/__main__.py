@@ -1,7 +1,6 @@
 """Main module for the Open Surplus Manager application."""
 
 import asyncio
-import importlib
 import os
 import sys
 
@@ -9,6 +8,9 @@ import yaml
 
 from opensurplusmanager.core import Core
 from opensurplusmanager.exceptions import IntegrationInitializationError
+from opensurplusmanager.integrations import setup_integrations
+from opensurplusmanager.runtime import LoopMonitor, run, shutdown_event
+from opensurplusmanager.sites import SiteManager
 from opensurplusmanager.utils import logger
 
 core = Core()
@@ -17,41 +19,24 @@ integrations = []
 
 config_file_name = os.getenv("CONFIG_FILE", "config.yaml")
 
+# Directory with a config file per site, enables the multi-site mode
+sites_dir = os.getenv("SITES_DIR", None)
+sites = SiteManager(sites_dir) if sites_dir else None
+
 
 async def __load_integrations() -> None:
     """Load the integrations for the Open Surplus Manager application."""
     logger.info("Loading integrations...")
-
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-
-    integrations_folder = os.path.join(script_dir, "integrations")
-    integrations_names = core.config.get("integrations", {})
-
-    # Given the names of the integrations folder, if the name is in the config, load it
-    for integration_name in integrations_names:
-        integration_path = os.path.join(integrations_folder, integration_name)
-        if os.path.isdir(integration_path):
-            init_file = os.path.join(integration_path, "__init__.py")
-            if os.path.exists(init_file):
-                spec = importlib.util.spec_from_file_location("__init__", init_file)
-                module = importlib.util.module_from_spec(spec)
-                spec.loader.exec_module(module)
-                if hasattr(module, "setup"):
-                    try:
-                        integration = await module.setup(core)
-                    except IntegrationInitializationError as e:
-                        logger.error(
-                            "Error initializing integration %s: %s", integration_name, e
-                        )
-                        # If an exception is raised during initialization,
-                        # close all integrations and exit
-                        for task in asyncio.all_tasks():
-                            if task is not asyncio.current_task():
-                                task.cancel()
-                        await close_integrations()
-                        sys.exit(1)
-                    if integration is not None:
-                        integrations.append(integration)
+    try:
+        await setup_integrations(core, integrations)
+    except IntegrationInitializationError:
+        # If an exception is raised during initialization,
+        # close all integrations and exit
+        for task in asyncio.all_tasks():
+            if task is not asyncio.current_task():
+                task.cancel()
+        await close_integrations()
+        sys.exit(1)
 
 
 def __load_config() -> None:
@@ -73,16 +58,53 @@ def __load_config() -> None:
 
 
 async def main() -> int:
-    """Man entry point. Loads config, integrations and runs core."""
-    __load_config()
-    core.load_config()
-    await __load_integrations()
+    """
+    Man entry point. Loads config, integrations and runs core until the process
+    receives SIGINT or SIGTERM, then shuts everything down.
+    """
+    shutdown = shutdown_event()
+    monitor = LoopMonitor(
+        interval=float(os.getenv("LOOP_LAG_INTERVAL", "0.5")),
+        slow_threshold=float(os.getenv("SLOW_CALLBACK_THRESHOLD", "0.1")),
+    )
+    monitor.start()
     try:
-        await core.run()
-    except OSError as e:
-        logger.error("Error running core: %s", e)
+        if sites is not None:
+            await sites.load()
+            try:
+                await sites.run()
+            except OSError as e:
+                logger.error("Error running sites: %s", e)
+                await sites.close()
+                sys.exit(1)
+        else:
+            __load_config()
+            core.load_config()
+            await __load_integrations()
+            try:
+                await core.run()
+            except OSError as e:
+                logger.error("Error running core: %s", e)
+                await close_integrations()
+                sys.exit(1)
+        await shutdown.wait()
+    finally:
+        monitor.stop()
+    await shutdown_app()
+    return 0
+
+
+async def shutdown_app() -> None:
+    """Close the API, the integrations and the core."""
+    logger.info("Shutting down...")
+    if sites is not None:
+        await sites.close()
+    else:
+        if core.api is not None:
+            await core.api.close()
         await close_integrations()
-        sys.exit(1)
+        core.close()
+    logger.info("Shutdown completed")
 
 
 async def close_integrations() -> None:
@@ -97,11 +119,9 @@ async def close_integrations() -> None:
 
 if __name__ == "__main__":
     try:
-        sys.exit(asyncio.run(main()))
+        sys.exit(run(main))
     except KeyboardInterrupt:
-        logger.info("Shutting down...")
-        if core.api is not None:
-            asyncio.run(core.api.close())
-        asyncio.run(close_integrations())
-        logger.info("Shutdown completed")
+        # Only raised where the signal handlers are not supported, the loop is
+        # already closed so the shutdown runs in a new one
+        run(shutdown_app)
         sys.exit(0)
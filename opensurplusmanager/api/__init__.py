@@ -3,21 +3,155 @@
 from __future__ import annotations
 
 import asyncio
+import hmac
 import os
+import time
 from dataclasses import dataclass
 from json import JSONDecodeError
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List
 
 from aiohttp import web
 
+from opensurplusmanager.api.cache import ResponseCache
+from opensurplusmanager.api.stream import StateStream
+from opensurplusmanager.exceptions import InvalidConfigurationChange
+from opensurplusmanager.metrics import READINGS, format_labels, registry
 from opensurplusmanager.models.device import Device
-from opensurplusmanager.utils import logger
+from opensurplusmanager.tracing import PROFILE_MODES, profile, profile_lock, tracer
+from opensurplusmanager.utils import json_dumps, json_loads, logger
 
 if TYPE_CHECKING:
     from opensurplusmanager.core import Core
 
 routes = web.RouteTableDef()
 
+# Entity name of the surplus in the ingested records
+SURPLUS_ENTITY = "surplus"
+# Maximum seconds of a profile
+MAX_PROFILE_SECONDS = 60
+
+
+def monotonic_to_unix(value: float) -> float | None:
+    """
+    Convert a time.monotonic() time to Unix time.
+
+    Parameters:
+    value (float): The monotonic time, 0 if there is none.
+
+    Returns:
+    float | None: The Unix time or None if the value is 0.
+    """
+    if not value:
+        return None
+    return time.time() - (time.monotonic() - value)
+
+
+def collect_core_metrics(cores: List[Core]) -> Iterator[str]:
+    """
+    Yield the metrics with the current state of some cores and their devices. The
+    samples of the cores that have a site name are labeled with it.
+
+    Parameters:
+    cores (List[Core]): The cores.
+
+    Yields:
+    str: The lines of the exposition.
+    """
+    now = time.monotonic()
+    core_labels = [
+        format_labels(("site",), (core.name,)) if core.name is not None else ""
+        for core in cores
+    ]
+    yield "# HELP osm_surplus_watts Surplus power, negative is grid consumption."
+    yield "# TYPE osm_surplus_watts gauge"
+    for core, label in zip(cores, core_labels):
+        yield f"osm_surplus_watts{label} {core.surplus}"
+    yield "# HELP osm_surplus_stale 1 if the surplus reading is stale."
+    yield "# TYPE osm_surplus_stale gauge"
+    for core, label in zip(cores, core_labels):
+        yield f"osm_surplus_stale{label} {float(core.surplus_stale)}"
+    yield "# HELP osm_surplus_age_seconds Age of the last surplus reading."
+    yield "# TYPE osm_surplus_age_seconds gauge"
+    for core, label in zip(cores, core_labels):
+        if core.surplus_updated_at:
+            yield f"osm_surplus_age_seconds{label} {now - core.surplus_updated_at}"
+
+    columns = []
+    for core in cores:
+        state = core.state
+        names = ("device",) if core.name is None else ("site", "device")
+        prefix = () if core.name is None else (core.name,)
+        labels = [format_labels(names, prefix + (name,)) for name in state.names]
+        ages = [
+            now - updated_at if updated_at else -1 for updated_at in state.updated_at
+        ]
+        columns.append(
+            (
+                labels,
+                (state.consumption, state.powered, state.enabled, state.stale, ages),
+            )
+        )
+    for index, (metric, documentation) in enumerate(
+        (
+            ("osm_device_consumption_watts", "Consumption of the device."),
+            ("osm_device_powered", "1 if the device is powered."),
+            ("osm_device_enabled", "0 while the device is in cooldown."),
+            ("osm_device_stale", "1 if the consumption reading is stale."),
+            (
+                "osm_device_reading_age_seconds",
+                "Age of the last consumption reading, -1 if there is none.",
+            ),
+        )
+    ):
+        yield f"# HELP {metric} {documentation}"
+        yield f"# TYPE {metric} gauge"
+        for labels, values in columns:
+            for label, value in zip(labels, values[index]):
+                yield f"{metric}{label} {float(value)}"
+
+    yield (
+        "# HELP osm_device_state_mismatches_total Times the powered state of the "
+        "device did not match its actual state."
+    )
+    yield "# TYPE osm_device_state_mismatches_total counter"
+    for core, (labels, _) in zip(cores, columns):
+        for label, value in zip(labels, core.state.mismatches):
+            yield f"osm_device_state_mismatches_total{label} {float(value)}"
+
+    planners = []
+    for core in cores:
+        if core.shadows is None:
+            continue
+        names = ("planner",) if core.name is None else ("site", "planner")
+        prefix = () if core.name is None else (core.name,)
+        for name, planner in core.shadows.state().items():
+            planners.append(
+                (format_labels(names, prefix + (name,)), planner["statistics"])
+            )
+    for metric, key, documentation in (
+        (
+            "osm_planner_commands_total",
+            "commands",
+            "Commands sent, or that a shadow planner would have sent.",
+        ),
+        (
+            "osm_planner_self_consumption_wh_total",
+            "self_consumption_wh",
+            "Estimated energy of the devices covered by the surplus.",
+        ),
+        (
+            "osm_planner_grid_import_wh_total",
+            "grid_import_wh",
+            "Estimated energy imported from the grid.",
+        ),
+    ):
+        if not planners:
+            break
+        yield f"# HELP {metric} {documentation}"
+        yield f"# TYPE {metric} counter"
+        for label, statistics in planners:
+            yield f"{metric}{label} {float(statistics[key])}"
+
 
 @dataclass
 class DeviceResponse:
@@ -29,9 +163,15 @@ class DeviceResponse:
     expected_consumption: float
     max_consumption: float | None
     consumption: float
+    raw_consumption: float
     powered: bool
     cooldown: int | None
     enabled: bool
+    source: str | None
+    last_reading: float | None
+    stale: bool
+    actual_powered: bool | None
+    state_mismatches: int
 
     @classmethod
     def from_device(cls, device: Device) -> DeviceResponse:
@@ -51,9 +191,15 @@ class DeviceResponse:
             expected_consumption=device.expected_consumption,
             max_consumption=device.max_consumption,
             consumption=device.consumption,
+            raw_consumption=device.raw_consumption,
             powered=device.powered,
             cooldown=device.cooldown,
             enabled=device.enabled,
+            source=device.source,
+            last_reading=monotonic_to_unix(device.updated_at),
+            stale=device.stale,
+            actual_powered=device.actual_powered,
+            state_mismatches=device.state_mismatches,
         )
 
 
@@ -66,22 +212,49 @@ class Api:
     def __init__(self, core: Core):
         self.core = core
         self.runner = None
+        self.stream = None
+        self.cache = ResponseCache(core=core)
+        self.ingest_token = None
+        # Timestamp of the last ingested record by entity
+        self.ingest_times: Dict[str, float] = {}
+        self.__ingest_readings = READINGS.labels("ingest")
+
+    def create_app(self) -> web.Application:
+        """
+        Create the application with the routes of the core, mounted at /api or at
+        /api/sites/{site} in multi-site mode.
 
-    async def run(self):
-        """Run the API."""
-        app = web.Application()
+        Returns:
+        web.Application: The application.
+        """
+        api_config = self.core.config.get("api", None) or {}
+        self.stream = StateStream(
+            core=self.core,
+            snapshot_factory=self.__snapshot,
+            queue_size=api_config.get("stream_queue_size", 100),
+        )
+        self.ingest_token = api_config.get("ingest_token", None)
 
         api_app = web.Application()
         api_app.add_routes(
             [
                 web.get("/", self.hello),
                 web.get("/core", self.get_core_state),
+                web.patch("/core", self.patch_core),
                 web.get(
                     "/device/{device_name}/consumption", self.get_device_consumption
                 ),
                 web.get("/device/{device_name}", self.get_device),
                 web.get("/devices", self.get_devices),
+                web.patch("/devices", self.patch_devices),
                 web.get("/surplus", self.get_surplus),
+                web.get("/history", self.get_history),
+                web.get("/history/stored", self.get_stored_history),
+                web.get("/actions", self.get_actions),
+                web.get("/calibration", self.get_calibration),
+                web.post("/calibration/apply", self.apply_calibration),
+                web.get("/shadows", self.get_shadows),
+                web.get("/derived", self.get_derived),
                 web.post("/surplus_margin", self.set_surplus_margin),
                 web.post("/grid_margin", self.set_grid_margin),
                 web.post("/idle_power", self.set_idle_power),
@@ -94,11 +267,22 @@ class Api:
                     self.set_device_expected_consumption,
                 ),
                 web.post("/device/{device_name}/cooldown", self.set_device_cooldown),
+                web.post("/ingest", self.ingest),
+                web.get("/debug/traces", self.get_traces),
+                web.get("/debug/profile", self.get_profile),
+                web.get("/stream", self.stream_events),
+                web.get("/ws", self.stream_websocket),
             ]
         )
         api_app.add_routes(routes)
+        return api_app
 
-        app.add_subapp("/api", api_app)
+    async def run(self):
+        """Start the API server. Returns once it is listening."""
+        app = web.Application()
+        app.add_subapp("/api", self.create_app())
+        app.router.add_get("/metrics", self.get_metrics)
+        registry.add_collector(self.collect_metrics)
 
         runner = web.AppRunner(app)
         self.runner = runner
@@ -109,9 +293,6 @@ class Api:
         await site.start()
         logger.info("API started on %s:%s", host, port)
 
-        while True:
-            await asyncio.sleep(3600)
-
     async def hello(self, _) -> web.Response:
         """
         Test endpoint.
@@ -121,20 +302,39 @@ class Api:
         """
         return web.json_response({"message": "Hello, World!"})
 
-    async def get_core_state(self, _) -> web.Response:
+    async def get_core_state(self, request: web.Request) -> web.Response:
         """
         Get the state of the core.
 
+        Parameters:
+        request (web.Request): The request object.
+
         Returns:
-        web.Response: A JSON with the state of the core.
+        web.Response: A JSON with the state of the core or a 304 if the client
+        already has the current version.
         """
-        state = {
+        return self.cache.response(request, "core", self.__core_state)
+
+    def __core_state(self) -> dict:
+        """Build the dictionary with the state of the core."""
+        return {
             "surplus": self.core.surplus,
+            "raw_surplus": self.core.raw_surplus,
+            "surplus_source": self.core.surplus_source,
+            "surplus_last_reading": monotonic_to_unix(self.core.surplus_updated_at),
+            "surplus_stale": self.core.surplus_stale,
+            "stale_policy": self.core.stale_policy,
             "surplus_margin": self.core.surplus_margin,
             "grid_margin": self.core.grid_margin,
             "idle_power": self.core.idle_power,
         }
-        return web.json_response(state)
+
+    def __snapshot(self) -> dict:
+        """Build the full state sent to the stream clients on connection."""
+        return {
+            "core": self.__core_state(),
+            "devices": self.__devices_state(),
+        }
 
     async def get_surplus(self, _) -> web.Response:
         """
@@ -145,6 +345,172 @@ class Api:
         """
         return web.json_response({"surplus": self.core.surplus})
 
+    async def get_history(self, request: web.Request) -> web.Response:
+        """
+        Get the history of a series. Query parameters: `series` (surplus or
+        consumption.<device name>), `from` and `to` as Unix time and `step` (0 for
+        the raw samples or a rollup resolution in seconds). Without `series` the
+        names of the available series are returned.
+
+        Parameters:
+        request (web.Request): The request object with the query parameters.
+
+        Returns:
+        web.Response: A JSON with the step used and the points, [time, value] for
+        raw samples and [time, min, max, mean] for rollups, a 404 if the series is
+        not found or a 400 if the parameters are invalid.
+        """
+        history = self.core.history
+        name = request.query.get("series")
+        if name is None:
+            return web.json_response({"series": list(history.series)})
+        try:
+            since = float(request.query.get("from", "-inf"))
+            until = float(request.query.get("to", "inf"))
+            step = request.query.get("step")
+            step = int(step) if step is not None else None
+            result = history.query(name, since, until, step)
+        except ValueError as e:
+            return web.Response(status=400, text=f"Invalid parameters: {e}")
+        if result is None:
+            return web.Response(status=404, text="Series not found")
+        step, points = result
+        return web.Response(
+            body=json_dumps({"series": name, "step": step, "points": points}),
+            content_type="application/json",
+        )
+
+    async def get_stored_history(self, request: web.Request) -> web.Response:
+        """
+        Get the history of a series from the history store. Same query parameters
+        as `get_history`, `step` is 0 or the rollup step of the store.
+
+        Parameters:
+        request (web.Request): The request object with the query parameters.
+
+        Returns:
+        web.Response: A JSON with the step used and the points, a 404 if the store
+        is not configured or a 400 if the parameters are invalid.
+        """
+        store = self.core.store
+        if store is None:
+            return web.Response(status=404, text="History store not configured")
+        name = request.query.get("series")
+        try:
+            if name is None:
+                raise ValueError("series is required")
+            since = float(request.query.get("from", "-inf"))
+            until = float(request.query.get("to", "inf"))
+            step = request.query.get("step")
+            step = int(step) if step is not None else None
+            step, points = await asyncio.to_thread(
+                store.query, name, since, until, step
+            )
+        except ValueError as e:
+            return web.Response(status=400, text=f"Invalid parameters: {e}")
+        return web.Response(
+            body=json_dumps({"series": name, "step": step, "points": points}),
+            content_type="application/json",
+        )
+
+    async def get_actions(self, request: web.Request) -> web.Response:
+        """
+        Get the commands sent to the devices from the history store. Query
+        parameters: `from` and `to` as Unix time and optionally `device`.
+
+        Parameters:
+        request (web.Request): The request object with the query parameters.
+
+        Returns:
+        web.Response: A JSON with the list of actions, a 404 if the store is not
+        configured or a 400 if the parameters are invalid.
+        """
+        store = self.core.store
+        if store is None:
+            return web.Response(status=404, text="History store not configured")
+        try:
+            since = float(request.query.get("from", "-inf"))
+            until = float(request.query.get("to", "inf"))
+        except ValueError as e:
+            return web.Response(status=400, text=f"Invalid parameters: {e}")
+        rows = await asyncio.to_thread(
+            store.query_actions, since, until, request.query.get("device")
+        )
+        actions = [
+            {
+                "time": ts,
+                "device": device,
+                "command": command,
+                "value": value,
+                "success": bool(success),
+            }
+            for ts, device, command, value, success in rows
+        ]
+        return web.Response(
+            body=json_dumps({"actions": actions}), content_type="application/json"
+        )
+
+    async def get_calibration(self, _) -> web.Response:
+        """
+        Get the expected consumption learned for every calibrated device.
+
+        Returns:
+        web.Response: A JSON with the statistics, the confidence and the proposed
+        value by device name or a 404 if the calibration is not configured.
+        """
+        if self.core.calibrator is None:
+            return web.Response(status=404, text="Calibration not configured")
+        return web.json_response(self.core.calibrator.state())
+
+    async def apply_calibration(self, request: web.Request) -> web.Response:
+        """
+        Apply the proposed expected consumptions. The body can have a list of
+        device names in `devices` to only apply those, e.g. {"devices": ["device1"]}.
+
+        Parameters:
+        request (web.Request): The request object with the optional device names.
+
+        Returns:
+        web.Response: A JSON with the applied values, a 404 if the calibration is
+        not configured or a 400 if the submitted JSON is invalid.
+        """
+        if self.core.calibrator is None:
+            return web.Response(status=404, text="Calibration not configured")
+        names = None
+        if request.can_read_body:
+            try:
+                data = await request.json()
+                names = data.get("devices", None)
+            except (JSONDecodeError, AttributeError):
+                return web.Response(status=400, text="Invalid JSON")
+            if names is not None and not isinstance(names, list):
+                return web.Response(status=400, text="Invalid JSON")
+        return web.json_response({"applied": self.core.calibrator.apply(names)})
+
+    async def get_shadows(self, _) -> web.Response:
+        """
+        Get the estimated outcome of the live planner and of the shadow planners.
+
+        Returns:
+        web.Response: A JSON with the settings and statistics by planner name or a
+        404 if no shadow planner is configured.
+        """
+        if self.core.shadows is None:
+            return web.Response(status=404, text="Shadow planners not configured")
+        return web.json_response(self.core.shadows.state())
+
+    async def get_derived(self, _) -> web.Response:
+        """
+        Get the values of the inputs and the derived entities.
+
+        Returns:
+        web.Response: A JSON with the values by name under "inputs" and "derived"
+        and the derived surplus, or a 404 if there are no derived entities.
+        """
+        if self.core.derived is None:
+            return web.Response(status=404, text="Derived entities not configured")
+        return web.json_response(self.core.derived.state())
+
     async def get_device_consumption(self, request: web.Request) -> web.Response:
         """
         Get the consumption of a device.
@@ -170,28 +536,38 @@ class Api:
         request (web.Request): The request object with the device name.
 
         Returns:
-        web.Response: A JSON with the details of the requested device or a 404 if the
-        device is not found.
+        web.Response: A JSON with the details of the requested device, a 304 if the
+        client already has the current version or a 404 if the device is not found.
         """
         device_name = request.match_info["device_name"]
         device: Device | None = self.core.get_device(device_name)
         if not device:
             return web.Response(status=404, text="Device not found")
-        device_response = DeviceResponse.from_device(device)
-        return web.json_response(device_response.__dict__)
+        return self.cache.response(
+            request,
+            f"device/{device_name}",
+            lambda: DeviceResponse.from_device(device).__dict__,
+        )
 
-    async def get_devices(self, _) -> web.Response:
+    async def get_devices(self, request: web.Request) -> web.Response:
         """
         Get the details of all devices.
 
-        Returns:
-        web.Response: A JSON with a list of all devices and their details.
+        Parameters:
+        request (web.Request): The request object.
 
+        Returns:
+        web.Response: A JSON with a list of all devices and their details or a 304 if
+        the client already has the current version.
         """
-        devices = [
-            DeviceResponse.from_device(device) for device in self.core.devices.values()
+        return self.cache.response(request, "devices", self.__devices_state)
+
+    def __devices_state(self) -> list:
+        """Build the list with the details of all the devices."""
+        return [
+            DeviceResponse.from_device(device).__dict__
+            for device in self.core.devices.values()
         ]
-        return web.json_response([device.__dict__ for device in devices])
 
     async def set_surplus_margin(self, request: web.Request) -> web.Response:
         """
@@ -320,7 +696,284 @@ class Api:
         device.cooldown = value
         return web.json_response({"cooldown": device.cooldown})
 
+    async def patch_core(self, request: web.Request) -> web.Response:
+        """
+        Change several core settings at once. The body is an object with the new
+        values, e.g. {"surplus_margin": 50, "grid_margin": 200}.
+
+        Parameters:
+        request (web.Request): The request object with the new settings.
+
+        Returns:
+        web.Response: A JSON with the settings that changed, or a 400 with the list
+        of errors if the JSON or any of the changes is invalid.
+        """
+        try:
+            data = await request.json()
+        except JSONDecodeError:
+            return web.Response(status=400, text="Invalid JSON")
+        return await self.__apply_changes(core_changes=data)
+
+    async def patch_devices(self, request: web.Request) -> web.Response:
+        """
+        Change the settings of several devices at once. The body is an object with
+        the new values by device name, e.g. {"device1": {"cooldown": 10}}. All the
+        changes are validated before any is applied and the config is written once.
+
+        Parameters:
+        request (web.Request): The request object with the new settings.
+
+        Returns:
+        web.Response: A JSON with the settings that changed, or a 400 with the list
+        of errors if the JSON or any of the changes is invalid.
+        """
+        try:
+            data = await request.json()
+        except JSONDecodeError:
+            return web.Response(status=400, text="Invalid JSON")
+        if not isinstance(data, dict):
+            return web.Response(status=400, text="Invalid JSON")
+        return await self.__apply_changes(device_changes=data)
+
+    async def __apply_changes(self, **changes) -> web.Response:
+        """Apply a batch of changes in the core and build the response."""
+        try:
+            changed = await self.core.apply_changes(**changes)
+        except InvalidConfigurationChange as e:
+            return web.json_response({"errors": e.errors}, status=400)
+        return web.json_response({"changed": changed})
+
+    async def ingest(self, request: web.Request) -> web.Response:
+        """
+        Push a batch of surplus and consumption readings. The body is a JSON list
+        of records, or an object with the list in "records", or newline-delimited
+        JSON with one record per line if the content type is application/x-ndjson.
+        A record is {"entity": "surplus", a device or an input name, "value": number}
+        with an optional Unix "timestamp", records older than the last one of their
+        entity are rejected. The whole batch triggers a single update of the devices.
+
+        If `api.ingest_token` is configured the request must send it in an
+        "Authorization: Bearer <token>" or an "X-Ingest-Token" header.
+
+        Parameters:
+        request (web.Request): The request object with the records.
+
+        Returns:
+        web.Response: A JSON with the number of accepted records and the rejected
+        ones, a 401 if the token is wrong or a 400 if the body is invalid.
+        """
+        if self.ingest_token is not None and not self.__ingest_authorized(request):
+            return web.Response(status=401, text="Invalid ingest token")
+        try:
+            if request.content_type == "application/x-ndjson":
+                # Parsed line by line as the body arrives
+                records = [
+                    json_loads(line) async for line in request.content if line.strip()
+                ]
+            else:
+                records = json_loads(await request.read())
+                if isinstance(records, dict):
+                    records = records.get("records")
+        except ValueError:
+            return web.Response(status=400, text="Invalid JSON")
+        if not isinstance(records, list):
+            return web.Response(status=400, text="Invalid JSON")
+
+        accepted = 0
+        rejected = []
+        with self.core.deferred_update():
+            for index, record in enumerate(records):
+                error = self.__ingest_record(record)
+                if error is None:
+                    accepted += 1
+                else:
+                    rejected.append({"index": index, "error": error})
+        self.__ingest_readings.inc(accepted)
+        return web.json_response({"accepted": accepted, "rejected": rejected})
+
+    def __ingest_authorized(self, request: web.Request) -> bool:
+        """Check the ingest token of a request."""
+        token = request.headers.get("X-Ingest-Token")
+        if token is None:
+            scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+            if scheme.lower() != "bearer":
+                return False
+        return hmac.compare_digest(token.encode(), str(self.ingest_token).encode())
+
+    def __ingest_record(self, record: Any) -> str | None:
+        """Apply an ingested record, returns why it was rejected or None."""
+        if not isinstance(record, dict):
+            return "Invalid record"
+        entity = record.get("entity")
+        value = record.get("value")
+        timestamp = record.get("timestamp")
+        if not isinstance(entity, str):
+            return "Invalid entity"
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            return "Invalid value"
+        if timestamp is not None:
+            if not isinstance(timestamp, (int, float)) or isinstance(timestamp, bool):
+                return "Invalid timestamp"
+            if timestamp < self.ingest_times.get(entity, 0):
+                return "Out of order"
+        if entity == SURPLUS_ENTITY:
+            self.core.surplus = value
+        elif self.core.derived is not None and self.core.derived.is_input(entity):
+            self.core.set_input(entity, value)
+        else:
+            device = self.core.get_device(entity)
+            if device is None:
+                return "Device not found"
+            device.consumption = value
+        if timestamp is not None:
+            self.ingest_times[entity] = timestamp
+        return None
+
+    async def get_traces(self, _) -> web.Response:
+        """
+        Get the recent tracing spans in the Chrome trace event format, to open in
+        Perfetto or chrome://tracing.
+
+        Returns:
+        web.Response: The trace as JSON or a 404 if tracing is disabled.
+        """
+        if not tracer.enabled:
+            return web.Response(status=404, text="Tracing is disabled")
+        return web.Response(
+            body=json_dumps(tracer.chrome_trace()), content_type="application/json"
+        )
+
+    async def get_profile(self, request: web.Request) -> web.Response:
+        """
+        Profile the application for some seconds and get the report. The query
+        parameters are `seconds` (default 5) and `mode`, "cprofile" (default) or
+        "tracemalloc". Only available if `debug.profiling` is enabled.
+
+        Parameters:
+        request (web.Request): The request object with the query parameters.
+
+        Returns:
+        web.Response: The report as plain text, a 404 if profiling is disabled, a
+        409 if another profile is running or a 400 if the parameters are invalid.
+        """
+        debug_config = self.core.config.get("debug", None) or {}
+        if not debug_config.get("profiling", False):
+            return web.Response(status=404, text="Profiling is disabled")
+        mode = request.query.get("mode", "cprofile")
+        try:
+            seconds = float(request.query.get("seconds", 5))
+        except ValueError:
+            return web.Response(status=400, text="Invalid seconds")
+        if not 0 < seconds <= MAX_PROFILE_SECONDS or mode not in PROFILE_MODES:
+            return web.Response(status=400, text="Invalid seconds or mode")
+        if profile_lock.locked():
+            return web.Response(status=409, text="A profile is already running")
+        async with profile_lock:
+            report = await profile(seconds, mode)
+        return web.Response(text=report)
+
+    async def get_metrics(self, _) -> web.Response:
+        """
+        Get the metrics in the Prometheus text exposition format.
+
+        Returns:
+        web.Response: The metrics as plain text.
+        """
+        return web.Response(
+            text=registry.render(),
+            content_type="text/plain",
+            headers={"X-Content-Type-Options": "nosniff"},
+            charset="utf-8",
+        )
+
+    def collect_metrics(self):
+        """
+        Metrics collector with the current state of the core and its devices. Called
+        by the registry on every scrape.
+
+        Yields:
+        str: The lines of the exposition.
+        """
+        yield from collect_core_metrics([self.core])
+
+    async def stream_events(self, request: web.Request) -> web.StreamResponse:
+        """
+        Stream the state changes as Server-Sent Events. A snapshot is sent on
+        connection and then only the changes. If the client is too slow and its queue
+        overflows, a new snapshot is sent.
+
+        Parameters:
+        request (web.Request): The request object.
+
+        Returns:
+        web.StreamResponse: The event stream.
+        """
+        response = web.StreamResponse(
+            headers={
+                "Content-Type": "text/event-stream",
+                "Cache-Control": "no-cache",
+                "Connection": "keep-alive",
+            }
+        )
+        await response.prepare(request)
+        subscriber = self.stream.subscribe()
+        try:
+            await response.write(self.stream.snapshot().sse)
+            while True:
+                try:
+                    event = await asyncio.wait_for(
+                        self.stream.next_event(subscriber), timeout=15
+                    )
+                except asyncio.TimeoutError:
+                    # Comment line to keep the connection alive through proxies
+                    await response.write(b": keep-alive\n\n")
+                    continue
+                await response.write(event.sse)
+        except ConnectionResetError:
+            pass
+        finally:
+            self.stream.unsubscribe(subscriber)
+        return response
+
+    async def stream_websocket(self, request: web.Request) -> web.WebSocketResponse:
+        """
+        Stream the state changes through a WebSocket. Same messages as the
+        Server-Sent Events endpoint.
+
+        Parameters:
+        request (web.Request): The request object.
+
+        Returns:
+        web.WebSocketResponse: The WebSocket.
+        """
+        ws = web.WebSocketResponse(heartbeat=15)
+        await ws.prepare(request)
+        subscriber = self.stream.subscribe()
+        sender = asyncio.create_task(self.__send_events(ws, subscriber))
+        try:
+            # Incoming messages are ignored, the loop ends when the client closes
+            async for _ in ws:
+                pass
+        finally:
+            sender.cancel()
+            self.stream.unsubscribe(subscriber)
+        return ws
+
+    async def __send_events(self, ws: web.WebSocketResponse, subscriber):
+        """Send the snapshot and the events of a subscriber to a WebSocket."""
+        try:
+            await ws.send_str(self.stream.snapshot().payload)
+            while not ws.closed:
+                event = await self.stream.next_event(subscriber)
+                await ws.send_str(event.payload)
+        except ConnectionResetError:
+            pass
+
     async def close(self):
         """Safely close the API."""
-        await self.runner.cleanup()
+        if self.stream is not None:
+            self.stream.close()
+        registry.remove_collector(self.collect_metrics)
+        if self.runner is not None:
+            await self.runner.cleanup()
         logger.info("API closed")
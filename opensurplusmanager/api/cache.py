@@ -0,0 +1,76 @@
+"""Versioned cache of serialized API responses."""
+
+from __future__ import annotations
+
+import secrets
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Callable, Dict, Tuple
+
+from aiohttp import web
+
+from opensurplusmanager.utils import json_dumps
+
+if TYPE_CHECKING:
+    from opensurplusmanager.core import Core
+
+
+@dataclass
+class ResponseCache:
+    """
+    Keeps the serialized body of the read endpoints for the current version of the
+    core state. A body is only built and serialized again after the state changed,
+    repeated requests are served from the cached bytes. Clients sending a matching
+    `If-None-Match` header get a 304 without body.
+    """
+
+    core: Core
+    # key -> (version, body, etag)
+    entries: Dict[str, Tuple[int, bytes, str]] = field(default_factory=dict)
+    # Random per process so an ETag from a previous run never matches
+    epoch: str = field(default_factory=lambda: secrets.token_hex(4))
+
+    def get(self, key: str, builder: Callable[[], Any]) -> Tuple[bytes, str]:
+        """
+        Get the serialized body of a resource, building it if the cached one is
+        outdated.
+
+        Parameters:
+        key (str): The key of the resource.
+        builder (Callable[[], Any]): Builds the data to serialize.
+
+        Returns:
+        Tuple[bytes, str]: The JSON body and its ETag.
+        """
+        version = self.core.version
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == version:
+            return entry[1], entry[2]
+        body = json_dumps(builder())
+        etag = f'"{self.epoch}-{version}"'
+        self.entries[key] = (version, body, etag)
+        return body, etag
+
+    def response(
+        self, request: web.Request, key: str, builder: Callable[[], Any]
+    ) -> web.Response:
+        """
+        Build the response of a cached resource.
+
+        Parameters:
+        request (web.Request): The request, used to read `If-None-Match`.
+        key (str): The key of the resource.
+        builder (Callable[[], Any]): Builds the data to serialize.
+
+        Returns:
+        web.Response: A 304 if the client has the current version, otherwise a
+        JSON response with the cached body.
+        """
+        body, etag = self.get(key, builder)
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if_none_match = request.headers.get("If-None-Match")
+        if if_none_match is not None and (
+            if_none_match.strip() == "*"
+            or etag in (tag.strip() for tag in if_none_match.split(","))
+        ):
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=body, content_type="application/json", headers=headers)
@@ -0,0 +1,187 @@
+"""Live state stream for the REST API (Server-Sent Events and WebSocket)."""
+
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Callable, Dict, List
+
+from opensurplusmanager.bus import COALESCE, StateChange, Subscription
+from opensurplusmanager.utils import json_dumps, logger
+
+if TYPE_CHECKING:
+    from opensurplusmanager.core import Core
+
+
+@dataclass(frozen=True)
+class StreamEvent:
+    """
+    An event serialized once and shared by all the subscribers. Holds the JSON
+    payload used by WebSocket clients and the framed message used by SSE clients.
+    """
+
+    event_type: str
+    payload: str
+    sse: bytes
+
+    @classmethod
+    def create(cls, event_type: str, data: Dict[str, Any]) -> StreamEvent:
+        """
+        Serialize an event.
+
+        Parameters:
+        event_type (str): The type of the event (snapshot, core or device).
+        data (Dict[str, Any]): The content of the event.
+
+        Returns:
+        StreamEvent: The serialized event.
+        """
+        payload = json_dumps({"type": event_type, **data}).decode()
+        sse = f"event: {event_type}\ndata: {payload}\n\n".encode()
+        return cls(event_type=event_type, payload=payload, sse=sse)
+
+
+# Put in a subscriber queue after it overflowed so the client gets a new snapshot.
+RESYNC = None
+# Pending changes of the bus subscription of the stream, one per device attribute
+# since the changes are coalesced
+BUS_QUEUE_SIZE = 1000
+
+
+@dataclass
+class Subscriber:
+    """A client of the stream with its own bounded queue of pending events."""
+
+    queue: asyncio.Queue = field(default_factory=asyncio.Queue)
+    dropped: int = 0
+
+    def push(self, event: StreamEvent):
+        """
+        Queue an event for the subscriber. If the queue is full the pending events
+        are dropped and replaced with a resync marker, so the client receives a new
+        snapshot instead of an incomplete sequence of deltas.
+
+        Parameters:
+        event (StreamEvent): The event to queue.
+        """
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.dropped += self.queue.qsize()
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC)
+
+
+@dataclass
+class StateStream:
+    """
+    Fans out the changes of the core to the connected subscribers. Subscribes to
+    the state changes of the bus while there are subscribers and serializes every
+    change once for all of them.
+    """
+
+    core: Core
+    snapshot_factory: Callable[[], Dict[str, Any]]
+    queue_size: int = 100
+    subscribers: List[Subscriber] = field(default_factory=list)
+    __changes: Subscription | None = field(default=None)
+    __task: asyncio.Task | None = field(default=None)
+
+    def on_change(self, change: StateChange):
+        """
+        Serializes a change once and pushes it to every subscriber.
+
+        Parameters:
+        change (StateChange): The change published by the core.
+        """
+        if change.name is None:
+            event = StreamEvent.create(change.kind, {change.attribute: change.value})
+        else:
+            event = StreamEvent.create(
+                change.kind, {"name": change.name, change.attribute: change.value}
+            )
+        for subscriber in self.subscribers:
+            subscriber.push(event)
+
+    async def __forward(self, changes: Subscription):
+        """
+        Forwards the changes of the bus to the subscribers until the subscription
+        is closed.
+
+        Parameters:
+        changes (Subscription): The subscription to the state changes.
+        """
+        async for change in changes:
+            self.on_change(change)
+
+    def snapshot(self) -> StreamEvent:
+        """
+        Build a snapshot event with the full state of the core and its devices.
+
+        Returns:
+        StreamEvent: The snapshot event.
+        """
+        return StreamEvent.create("snapshot", self.snapshot_factory())
+
+    def subscribe(self) -> Subscriber:
+        """
+        Add a new subscriber to the stream. The first one subscribes the stream to
+        the bus.
+
+        Returns:
+        Subscriber: The new subscriber.
+        """
+        subscriber = Subscriber(queue=asyncio.Queue(maxsize=self.queue_size))
+        self.subscribers.append(subscriber)
+        if self.__changes is None:
+            # A slow stream keeps the last value of every attribute
+            self.__changes = self.core.bus.subscribe(
+                StateChange, maxsize=BUS_QUEUE_SIZE, overflow=COALESCE, name="api"
+            )
+            self.__task = asyncio.create_task(self.__forward(self.__changes))
+        logger.debug("New stream subscriber, %s connected", len(self.subscribers))
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        """
+        Remove a subscriber from the stream. The last one unsubscribes the stream
+        from the bus.
+
+        Parameters:
+        subscriber (Subscriber): The subscriber to remove.
+        """
+        if subscriber in self.subscribers:
+            self.subscribers.remove(subscriber)
+        if subscriber.dropped:
+            logger.info(
+                "Stream subscriber closed, %s events were dropped", subscriber.dropped
+            )
+        if not self.subscribers:
+            self.close()
+
+    async def next_event(self, subscriber: Subscriber) -> StreamEvent:
+        """
+        Wait for the next event of a subscriber. Returns a new snapshot if the
+        subscriber queue overflowed.
+
+        Parameters:
+        subscriber (Subscriber): The subscriber waiting for events.
+
+        Returns:
+        StreamEvent: The next event to send to the client.
+        """
+        event = await subscriber.queue.get()
+        if event is RESYNC:
+            return self.snapshot()
+        return event
+
+    def close(self):
+        """Unsubscribe from the bus and remove the subscribers."""
+        if self.__changes is not None:
+            self.__changes.close()
+            self.__changes = None
+        if self.__task is not None:
+            self.__task.cancel()
+            self.__task = None
+        self.subscribers.clear()
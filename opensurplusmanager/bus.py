@@ -0,0 +1,334 @@
+"""
+Internal event bus between the integrations, the core and the API.
+
+The core publishes typed events (readings, filtered samples, control decisions,
+command results and state changes) and any component can subscribe to the types it needs. Every
+subscription has its own bounded queue, so a slow subscriber never blocks the
+publisher nor the other subscribers. When a queue is full the overflow policy of
+the subscription decides what is lost:
+
+- "drop_oldest" drops the oldest pending event.
+- "coalesce" keeps only the latest pending event per key (e.g. per entity), so a
+  slow subscriber sees every entity with its last value. The `key` of an event
+  includes its type, so events of different types never replace each other.
+
+An event is published as a single object shared by all the subscribers, publishing
+does not allocate per subscriber.
+"""
+
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass, field
+from typing import Any, Dict, Hashable, List, Tuple
+
+from opensurplusmanager.exceptions import SubscriptionClosed
+from opensurplusmanager.metrics import BUS_EVENTS_DROPPED
+from opensurplusmanager.utils import logger
+
+DROP_OLDEST = "drop_oldest"
+COALESCE = "coalesce"
+OVERFLOW_POLICIES = (DROP_OLDEST, COALESCE)
+
+
+@dataclass(frozen=True, slots=True)
+class Reading:
+    """A surplus or consumption reading, before filtering."""
+
+    # "surplus" or the device name
+    entity: str
+    value: float
+
+    @property
+    def key(self) -> Hashable:
+        """Coalescing key."""
+        return (Reading, self.entity)
+
+
+@dataclass(frozen=True, slots=True)
+class Sample:
+    """A reading accepted by the filters, recorded in the history."""
+
+    # "surplus" or "consumption.<device name>"
+    series: str
+    value: float
+    # Unix time of the reading
+    timestamp: float
+
+    @property
+    def key(self) -> Hashable:
+        """Coalescing key."""
+        return (Sample, self.series)
+
+
+@dataclass(frozen=True, slots=True)
+class Decision:
+    """A control cycle that finished."""
+
+    cycle: int
+    surplus: float
+    # Seconds the cycle took, including the device commands
+    duration: float
+
+    @property
+    def key(self) -> Hashable:
+        """Coalescing key, only the last cycle is kept."""
+        return Decision
+
+
+@dataclass(frozen=True, slots=True)
+class CommandResult:
+    """A command sent to a device."""
+
+    device: str
+    # turn_on, turn_off or regulate
+    command: str
+    value: float | None
+    success: bool
+
+    @property
+    def key(self) -> Hashable:
+        """Coalescing key."""
+        return (CommandResult, self.device)
+
+
+@dataclass(frozen=True, slots=True)
+class StateChange:
+    """A change of a setting or of the state of the core or a device."""
+
+    # "core" or "device"
+    kind: str
+    # The device name, None for core changes
+    name: str | None
+    attribute: str
+    value: Any
+
+    @property
+    def key(self) -> Hashable:
+        """Coalescing key."""
+        return (StateChange, self.name, self.attribute)
+
+
+class Subscription:
+    """
+    Bounded queue of the events of the subscribed types. Iterate it with
+    `async for` or call `get` to receive the events.
+    """
+
+    def __init__(
+        self,
+        bus: EventBus,
+        event_types: Tuple[type, ...],
+        maxsize: int,
+        overflow: str,
+        name: str,
+    ):
+        self.bus = bus
+        self.event_types = event_types
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.name = name
+        # Events dropped or replaced because the queue was full
+        self.dropped = 0
+        self.closed = False
+        # Ring of pending events for drop_oldest, preallocated
+        self.__ring: List[Any] = [None] * maxsize if overflow == DROP_OLDEST else []
+        self.__head = 0
+        self.__size = 0
+        # Pending events by key for coalesce, in arrival order of the keys
+        self.__pending: Dict[Hashable, Any] = {}
+        self.__waiter: asyncio.Future | None = None
+        self.__dropped_metric = BUS_EVENTS_DROPPED.labels(name)
+
+    def __len__(self) -> int:
+        return self.__size if self.overflow == DROP_OLDEST else len(self.__pending)
+
+    def push(self, event: Any):
+        """
+        Queue an event, applying the overflow policy if the queue is full. Called
+        by the bus.
+
+        Parameters:
+        event (Any): The event.
+        """
+        if self.overflow == DROP_OLDEST:
+            ring = self.__ring
+            index = (self.__head + self.__size) % self.maxsize
+            if self.__size == self.maxsize:
+                self.__head = (self.__head + 1) % self.maxsize
+                self.__dropped()
+            else:
+                self.__size += 1
+            ring[index] = event
+        else:
+            pending = self.__pending
+            key = event.key
+            if key in pending:
+                # Keeps the position of the key in the queue
+                pending[key] = event
+            else:
+                if len(pending) == self.maxsize:
+                    del pending[next(iter(pending))]
+                    self.__dropped()
+                pending[key] = event
+        waiter = self.__waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def __dropped(self):
+        """Account an event lost because the queue was full."""
+        self.dropped += 1
+        self.__dropped_metric.inc()
+
+    def get_nowait(self) -> Any:
+        """
+        Get the oldest pending event.
+
+        Returns:
+        Any: The event.
+
+        Raises:
+        asyncio.QueueEmpty: If there is no pending event.
+        """
+        if self.overflow == DROP_OLDEST:
+            if not self.__size:
+                raise asyncio.QueueEmpty
+            event = self.__ring[self.__head]
+            self.__ring[self.__head] = None
+            self.__head = (self.__head + 1) % self.maxsize
+            self.__size -= 1
+            return event
+        if not self.__pending:
+            raise asyncio.QueueEmpty
+        key = next(iter(self.__pending))
+        return self.__pending.pop(key)
+
+    async def get(self) -> Any:
+        """
+        Wait for the next event.
+
+        Returns:
+        Any: The event.
+
+        Raises:
+        SubscriptionClosed: If the subscription is closed.
+        """
+        while not len(self):
+            if self.closed:
+                raise SubscriptionClosed(self.name)
+            self.__waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self.__waiter
+            finally:
+                self.__waiter = None
+        return self.get_nowait()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Any:
+        try:
+            return await self.get()
+        except SubscriptionClosed as e:
+            raise StopAsyncIteration from e
+
+    def close(self):
+        """Unsubscribe from the bus. The pending events can still be received."""
+        if self.closed:
+            return
+        self.closed = True
+        self.bus.unsubscribe(self)
+        waiter = self.__waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+        if self.dropped:
+            logger.info(
+                "Bus subscription %s closed, %s events were dropped",
+                self.name,
+                self.dropped,
+            )
+
+
+@dataclass
+class EventBus:
+    """Publishes the events to the subscriptions of their type."""
+
+    # Subscriptions by event type. The lists are replaced, never modified, so a
+    # subscription can be closed while an event is being published.
+    __subscriptions: Dict[type, List[Subscription]] = field(default_factory=dict)
+
+    def subscribe(
+        self,
+        *event_types: type,
+        maxsize: int = 100,
+        overflow: str = DROP_OLDEST,
+        name: str = "subscriber",
+    ) -> Subscription:
+        """
+        Subscribe to one or more event types.
+
+        Parameters:
+        event_types (type): The event types, e.g. Reading, StateChange.
+        maxsize (int): Maximum pending events.
+        overflow (str): What to do when the queue is full, "drop_oldest" or
+        "coalesce".
+        name (str): Name of the subscriber used in the logs and metrics.
+
+        Returns:
+        Subscription: The subscription.
+
+        Raises:
+        ValueError: If the overflow policy or the size is not valid.
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"overflow must be one of {', '.join(OVERFLOW_POLICIES)}")
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+        subscription = Subscription(self, event_types, maxsize, overflow, name)
+        for event_type in event_types:
+            self.__subscriptions[event_type] = [
+                *self.__subscriptions.get(event_type, ()),
+                subscription,
+            ]
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        """
+        Remove a subscription. Use `Subscription.close` instead.
+
+        Parameters:
+        subscription (Subscription): The subscription.
+        """
+        for event_type in subscription.event_types:
+            remaining = [
+                other
+                for other in self.__subscriptions.get(event_type, ())
+                if other is not subscription
+            ]
+            if remaining:
+                self.__subscriptions[event_type] = remaining
+            else:
+                self.__subscriptions.pop(event_type, None)
+
+    def subscribed(self, event_type: type) -> bool:
+        """
+        Whether an event type has subscribers, to avoid building events nobody
+        receives.
+
+        Parameters:
+        event_type (type): The event type.
+
+        Returns:
+        bool: True if there is at least one subscription.
+        """
+        return event_type in self.__subscriptions
+
+    def publish(self, event: Any):
+        """
+        Queue an event in the subscriptions of its type.
+
+        Parameters:
+        event (Any): The event.
+        """
+        for subscription in self.__subscriptions.get(type(event), ()):
+            subscription.push(event)
@@ -0,0 +1,294 @@
+"""
+Online calibration of the expected consumption of the devices.
+
+While a switch device is powered its consumption readings are summarized with
+constant memory statistics (Welford mean and variance and P² quantile
+estimators). Periodically a new expected consumption is proposed from them and,
+if the calibration is in apply mode and the guardrails allow it, applied to the
+devices with a single config write.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import math
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Dict
+
+from opensurplusmanager.models.device import DeviceType
+from opensurplusmanager.utils import logger
+
+if TYPE_CHECKING:
+    from opensurplusmanager.core import Core
+    from opensurplusmanager.models.device import Device
+
+
+class Welford:
+    """Running mean and variance."""
+
+    __slots__ = ("count", "mean", "m2")
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value: float):
+        """Add a sample."""
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    @property
+    def std(self) -> float:
+        """Sample standard deviation."""
+        if self.count < 2:
+            return 0.0
+        return math.sqrt(self.m2 / (self.count - 1))
+
+
+class P2Quantile:
+    """
+    Streaming estimator of a quantile with the P² algorithm (Jain and Chlamtac),
+    using five markers regardless of the number of samples.
+    """
+
+    __slots__ = ("quantile", "heights", "positions", "desired", "increments")
+
+    def __init__(self, quantile: float):
+        self.quantile = quantile
+        self.heights = []
+        self.positions = [1, 2, 3, 4, 5]
+        q = quantile
+        self.desired = [1, 1 + 2 * q, 1 + 4 * q, 3 + 2 * q, 5]
+        self.increments = [0, q / 2, q, (1 + q) / 2, 1]
+
+    def add(self, value: float):
+        """Add a sample."""
+        heights = self.heights
+        if len(heights) < 5:
+            heights.append(value)
+            heights.sort()
+            return
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = 0
+            while value >= heights[cell + 1]:
+                cell += 1
+        positions = self.positions
+        for i in range(cell + 1, 5):
+            positions[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+        for i in range(1, 4):
+            offset = self.desired[i] - positions[i]
+            if (offset >= 1 and positions[i + 1] - positions[i] > 1) or (
+                offset <= -1 and positions[i - 1] - positions[i] < -1
+            ):
+                step = 1 if offset > 0 else -1
+                height = self.__parabolic(i, step)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = self.__linear(i, step)
+                heights[i] = height
+                positions[i] += step
+
+    def __parabolic(self, i: int, step: int) -> float:
+        h, n = self.heights, self.positions
+        return h[i] + step / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + step) * (h[i + 1] - h[i]) / (n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - step) * (h[i] - h[i - 1]) / (n[i] - n[i - 1])
+        )
+
+    def __linear(self, i: int, step: int) -> float:
+        h, n = self.heights, self.positions
+        return h[i] + step * (h[i + step] - h[i]) / (n[i + step] - n[i])
+
+    @property
+    def value(self) -> float | None:
+        """The current estimation, None without samples."""
+        heights = self.heights
+        if not heights:
+            return None
+        if len(heights) < 5:
+            return heights[min(int(self.quantile * len(heights)), len(heights) - 1)]
+        return heights[2]
+
+
+class DeviceStatistics:
+    """Statistics of the consumption of a device while it is powered."""
+
+    __slots__ = ("moments", "median", "p90")
+
+    def __init__(self):
+        self.moments = Welford()
+        self.median = P2Quantile(0.5)
+        self.p90 = P2Quantile(0.9)
+
+    def add(self, value: float):
+        """Add a sample."""
+        self.moments.add(value)
+        self.median.add(value)
+        self.p90.add(value)
+
+    def get(self, statistic: str) -> float | None:
+        """Get a statistic by name (mean, median or p90)."""
+        if statistic == "mean":
+            return self.moments.mean if self.moments.count else None
+        if statistic == "median":
+            return self.median.value
+        return self.p90.value
+
+    @property
+    def confidence(self) -> float:
+        """
+        Confidence of the estimation between 0 and 1, one minus the relative
+        standard error of the mean.
+        """
+        moments = self.moments
+        if moments.count < 2 or moments.mean <= 0:
+            return 0.0
+        error = moments.std / math.sqrt(moments.count) / moments.mean
+        return max(0.0, 1.0 - error)
+
+
+@dataclass
+class Calibrator:
+    """
+    Learns the expected consumption of the switch devices. In "propose" mode the
+    values are only exposed, in "apply" mode they are also applied every
+    `interval` seconds when they pass the guardrails.
+    """
+
+    core: Core
+    mode: str = "propose"
+    # Seconds between evaluations
+    interval: int = 3600
+    # Statistic used as expected consumption: mean, median or p90
+    statistic: str = "median"
+    min_samples: int = 100
+    min_confidence: float = 0.9
+    # Maximum relative change applied in one evaluation
+    max_change: float = 0.2
+    # Devices excluded from calibration
+    exclude: list = field(default_factory=list)
+    statistics: Dict[str, DeviceStatistics] = field(default_factory=dict)
+
+    def __post_init__(self):
+        if self.mode not in ("propose", "apply"):
+            raise ValueError("Calibration mode must be propose or apply")
+        if self.statistic not in ("mean", "median", "p90"):
+            raise ValueError("Calibration statistic must be mean, median or p90")
+        for device in self.core.devices.values():
+            if device.device_type == DeviceType.SWITCH and device.name not in (
+                self.exclude
+            ):
+                self.statistics[device.name] = DeviceStatistics()
+
+    def add_reading(self, device: Device, value: float):
+        """
+        Add an accepted consumption reading of a device, called by the device for
+        every reading, also when it is equal to the previous one.
+
+        Parameters:
+        device (Device): The device.
+        value (float): The filtered reading.
+        """
+        statistics = self.statistics.get(device.name)
+        if statistics is None:
+            return
+        if device.powered and device.enabled and value > self.core.idle_power:
+            statistics.add(value)
+
+    def proposal(self, device: Device) -> float | None:
+        """
+        Get the expected consumption proposed for a device, limited by the
+        guardrails.
+
+        Parameters:
+        device (Device): The device.
+
+        Returns:
+        float | None: The proposed value or None if there is not enough data.
+        """
+        statistics = self.statistics.get(device.name)
+        if statistics is None or statistics.moments.count < self.min_samples:
+            return None
+        if statistics.confidence < self.min_confidence:
+            return None
+        value = statistics.get(self.statistic)
+        current = device.expected_consumption
+        if current:
+            low = current * (1 - self.max_change)
+            high = current * (1 + self.max_change)
+            value = min(max(value, low), high)
+        if device.max_consumption is not None:
+            value = min(value, device.max_consumption)
+        return round(value, 1)
+
+    def state(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Get the learned values of every calibrated device.
+
+        Returns:
+        Dict[str, Dict[str, Any]]: The statistics and the proposal by device name.
+        """
+        result = {}
+        for name, statistics in self.statistics.items():
+            device = self.core.devices[name]
+            result[name] = {
+                "expected_consumption": device.expected_consumption,
+                "samples": statistics.moments.count,
+                "mean": statistics.get("mean"),
+                "std": statistics.moments.std,
+                "median": statistics.get("median"),
+                "p90": statistics.get("p90"),
+                "confidence": statistics.confidence,
+                "proposed": self.proposal(device),
+            }
+        return result
+
+    def apply(self, names: list | None = None) -> Dict[str, float]:
+        """
+        Apply the proposals to the devices, writing the config once. The
+        statistics of an updated device are reset so the next proposal only uses
+        new readings.
+
+        Parameters:
+        names (list | None): The devices to apply, all the calibrated if None.
+
+        Returns:
+        Dict[str, float]: The new expected consumption by device name.
+        """
+        applied = {}
+        with self.core.deferred_save():
+            for name in names if names is not None else list(self.statistics):
+                device = self.core.get_device(name)
+                if device is None or name not in self.statistics:
+                    continue
+                value = self.proposal(device)
+                if value is None or value == device.expected_consumption:
+                    continue
+                logger.info(
+                    "Calibrated expected consumption of %s: %s -> %s",
+                    name,
+                    device.expected_consumption,
+                    value,
+                )
+                device.expected_consumption = value
+                self.statistics[name] = DeviceStatistics()
+                applied[name] = value
+        return applied
+
+    async def run(self):
+        """Indefinitely applies the proposals every `interval` seconds."""
+        if self.mode != "apply":
+            return
+        while True:
+            await asyncio.sleep(self.interval)
+            self.apply()
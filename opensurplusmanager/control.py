@@ -0,0 +1,149 @@
+"""
+Closed-loop power controller for the regulated devices.
+
+Without a controller a regulated device is set to its consumption plus the whole
+surplus, which overshoots and oscillates when the device takes longer than a
+polling period to reach the new power (EV chargers, heaters behind a PWM
+controller). A controller keeps its state between the control cycles and moves
+the power towards the surplus margin with a PID law, so it converges in fewer
+commands.
+"""
+
+from __future__ import annotations
+
+import math
+from typing import Dict
+
+
+class PIDController:
+    """
+    PID controller of the power of a regulated device with feed-forward and
+    anti-windup.
+
+    The error is the surplus minus the surplus margin, a positive error means the
+    device can consume more. The integral term holds the power of the device and
+    starts at its consumption when the controller is reset, so the first command
+    does not jump. The feed-forward adds a fraction of the change of the power
+    available to the device (the surplus plus its own consumption) since the
+    previous cycle, which reacts to a change of the solar production or of the
+    other loads without waiting for the integral. When the output is clamped to
+    the power range of the device the integral is clamped too, so it does not wind
+    up while the device is saturated.
+    """
+
+    __slots__ = (
+        "kp",
+        "ki",
+        "kd",
+        "feed_forward",
+        "deadband",
+        "integral",
+        "last_error",
+        "last_available",
+        "last_time",
+    )
+
+    def __init__(
+        self,
+        kp: float = 0.5,
+        ki: float = 0.1,
+        kd: float = 0.0,
+        feed_forward: float = 0.8,
+        deadband: float = 20.0,
+    ):
+        """
+        Parameters:
+            kp (float): Proportional gain, watts per watt of error.
+            ki (float): Integral gain, watts per watt of error and second.
+            kd (float): Derivative gain, watts per watt of error per second.
+            feed_forward (float): Fraction of the change of the available power
+            added to the output, 0 to disable.
+            deadband (float): Watts the output has to differ from the last command
+            to send a new one.
+
+        Raises:
+            ValueError: If a gain or the deadband is negative.
+        """
+        if min(kp, ki, kd, feed_forward, deadband) < 0:
+            raise ValueError("Controller gains and deadband can not be negative")
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.feed_forward = feed_forward
+        self.deadband = deadband
+        self.reset()
+
+    def reset(self):
+        """Forget the state, the next update starts from the device consumption."""
+        self.integral = math.nan
+        self.last_error = 0.0
+        self.last_available = 0.0
+        self.last_time = 0.0
+
+    def update(
+        self,
+        error: float,
+        consumption: float,
+        now: float,
+        low: float,
+        high: float,
+    ) -> float:
+        """
+        Compute the power of the device for a cycle.
+
+        Parameters:
+            error (float): The surplus minus the surplus margin.
+            consumption (float): The consumption of the device.
+            now (float): The time.monotonic() of the cycle.
+            low (float): Minimum power of the device.
+            high (float): Maximum power of the device.
+
+        Returns:
+            float: The power of the device, between low and high.
+        """
+        available = error + consumption
+        if math.isnan(self.integral):
+            self.integral = consumption
+            dt = 0.0
+            derivative = 0.0
+        else:
+            dt = now - self.last_time
+            derivative = (error - self.last_error) / dt if dt > 0 else 0.0
+            self.integral += self.ki * error * dt
+            self.integral += self.feed_forward * (available - self.last_available)
+        proportional = self.kp * error
+        self.last_error = error
+        self.last_available = available
+        self.last_time = now
+
+        output = self.integral + proportional + self.kd * derivative
+        clamped = min(max(output, low), high)
+        if clamped != output:
+            # Back-calculation: keep the integral where the output is at the limit
+            self.integral += clamped - output
+        return clamped
+
+    @classmethod
+    def from_config(cls, config: Dict | None) -> PIDController | None:
+        """
+        Build a controller from the `controller` config of a device, for example
+        {"kp": 0.5, "ki": 0.1, "feed_forward": 0.8}. An empty config uses the
+        default gains.
+
+        Parameters:
+            config (Dict | None): The controller config.
+
+        Returns:
+            PIDController | None: The controller or None if it is not configured.
+
+        Raises:
+            ValueError: If a parameter is not valid.
+        """
+        if config is None:
+            return None
+        if config is True:
+            config = {}
+        try:
+            return cls(**config)
+        except TypeError as e:
+            raise ValueError(f"Invalid controller parameters: {e}") from e
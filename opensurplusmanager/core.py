@@ -1,23 +1,75 @@
 """This file contains the main logic for the application."""
 
 import asyncio
+import logging
+import math
 import os
+import time
+from contextlib import contextmanager
 from dataclasses import dataclass, field
-from typing import Dict
+from typing import Any, Awaitable, Callable, Dict, List
 
 import yaml
 
 from opensurplusmanager.api import Api
+from opensurplusmanager.bus import (
+    CommandResult,
+    Decision,
+    EventBus,
+    Reading,
+    Sample,
+    StateChange,
+    Subscription,
+)
+from opensurplusmanager.calibration import Calibrator
+from opensurplusmanager.control import PIDController
+from opensurplusmanager.derived import DERIVED_SOURCE, DerivedEntities
+from opensurplusmanager.exceptions import InvalidConfigurationChange
+from opensurplusmanager.filters import FilterChain
+from opensurplusmanager.history import History
+from opensurplusmanager.ingestion import IngestionSupervisor
+from opensurplusmanager.journal import (
+    ATTRIBUTE_KINDS,
+    COMMAND_KINDS,
+    NO_DEVICE,
+    Journal,
+    RecordKind,
+)
+from opensurplusmanager.metrics import CONFIG_SAVES, CYCLE_DURATION
 from opensurplusmanager.models.device import (
     Device,
     DeviceType,
     IntegrationConnectionError,
 )
 from opensurplusmanager.models.integration import ControlIntegration
+from opensurplusmanager.models.state import DeviceStateTable
+from opensurplusmanager.shadow import ShadowPlanners
+from opensurplusmanager.snapshot import RuntimeSnapshot
+from opensurplusmanager.storage import HistoryStore
+from opensurplusmanager.tracing import tracer
 from opensurplusmanager.utils import logger
 
 config_file_name = os.getenv("CONFIG_FILE", "config.yaml")
 
+PLAN_DURATION = CYCLE_DURATION.labels("plan")
+DISPATCH_DURATION = CYCLE_DURATION.labels("dispatch")
+CONFIG_SAVE_COUNT = CONFIG_SAVES.labels()
+
+# Called as listener(kind, device_name, attribute, value) where kind is "core" or
+# "device" and device_name is None for core changes.
+ChangeListener = Callable[[str, str | None, str, Any], None]
+
+# Integrations that can read the state entity of a device
+STATE_INTEGRATIONS = ("http_get", "mqtt_sub")
+
+# Settings that can be changed at runtime and whether they accept None
+CORE_SETTINGS = {"surplus_margin": False, "grid_margin": False, "idle_power": False}
+DEVICE_SETTINGS = {
+    "expected_consumption": False,
+    "max_consumption": True,
+    "cooldown": True,
+}
+
 
 @dataclass
 class Core:
@@ -27,6 +79,11 @@ class Core:
     """
 
     __surplus = 0
+    # Last surplus reading before filtering
+    __raw_surplus = 0
+    # time.monotonic() of the last surplus reading, 0 if there is none
+    __surplus_updated_at = 0
+    __surplus_stale = False
     # How much surplus power is left in a normal case.
     # Positive is a surplus, negative is grid consumption.
     __surplus_margin: float | None = field(default=100)
@@ -34,9 +91,70 @@ class Core:
     # is tolerated before turning off devices.
     __grid_margin: float | None = field(default=100)
     config: Dict = field(default_factory=dict)
+    # File the config is saved to
+    config_file: str = field(default=config_file_name)
+    # Name of the site in multi-site mode, None when running a single core
+    name: str | None = None
     __idle_power: float = field(default=50)
     devices: Dict[str, Device] = field(default_factory=dict)
+    # Runtime state of the devices, indexed by their slot
+    state: DeviceStateTable = field(default_factory=DeviceStateTable)
     api: Api | None = None
+    listeners: List[ChangeListener] = field(default_factory=list)
+    # Readings, decisions, command results and state changes for any subscriber
+    bus: EventBus = field(default_factory=EventBus)
+    history: History = field(default_factory=History)
+    # Samples of the bus waiting to be recorded in the history, None if the
+    # config is not loaded
+    __samples: Subscription | None = field(default=None)
+    __surplus_filter: FilterChain | None = field(default=None)
+    # Integration that provides the surplus, "derived" if it is computed
+    surplus_source: str | None = None
+    # Inputs and entities computed from them, None if there are none
+    derived: DerivedEntities | None = None
+    # Seconds after which the surplus is stale, None to never be stale
+    surplus_stale_after: float | None = None
+    # What to do while the surplus is stale: "hold" keeps the devices as they are,
+    # "shed" turns them off.
+    stale_policy: str = "hold"
+    # Seconds between freshness checks
+    freshness_interval: float = 1
+    # Seconds after a turn on or turn off command before the actual state of the
+    # device is trusted over the commanded one
+    state_settle_time: float = 30
+    # Infer the actual state of the devices without a state entity from their
+    # consumption, on above the idle power
+    infer_state: bool = False
+    # Readings that never arrived are stale counting from this time.monotonic()
+    __started_at: float = field(default_factory=time.monotonic)
+    store: HistoryStore | None = None
+    calibrator: Calibrator | None = None
+    journal: Journal | None = None
+    # Runtime state written periodically and loaded on start for warm restarts
+    snapshot: RuntimeSnapshot | None = None
+    # Alternative planners evaluated on every cycle without actuating
+    shadows: ShadowPlanners | None = None
+    # Runs the consumption integrations in worker processes if configured
+    ingestion: IngestionSupervisor | None = None
+    # Number of the current control cycle, written in the journal records
+    cycle: int = 0
+    # Run a control cycle for every surplus reading, disabled by the replay of the
+    # journal that runs the journaled cycles
+    auto_update: bool = True
+    # Incremented on every state change, used to cache the API responses.
+    __version: int = field(default=0)
+    # Held while the devices are being updated or a batch of changes is applied.
+    __update_lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    __deferred_saves: int = field(default=0)
+    __save_pending: bool = field(default=False)
+    __deferred_updates: int = field(default=0)
+    __update_pending: bool = field(default=False)
+    # Time spent waiting for device commands in the current cycle
+    __dispatch_time: float = field(default=0)
+    # Background tasks started by `start`, cancelled by `close`
+    __tasks: List[asyncio.Task] = field(default_factory=list)
+    # Turns off the devices while the surplus is stale, None if it is not running
+    __shed_task: asyncio.Task | None = field(default=None)
 
     @property
     def surplus(self) -> float:
@@ -45,11 +163,101 @@ class Core:
 
     @surplus.setter
     def surplus(self, value):
-        """Set the surplus power available. Creates a task to update the devices."""
-        logger.info("Setting surplus to %s", value)
-        self.__surplus = value
+        """
+        Set the surplus power available. The reading goes through the surplus
+        filters if they are configured, rejected readings are ignored. Creates a
+        task to update the devices, or a single one when the `deferred_update`
+        block it is set in exits.
+        """
+        logger.debug("Setting surplus to %s", value)
+        if self.journal is not None:
+            self.journal.write(RecordKind.SURPLUS, value=value, cycle=self.cycle)
+        if self.bus.subscribed(Reading):
+            self.bus.publish(Reading("surplus", value))
+        self.__raw_surplus = value
+        self.__surplus_updated_at = time.monotonic()
+        # The time and raw value of the reading are served by the API even if
+        # the filtered value does not change
+        self.touch()
+        if self.__surplus_stale:
+            self.__set_surplus_stale(False)
+        if self.__surplus_filter is not None:
+            value = self.__surplus_filter.update(value)
+            if value is None:
+                logger.debug("Surplus reading %s rejected", self.__raw_surplus)
+                return
+        self.record_reading("surplus", value)
+        if value != self.__surplus:
+            self.__surplus = value
+            self.notify_change("core", None, "surplus", value)
+        if not self.auto_update:
+            return
+        if self.__deferred_updates:
+            self.__update_pending = True
+            return
         asyncio.create_task(self.__update())
 
+    @property
+    def raw_surplus(self) -> float:
+        """The last surplus reading before filtering."""
+        return self.__raw_surplus
+
+    @property
+    def surplus_updated_at(self) -> float:
+        """time.monotonic() of the last surplus reading, 0 if there is none."""
+        return self.__surplus_updated_at
+
+    @property
+    def trace_lane(self) -> str:
+        """Tracing lane of the control cycles and device commands."""
+        return "core" if self.name is None else f"core {self.name}"
+
+    @property
+    def surplus_stale(self) -> bool:
+        """Whether the surplus reading is too old to be trusted."""
+        return self.__surplus_stale
+
+    def restore_surplus(self, value: float, raw_value: float, updated_at: float):
+        """
+        Restore the surplus from a runtime snapshot without running a control
+        cycle.
+
+        Parameters:
+        value (float): The surplus after filtering.
+        raw_value (float): The last surplus reading before filtering.
+        updated_at (float): time.monotonic() of the reading, 0 if there was none.
+        """
+        self.__surplus = value
+        self.__raw_surplus = raw_value
+        self.__surplus_updated_at = updated_at
+        self.notify_change("core", None, "surplus", value)
+
+    def __set_surplus_stale(self, value: bool):
+        """Set the stale state of the surplus and notify the listeners."""
+        self.__surplus_stale = value
+        if value:
+            logger.warning(
+                "Surplus reading is stale, applying the %s policy", self.stale_policy
+            )
+        else:
+            logger.info("Surplus reading is fresh again")
+        self.notify_change("core", None, "surplus_stale", value)
+
+    @property
+    def version(self) -> int:
+        """
+        Monotonically increasing version of the state of the core and its devices.
+        Changes every time a listener is notified and on every reading.
+        """
+        return self.__version
+
+    def touch(self):
+        """
+        Change the version of the state without notifying the listeners, for the
+        changes only the API serves, e.g. the time of a reading.
+        """
+        self.__version += 1
+
     @property
     def surplus_margin(self) -> float:
         """
@@ -63,6 +271,7 @@ class Core:
         """Set the surplus_margin. Updates the config and saves it."""
         logger.info("Setting surplus margin to %s", value)
         self.__surplus_margin = value
+        self.notify_change("core", None, "surplus_margin", value)
         self.config["surplus_margin"] = value
         self.save_config()
 
@@ -76,6 +285,7 @@ class Core:
         """Set the grid_margin. Updates the config and saves it."""
         logger.info("Setting grid margin to %s", value)
         self.__grid_margin = value
+        self.notify_change("core", None, "grid_margin", value)
         self.config["grid_margin"] = value
         self.save_config()
 
@@ -95,6 +305,7 @@ class Core:
         """
         logger.info("Setting idle power to %s", value)
         self.__idle_power = value
+        self.notify_change("core", None, "idle_power", value)
         self.config["idle_power"] = value
         self.save_config()
 
@@ -113,14 +324,14 @@ class Core:
             if device.device_type == DeviceType.SWITCH:
                 if device.expected_consumption < available_power and not device.powered:
                     try:
-                        await device.turn_on()
+                        await self.__dispatch(device.turn_on())
                     except IntegrationConnectionError:
                         continue
                     available_power -= device.expected_consumption
             elif device.device_type == DeviceType.REGULATED:
                 if device.expected_consumption < available_power and not device.powered:
                     try:
-                        await device.turn_on()
+                        await self.__dispatch(device.turn_on())
                     except IntegrationConnectionError:
                         continue
                     device_power = (
@@ -129,11 +340,22 @@ class Core:
                         else available_power
                     )
                     try:
-                        await device.regulate(device_power)
+                        await self.__dispatch(device.regulate(device_power))
                     except IntegrationConnectionError:
                         continue
                     available_power -= device_power
-                elif device.powered and device.consumption > self.idle_power:
+                    if device.controller is not None:
+                        device.controller.reset()
+                elif (
+                    device.powered
+                    and not device.stale
+                    and device.consumption > self.idle_power
+                ):
+                    if device.controller is not None:
+                        available_power -= await self.__control(
+                            device, available_power - self.surplus_margin
+                        )
+                        continue
                     total_device_power = device.consumption + available_power
                     device_power = (
                         device.max_consumption
@@ -141,7 +363,7 @@ class Core:
                         else total_device_power
                     )
                     try:
-                        await device.regulate(device_power)
+                        await self.__dispatch(device.regulate(device_power))
                     except IntegrationConnectionError:
                         continue
                     added_power = device_power - device.consumption
@@ -158,49 +380,236 @@ class Core:
         """
         devices = reversed(self.devices.values())
         for device in filter(lambda x: x.enabled, devices):
-            if device.powered and device.consumption > self.idle_power:
+            # The consumption of a stale device is unknown, assume it is consuming
+            if device.powered and (
+                device.stale or device.consumption > self.idle_power
+            ):
                 if device.device_type == DeviceType.SWITCH:
                     try:
-                        await device.turn_off()
+                        await self.__dispatch(device.turn_off())
                     except IntegrationConnectionError:
                         continue
                     exceeded_power -= device.expected_consumption
 
                 elif device.device_type == DeviceType.REGULATED:
                     if (
-                        exceeded_power
+                        device.stale
+                        or exceeded_power
                         > device.consumption - device.expected_consumption
                     ):
                         try:
-                            await device.turn_off()
+                            await self.__dispatch(device.turn_off())
                         except IntegrationConnectionError:
                             continue
                         exceeded_power -= device.expected_consumption
+                    elif device.controller is not None:
+                        await self.__control(device, -exceeded_power)
+                        break
                     else:
-                        await device.regulate(device.consumption - exceeded_power)
+                        await self.__dispatch(
+                            device.regulate(device.consumption - exceeded_power)
+                        )
                         break
 
             if exceeded_power < 0:
                 break
 
+    async def run_cycle(self):
+        """Run a control cycle with the current surplus and wait for it to end."""
+        await self.__update()
+
     async def __update(self):
         """
         Every time the surplus is updated this method is called so devices
         can be turned on/off or regulated based on the new surplus data
         available.
         """
-        logger.info("Core is running")
-        self.__debug()
-        if self.surplus > 0:
-            await self.__turn_on_priority(self.surplus)
-        elif self.surplus < (-self.grid_margin):
-            await self.__turn_off_priority(self.surplus_margin - self.surplus)
+        async with self.__update_lock:
+            with tracer.span("cycle", self.trace_lane):
+                logger.debug("Core is running")
+                self.__debug()
+                start = time.perf_counter()
+                self.__dispatch_time = 0
+                self.cycle += 1
+                if self.journal is not None:
+                    self.journal.write(
+                        RecordKind.CYCLE, value=self.surplus, cycle=self.cycle
+                    )
+                self.reconcile()
+                if self.surplus > 0:
+                    await self.__turn_on_priority(self.surplus)
+                elif self.surplus < (-self.grid_margin):
+                    await self.__turn_off_priority(self.surplus_margin - self.surplus)
+                else:
+                    await self.__regulate_controlled(self.surplus - self.surplus_margin)
+                elapsed = time.perf_counter() - start
+                PLAN_DURATION.observe(elapsed - self.__dispatch_time)
+                DISPATCH_DURATION.observe(self.__dispatch_time)
+                if self.bus.subscribed(Decision):
+                    self.bus.publish(Decision(self.cycle, self.surplus, elapsed))
+
+    async def __control(self, device: Device, error: float) -> float:
+        """
+        Regulate a device with its controller.
+
+        Parameters:
+        device (Device): The regulated device.
+        error (float): The power available to the device minus the surplus margin.
+
+        Returns:
+        float: The power added to the device, 0 if no command was sent.
+        """
+        high = device.max_consumption
+        power = device.controller.update(
+            error,
+            device.consumption,
+            time.monotonic(),
+            device.expected_consumption,
+            math.inf if high is None else high,
+        )
+        last_power = self.state.last_power[device.slot]
+        if abs(power - last_power) < device.controller.deadband:
+            return 0
+        try:
+            await self.__dispatch(device.regulate(power))
+        except IntegrationConnectionError:
+            return 0
+        return power - device.consumption
+
+    async def __regulate_controlled(self, error: float):
+        """
+        Regulate the powered devices that have a controller, in priority order.
+        Used when the surplus is between the grid margin and 0, where the devices
+        are otherwise left as they are.
+
+        Parameters:
+        error (float): The surplus minus the surplus margin.
+        """
+        for device in self.devices.values():
+            if (
+                device.controller is not None
+                and device.enabled
+                and device.powered
+                and not device.stale
+                and device.consumption > self.idle_power
+            ):
+                error -= await self.__control(device, error)
+
+    def reconcile(self):
+        """
+        Fix the powered state of the devices that do not match their actual state,
+        e.g. switched by hand or that ignored a command, so the plan starts from
+        the real state. The actual state is not trusted until `state_settle_time`
+        seconds after the last command, while the device is still reacting.
+        """
+        now = time.monotonic()
+        state = self.state
+        for device in self.devices.values():
+            slot = device.slot
+            if now - state.commanded_at[slot] < self.state_settle_time:
+                continue
+            actual = device.actual_powered
+            if actual is None or actual == device.powered:
+                continue
+            self.reconcile_device(device, actual)
+
+    def reconcile_device(self, device: Device, actual: bool):
+        """
+        Set the powered state of a device to its actual state and journal it, the
+        replay of the journal applies the reconciliation from this record.
+
+        Parameters:
+        device (Device): The device that does not match its actual state.
+        actual (bool): The actual state of the device.
+        """
+        if self.journal is not None:
+            self.journal.write(
+                RecordKind.RECONCILE, device.slot, actual, cycle=self.cycle
+            )
+        self.state.mismatches[device.slot] += 1
+        logger.warning(
+            "Device %s is %s but it was assumed %s, reconciling",
+            device.name,
+            "on" if actual else "off",
+            "on" if device.powered else "off",
+        )
+        device.powered = actual
+        if device.controller is not None:
+            device.controller.reset()
+
+    async def __shed(self):
+        """
+        Turn off every powered device that is not in cooldown. Used when the
+        surplus is stale and the stale policy is "shed".
+        """
+        async with self.__update_lock:
+            for device in reversed(self.devices.values()):
+                if device.powered and device.enabled:
+                    try:
+                        await self.__dispatch(device.turn_off())
+                    except IntegrationConnectionError:
+                        continue
+
+    def check_freshness(self):
+        """
+        Update the stale state of the surplus, the devices and the inputs of the
+        derived entities from the time of their last reading. A reading that never arrived is stale once the threshold has
+        passed since the core started running.
+        """
+        now = time.monotonic()
+        if self.surplus_stale_after:
+            updated_at = self.__surplus_updated_at or self.__started_at
+            stale = now - updated_at > self.surplus_stale_after
+            if stale != self.__surplus_stale:
+                self.__set_surplus_stale(stale)
+            # Repeated while stale for the devices that were in cooldown, but never
+            # while the previous shed is still waiting for its commands
+            if (
+                stale
+                and self.stale_policy == "shed"
+                and (self.__shed_task is None or self.__shed_task.done())
+            ):
+                self.__shed_task = asyncio.create_task(self.__shed())
+        state = self.state
+        for device in self.devices.values():
+            stale_after = state.stale_after[device.slot]
+            if stale_after:
+                updated_at = state.updated_at[device.slot] or self.__started_at
+                stale = now - updated_at > stale_after
+                if stale != state.stale[device.slot]:
+                    if stale:
+                        logger.warning("Consumption of %s is stale", device.name)
+                    device.stale = stale
+        if self.derived is not None:
+            self.derived.check_freshness(now, self.__started_at)
+
+    async def __watch_freshness(self):
+        """Indefinitely checks the freshness of the readings."""
+        while True:
+            await asyncio.sleep(self.freshness_interval)
+            self.check_freshness()
+
+    async def __dispatch(self, command: Awaitable):
+        """
+        Await a device command, accounting the time spent as dispatch time of the
+        current cycle.
+
+        Parameters:
+        command (Awaitable): The device command to await.
+        """
+        start = time.perf_counter()
+        try:
+            await command
+        finally:
+            self.__dispatch_time += time.perf_counter() - start
 
     def __debug(self):
         """
         Print debug information about the core and devices. Only
         prints if the logger is in debug
         """
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
         logger.debug("Core debug:")
         logger.debug("Surplus: %s", self.surplus)
         logger.debug("Devices:")
@@ -212,6 +621,137 @@ class Core:
             logger.debug("    Max consumption: %s", device.max_consumption)
             logger.debug("    Enabled: %s", device.enabled)
 
+    def record_reading(self, series: str, value: float):
+        """
+        Publish a reading accepted by the filters in the bus, to be recorded in the
+        history by `__record_history`.
+
+        Parameters:
+        series (str): The name of the series.
+        value (float): The value read.
+        """
+        if self.bus.subscribed(Sample):
+            self.bus.publish(Sample(series, value, time.time()))
+
+    def __record_sample(self, sample: Sample):
+        """
+        Record a sample in the in-memory history and in the history store if it is
+        configured.
+
+        Parameters:
+        sample (Sample): The sample.
+        """
+        self.history.record(sample.series, sample.value, sample.timestamp)
+        if self.store is not None:
+            self.store.record(sample.series, sample.value, sample.timestamp)
+
+    async def __record_history(self, samples: Subscription):
+        """
+        Indefinitely records the samples published in the bus in the history.
+
+        Parameters:
+        samples (Subscription): The subscription to the samples.
+        """
+        async for sample in samples:
+            self.__record_sample(sample)
+
+    def record_action(
+        self, device: str, command: str, value: float | None, success: bool
+    ):
+        """
+        Record a command sent to a device in the history store and in the journal if
+        they are configured, and publish it in the bus.
+
+        Parameters:
+        device (str): The name of the device.
+        command (str): The command sent (turn_on, turn_off or regulate).
+        value (float | None): The power of a regulate command.
+        success (bool): Whether the command succeeded.
+        """
+        if self.store is not None:
+            self.store.record_action(device, command, value, success)
+        if self.journal is not None:
+            self.journal.write(
+                COMMAND_KINDS[command],
+                self.devices[device].slot,
+                value or 0,
+                success,
+                self.cycle,
+            )
+        if self.bus.subscribed(CommandResult):
+            self.bus.publish(CommandResult(device, command, value, success))
+
+    def add_listener(self, listener: ChangeListener):
+        """
+        Register a callback that is called synchronously every time the state of
+        the core or of a device changes.
+
+        Parameters:
+        listener (ChangeListener): The callback to register.
+        """
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener: ChangeListener):
+        """
+        Unregister a callback previously registered with `add_listener`.
+
+        Parameters:
+        listener (ChangeListener): The callback to remove.
+        """
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def notify_change(self, kind: str, name: str | None, attribute: str, value: Any):
+        """
+        Notify the registered listeners and the bus about a state change.
+
+        Parameters:
+        kind (str): "core" or "device".
+        name (str | None): The device name or None for core changes.
+        attribute (str): The attribute that changed.
+        value (Any): The new value of the attribute.
+        """
+        self.__version += 1
+        if self.journal is not None and attribute in ATTRIBUTE_KINDS:
+            self.journal.write(
+                ATTRIBUTE_KINDS[attribute],
+                self.devices[name].slot if name is not None else NO_DEVICE,
+                value,
+                cycle=self.cycle,
+            )
+        if self.bus.subscribed(StateChange):
+            self.bus.publish(StateChange(kind, name, attribute, value))
+        for listener in self.listeners:
+            try:
+                listener(kind, name, attribute, value)
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error("Error notifying change listener: %s", e)
+
+    def notify_device_change(self, device: Device, attribute: str):
+        """
+        Notify the registered listeners that an attribute of a device changed.
+
+        Parameters:
+        device (Device): The device that changed.
+        attribute (str): The name of the attribute that changed.
+        """
+        self.notify_change("device", device.name, attribute, getattr(device, attribute))
+
+    def set_input(self, name: str, value: float):
+        """
+        Set the reading of an input of the derived entities. The entities that
+        depend on it, the surplus included, are recomputed once the readings that
+        arrive at the same time have been set.
+
+        Parameters:
+        name (str): The name of the input.
+        value (float): The reading.
+        """
+        if self.derived is None or not self.derived.is_input(name):
+            logger.error("Input %s not found", name)
+            return
+        self.derived.set_input(name, value)
+
     def add_control_integration(self, name: str, integration: ControlIntegration):
         """
         Add a control integration to a device in the core. When a new device is loaded
@@ -224,10 +764,40 @@ class Core:
         """
         if name in self.devices:
             self.devices[name].control_integration = integration
+            self.__version += 1
         logger.info("Added control integration to device %s to core", name)
 
+    def start(self):
+        """
+        Start the background tasks of the core: calibration, freshness, runtime
+        snapshot, shadow planners and the ingestion workers. Loads the runtime
+        snapshot first, the journal continues in a new segment from the restored
+        state.
+        """
+        if self.ingestion is not None:
+            self.ingestion.start()
+        if self.__samples is not None:
+            self.__tasks.append(
+                asyncio.create_task(self.__record_history(self.__samples))
+            )
+        if self.calibrator is not None:
+            self.__tasks.append(asyncio.create_task(self.calibrator.run()))
+        self.__started_at = time.monotonic()
+        if self.snapshot is not None:
+            if self.snapshot.load() and self.journal is not None:
+                # The header of the current segment has the state before the load
+                self.journal.rotate()
+            self.__tasks.append(asyncio.create_task(self.snapshot.run()))
+        if self.shadows is not None:
+            self.__tasks.append(asyncio.create_task(self.shadows.run()))
+        self.__tasks.append(asyncio.create_task(self.__watch_freshness()))
+
     async def run(self):
-        """Entry point for the core. This method will start the API."""
+        """
+        Entry point for the core. Starts the background tasks and the API, returns
+        once the API is listening.
+        """
+        self.start()
         api = Api(core=self)
         self.api = api
         await api.run()
@@ -240,6 +810,71 @@ class Core:
         self.__grid_margin = self.config.get("grid_margin", self.grid_margin)
         self.__surplus_margin = self.config.get("surplus_margin", self.surplus_margin)
 
+        history_config = self.config.get("history", None) or {}
+        self.history = History(
+            raw_samples=history_config.get("raw_samples", self.history.raw_samples),
+            rollups=history_config.get("rollups", self.history.rollups),
+        )
+        # Subscribed before the integrations are loaded so their first readings are
+        # recorded, the recorder starts with the core
+        if self.__samples is None:
+            self.__samples = self.bus.subscribe(
+                Sample,
+                maxsize=history_config.get("queue_size", 10000),
+                name="history",
+            )
+
+        store_config = self.config.get("storage", None)
+        if store_config:
+            self.store = HistoryStore(**store_config)
+            self.store.start()
+
+        self.stale_policy = self.config.get("stale_policy", self.stale_policy)
+        if self.stale_policy not in ("hold", "shed"):
+            raise ValueError("stale_policy must be hold or shed")
+
+        reconciliation_config = self.config.get("reconciliation", None) or {}
+        self.state_settle_time = reconciliation_config.get(
+            "settle_time", self.state_settle_time
+        )
+        self.infer_state = reconciliation_config.get("infer_state", self.infer_state)
+
+        surplus_config = self.config.get("surplus", None) or {}
+        for source, entity_config in surplus_config.items():
+            self.surplus_source = source
+            if not isinstance(entity_config, dict):
+                continue
+            self.__surplus_filter = FilterChain.from_config(
+                entity_config.get("filters")
+            )
+            self.surplus_stale_after = entity_config.get("stale_after", None)
+
+        inputs_config = self.config.get("inputs", None) or []
+        derived_config = self.config.get("derived", None) or {}
+        surplus_expression = None
+        if DERIVED_SOURCE in surplus_config:
+            surplus_expression = (surplus_config[DERIVED_SOURCE] or {}).get(
+                "expression", None
+            )
+            if surplus_expression is None:
+                raise ValueError("Derived surplus must have an expression")
+        if inputs_config or derived_config or surplus_expression is not None:
+            self.derived = DerivedEntities.from_config(
+                self,
+                [input_config["name"] for input_config in inputs_config],
+                derived_config,
+                surplus_expression,
+                {
+                    input_config["name"]: input_config.get(
+                        "stale_after",
+                        (input_config.get("consumption_integration") or {}).get(
+                            "stale_after", None
+                        ),
+                    )
+                    for input_config in inputs_config
+                },
+            )
+
         devices = self.config.get("devices", [])
 
         for device in devices:
@@ -248,6 +883,16 @@ class Core:
             expected_consumption = device["expected_consumption"]
             max_consumption = device.get("max_consumption", None)
             cooldown = device.get("cooldown", None)
+            consumption_config = device.get("consumption_integration", None) or {}
+            state_config = device.get("state_integration", None) or {}
+            if state_config and state_config.get("name") not in STATE_INTEGRATIONS:
+                raise ValueError(
+                    f"Device {name} state_integration must be one of "
+                    f"{', '.join(STATE_INTEGRATIONS)}"
+                )
+            controller = PIDController.from_config(device.get("controller", None))
+            if controller is not None and device_type != DeviceType.REGULATED:
+                raise ValueError(f"Device {name} has a controller but is not regulated")
             new_device = Device(
                 name=name,
                 core=self,
@@ -255,19 +900,200 @@ class Core:
                 expected_consumption=expected_consumption,
                 max_consumption=max_consumption,
                 cooldown=cooldown,
+                filters=FilterChain.from_config(consumption_config.get("filters")),
+                source=consumption_config.get("name", None),
+                stale_after=consumption_config.get("stale_after", None),
+                controller=controller,
             )
             self.devices[name] = new_device
             logger.info("Added device %s to core", name)
 
+        calibration_config = self.config.get("calibration", None)
+        if calibration_config:
+            self.calibrator = Calibrator(core=self, **calibration_config)
+
+        ingestion_config = self.config.get("ingestion", None)
+        if ingestion_config:
+            self.ingestion = IngestionSupervisor(core=self, **ingestion_config)
+
+        journal_config = self.config.get("journal", None)
+        if journal_config:
+            self.journal = Journal(core=self, **journal_config)
+            self.journal.open()
+
+        debug_config = self.config.get("debug", None) or {}
+        if "tracing" in debug_config or "max_spans" in debug_config:
+            tracer.configure(
+                debug_config.get("tracing", tracer.enabled),
+                debug_config.get("max_spans", None),
+            )
+
+        snapshot_config = self.config.get("snapshot", None)
+        if snapshot_config:
+            self.snapshot = RuntimeSnapshot(core=self, **snapshot_config)
+
+        shadows_config = self.config.get("shadows", None)
+        if shadows_config:
+            self.shadows = ShadowPlanners.from_config(self, shadows_config)
+
+    def close(self):
+        """
+        Safely close the core, writing the runtime snapshot and the pending history
+        to the store and flushing the journal.
+        """
+        for task in self.__tasks:
+            task.cancel()
+        self.__tasks.clear()
+        if self.__samples is not None:
+            self.__samples.close()
+            # The samples the recorder had not received yet
+            while len(self.__samples):
+                self.__record_sample(self.__samples.get_nowait())
+        if self.snapshot is not None and self.snapshot.started:
+            try:
+                self.snapshot.write()
+            except OSError as e:
+                logger.error("Could not write the runtime snapshot: %s", e)
+        if self.ingestion is not None:
+            self.ingestion.close()
+        if self.store is not None:
+            self.store.close()
+        if self.journal is not None:
+            self.journal.close()
+
     def save_config(self):
-        """Creates a task to save the configuration to the config file."""
+        """
+        Creates a task to save the configuration to the config file. Inside a
+        `deferred_save` block the save is postponed until the block ends.
+        """
+        if self.__deferred_saves:
+            self.__save_pending = True
+            return
         logger.info("Saving config...")
         asyncio.create_task(self.__save_config_task())
 
+    @contextmanager
+    def deferred_save(self):
+        """
+        Context manager that groups all the config saves requested inside it into a
+        single write when it exits.
+        """
+        self.__deferred_saves += 1
+        try:
+            yield
+        finally:
+            self.__deferred_saves -= 1
+            if not self.__deferred_saves and self.__save_pending:
+                self.__save_pending = False
+                self.save_config()
+
+    @contextmanager
+    def deferred_update(self):
+        """
+        Context manager that groups the device updates requested by the surplus
+        readings set inside it into a single update when it exits.
+        """
+        self.__deferred_updates += 1
+        try:
+            yield
+        finally:
+            self.__deferred_updates -= 1
+            if not self.__deferred_updates and self.__update_pending:
+                self.__update_pending = False
+                asyncio.create_task(self.__update())
+
+    def validate_changes(
+        self,
+        core_changes: Dict[str, Any] | None = None,
+        device_changes: Dict[str, Dict[str, Any]] | None = None,
+    ):
+        """
+        Validate a batch of setting changes without applying them.
+
+        Parameters:
+        core_changes (Dict[str, Any]): New values for the core settings.
+        device_changes (Dict[str, Dict[str, Any]]): New values for the settings of
+        each device, by device name.
+
+        Raises:
+        InvalidConfigurationChange: With every error found in the batch.
+        """
+        errors = []
+
+        def check(prefix: str, settings: Dict[str, bool], changes: Any):
+            if not isinstance(changes, dict):
+                errors.append(f"{prefix}: expected an object")
+                return
+            for key, value in changes.items():
+                if key not in settings:
+                    errors.append(f"{prefix}: unknown setting '{key}'")
+                elif value is None:
+                    if not settings[key]:
+                        errors.append(f"{prefix}: '{key}' can not be null")
+                elif isinstance(value, bool) or not isinstance(value, (int, float)):
+                    errors.append(f"{prefix}: '{key}' must be a number")
+                elif key != "surplus_margin" and value < 0:
+                    errors.append(f"{prefix}: '{key}' can not be negative")
+
+        if core_changes is not None:
+            check("core", CORE_SETTINGS, core_changes)
+        for name, changes in (device_changes or {}).items():
+            if name not in self.devices:
+                errors.append(f"{name}: device not found")
+            else:
+                check(name, DEVICE_SETTINGS, changes)
+        if errors:
+            raise InvalidConfigurationChange(errors)
+
+    async def apply_changes(
+        self,
+        core_changes: Dict[str, Any] | None = None,
+        device_changes: Dict[str, Dict[str, Any]] | None = None,
+    ) -> Dict[str, Any]:
+        """
+        Validate and apply a batch of setting changes. The changes are applied while
+        the devices are not being updated and the config is written once.
+
+        Parameters:
+        core_changes (Dict[str, Any]): New values for the core settings.
+        device_changes (Dict[str, Dict[str, Any]]): New values for the settings of
+        each device, by device name.
+
+        Returns:
+        Dict[str, Any]: The settings that changed with their old and new values,
+        under "core" and "devices".
+
+        Raises:
+        InvalidConfigurationChange: If any of the changes is not valid. Nothing is
+        applied in that case.
+        """
+        self.validate_changes(core_changes, device_changes)
+        changed = {"core": {}, "devices": {}}
+        async with self.__update_lock:
+            with self.deferred_save():
+                for key, value in (core_changes or {}).items():
+                    old = getattr(self, key)
+                    if old != value:
+                        setattr(self, key, value)
+                        changed["core"][key] = {"old": old, "new": value}
+                for name, changes in (device_changes or {}).items():
+                    device = self.devices[name]
+                    for key, value in changes.items():
+                        old = getattr(device, key)
+                        if old != value:
+                            setattr(device, key, value)
+                            changed["devices"].setdefault(name, {})[key] = {
+                                "old": old,
+                                "new": value,
+                            }
+        return changed
+
     async def __save_config_task(self):
         """Saves the configuration to the config file."""
-        with open(config_file_name, "w", encoding="utf-8") as file:
-            yaml.dump(self.config, file, default_flow_style=False)
+        CONFIG_SAVE_COUNT.inc()
+        with tracer.span("save_config", "config", self.name):
+            with open(self.config_file, "w", encoding="utf-8") as file:
+                yaml.dump(self.config, file, default_flow_style=False)
 
     def get_device(self, name: str) -> Device | None:
         """
@@ -0,0 +1,408 @@
+"""
+Derived entities, computed with expressions from the readings of other entities.
+
+Sites that measure the production and the house consumption separately, or that
+have a meter per phase, declare those meters as inputs read by any consumption
+integration (or pushed to /api/ingest) and derive the surplus from them:
+
+    inputs:
+      - name: production
+        consumption_integration: {name: modbus_tcp, host: 192.168.1.10, ...}
+      - name: phase_1
+        consumption_integration: {name: mqtt_sub, topic: meter/phase_1}
+      ...
+    derived:
+      consumption: sum(phase_*)
+    surplus:
+      derived:
+        expression: production - consumption
+
+An expression uses numbers, the names of the inputs and of other derived entities,
++ - * / and parentheses, and the functions sum, min, max, avg and abs. Inside a
+function a name ending in * is every input and derived entity with that prefix,
+except the entity being defined.
+
+The expressions are compiled once when the config is loaded into a graph in
+topological order. When an input is read only the entities that depend on it are
+recomputed, and the readings that arrive in the same iteration of the event loop
+(e.g. the three phases of a Modbus read or a batch of ingestion slots) are
+coalesced into a single recomputation and a single surplus reading. An entity has
+no value until all its inputs have been read.
+
+An input with `stale_after` is stale when it has not been read for that many
+seconds. Its value is dropped until it is read again, so the entities that depend on
+it have no value either and a derived surplus is not set from the other inputs. The
+core then sees no surplus reading and applies its stale policy once the
+`stale_after` of the surplus has passed.
+"""
+
+from __future__ import annotations
+
+import ast
+import asyncio
+import fnmatch
+import heapq
+import re
+import time
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Set, Tuple
+
+from opensurplusmanager.utils import logger
+
+if TYPE_CHECKING:
+    from opensurplusmanager.core import Core
+
+# Surplus source of a derived surplus
+DERIVED_SOURCE = "derived"
+FUNCTIONS: Dict[str, Callable] = {
+    "sum": sum,
+    "min": min,
+    "max": max,
+    "avg": lambda values: sum(values) / len(values),
+    "abs": abs,
+}
+# Functions that take a single value, the others aggregate all their arguments
+SINGLE_FUNCTIONS = ("abs",)
+# A name ending in * used as function argument
+PATTERN = re.compile(r"\b([A-Za-z_]\w*\*)(?=\s*[,)])")
+OPERATORS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.USub, ast.UAdd)
+
+
+def compile_expression(
+    expression: str, names: Dict[str, int], entity: str | None = None
+) -> Tuple[Any, Set[int]]:
+    """
+    Compile an expression to evaluate it on the values of the graph.
+
+    Parameters:
+    expression (str): The expression, e.g. "production - sum(phase_*)".
+    names (Dict[str, int]): Index of the value of every entity it can use.
+    entity (str | None): The entity the expression defines, never matched by a
+    name ending in *.
+
+    Returns:
+    Tuple[Any, Set[int]]: The code, evaluated with the values in `v`, and the
+    indexes of the entities it uses.
+
+    Raises:
+    ValueError: If the expression is not valid or uses an unknown entity.
+    """
+    # Patterns are not valid Python, they are parsed as strings
+    source = PATTERN.sub(lambda match: repr(match.group(1)), expression)
+    try:
+        tree = ast.parse(source.strip(), mode="eval")
+    except SyntaxError as e:
+        raise ValueError(f"Invalid expression '{expression}'") from e
+    used: Set[int] = set()
+
+    def value(name: str) -> ast.expr:
+        if name not in names:
+            raise ValueError(f"Unknown entity '{name}' in '{expression}'")
+        used.add(names[name])
+        return ast.Subscript(
+            value=ast.Name(id="v", ctx=ast.Load()),
+            slice=ast.Constant(value=names[name]),
+            ctx=ast.Load(),
+        )
+
+    def convert(node: ast.expr) -> ast.expr:
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            return node
+        if isinstance(node, ast.Name):
+            return value(node.id)
+        if isinstance(node, ast.BinOp) and isinstance(node.op, OPERATORS):
+            return ast.BinOp(
+                left=convert(node.left), op=node.op, right=convert(node.right)
+            )
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, OPERATORS):
+            return ast.UnaryOp(op=node.op, operand=convert(node.operand))
+        if (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Name)
+            and node.func.id in FUNCTIONS
+            and not node.keywords
+        ):
+            arguments = []
+            for argument in node.args:
+                if isinstance(argument, ast.Constant) and isinstance(
+                    argument.value, str
+                ):
+                    matches = [
+                        name
+                        for name in fnmatch.filter(names, argument.value)
+                        if name.isidentifier() and name != entity
+                    ]
+                    if not matches:
+                        raise ValueError(
+                            f"No entity matches '{argument.value}' in '{expression}'"
+                        )
+                    arguments.extend(value(name) for name in sorted(matches))
+                else:
+                    arguments.append(convert(argument))
+            function = ast.Name(id=node.func.id, ctx=ast.Load())
+            if node.func.id in SINGLE_FUNCTIONS:
+                if len(arguments) != 1:
+                    raise ValueError(
+                        f"{node.func.id} takes one value in '{expression}'"
+                    )
+                return ast.Call(func=function, args=arguments, keywords=[])
+            if not arguments:
+                raise ValueError(f"{node.func.id} without values in '{expression}'")
+            values = ast.Tuple(elts=arguments, ctx=ast.Load())
+            return ast.Call(func=function, args=[values], keywords=[])
+        raise ValueError(f"Unsupported syntax in '{expression}'")
+
+    body = ast.fix_missing_locations(ast.Expression(body=convert(tree.body)))
+    return compile(body, f"<{expression}>", "eval"), used
+
+
+@dataclass
+class DerivedEntities:
+    """
+    The inputs and derived entities of a core, and the expression of the surplus
+    if it is derived.
+    """
+
+    core: Core
+    # Names of the inputs followed by the derived entities in topological order
+    names: List[str] = field(default_factory=list)
+    # Index of every name
+    index: Dict[str, int] = field(default_factory=dict)
+    # Last value of every entity, None until it has one
+    values: List[float | None] = field(default_factory=list)
+    # Code of every entity, None for the inputs
+    codes: List[Any] = field(default_factory=list)
+    # Derived entities that use each entity
+    dependents: List[List[int]] = field(default_factory=list)
+    # Index of the derived surplus, None if the surplus is read directly
+    surplus: int | None = None
+    # Seconds after which every input is stale, 0 to never be stale, and 0 for the
+    # derived entities
+    stale_after: List[float] = field(default_factory=list)
+    # time.monotonic() of the last reading of every input, 0 if there is none
+    updated_at: List[float] = field(default_factory=list)
+    # Whether every input is stale
+    stale: List[bool] = field(default_factory=list)
+    __dirty: List[int] = field(init=False, default_factory=list)
+    __pending: Set[int] = field(init=False, default_factory=set)
+    __scheduled: bool = field(init=False, default=False)
+    __globals: Dict[str, Any] = field(init=False)
+
+    def __post_init__(self):
+        self.__globals = {"__builtins__": {}, **FUNCTIONS}
+
+    @classmethod
+    def from_config(
+        cls,
+        core: Core,
+        inputs: List[str],
+        expressions: Dict[str, str],
+        surplus: str | None = None,
+        stale_after: Dict[str, float] | None = None,
+    ) -> DerivedEntities:
+        """
+        Compile the derived entities.
+
+        Parameters:
+        core (Core): The core.
+        inputs (List[str]): The names of the inputs.
+        expressions (Dict[str, str]): The expression of every derived entity.
+        surplus (str | None): The expression of the surplus, None if it is read
+        directly.
+        stale_after (Dict[str, float] | None): Seconds after which an input is
+        stale, by input name. The inputs that are not in it are never stale.
+
+        Returns:
+        DerivedEntities: The compiled entities.
+
+        Raises:
+        ValueError: If a name is not valid or repeated, an expression is not valid
+        or the entities depend on each other in a cycle.
+        """
+        expressions = dict(expressions)
+        if surplus is not None:
+            # Internal name, not a valid identifier so it can not be referenced
+            expressions["surplus()"] = surplus
+        names = [*inputs, *expressions]
+        for name in names:
+            if name != "surplus()" and (
+                not name.isidentifier() or name in FUNCTIONS or name == "v"
+            ):
+                raise ValueError(f"Invalid input or derived entity name '{name}'")
+        if len(set(names)) != len(names):
+            raise ValueError("Input and derived entity names must be unique")
+
+        # Compiled with provisional indexes to find the dependencies
+        provisional = {name: index for index, name in enumerate(names)}
+        dependencies: Dict[str, Set[str]] = {}
+        for name, expression in expressions.items():
+            _, used = compile_expression(str(expression), provisional, name)
+            dependencies[name] = {names[index] for index in used}
+        order = list(inputs)
+        remaining = dict(dependencies)
+        while remaining:
+            ready = [
+                name
+                for name, used in remaining.items()
+                if all(dependency in order for dependency in used)
+            ]
+            if not ready:
+                raise ValueError(
+                    "Derived entities depend on each other: "
+                    + ", ".join(sorted(remaining))
+                )
+            for name in ready:
+                order.append(name)
+                del remaining[name]
+
+        entities = cls(core=core)
+        entities.names = order
+        entities.index = {name: index for index, name in enumerate(order)}
+        entities.values = [None] * len(order)
+        entities.codes = [None] * len(order)
+        entities.dependents = [[] for _ in order]
+        entities.stale_after = [
+            (stale_after or {}).get(name, None) or 0 for name in order
+        ]
+        entities.updated_at = [0.0] * len(order)
+        entities.stale = [False] * len(order)
+        for name, expression in expressions.items():
+            code, used = compile_expression(str(expression), entities.index, name)
+            node = entities.index[name]
+            entities.codes[node] = code
+            for dependency in used:
+                entities.dependents[dependency].append(node)
+        if surplus is not None:
+            entities.surplus = entities.index["surplus()"]
+        logger.info(
+            "Compiled %s derived entities from %s inputs", len(expressions), len(inputs)
+        )
+        return entities
+
+    def is_input(self, name: str) -> bool:
+        """Whether an entity is an input."""
+        node = self.index.get(name)
+        return node is not None and self.codes[node] is None
+
+    def set_input(self, name: str, value: float):
+        """
+        Set the reading of an input and schedule the recomputation of the entities
+        that depend on it.
+
+        Parameters:
+        name (str): The name of the input.
+        value (float): The reading.
+
+        Raises:
+        KeyError: If the input does not exist.
+        """
+        node = self.index[name]
+        self.values[node] = value
+        self.updated_at[node] = time.monotonic()
+        if self.stale[node]:
+            self.stale[node] = False
+            logger.info("Input %s is no longer stale", name)
+        self.__invalidate(node)
+
+    def check_freshness(self, now: float, started_at: float):
+        """
+        Update the stale state of the inputs from the time of their last reading.
+        The value of an input that becomes stale is dropped and the entities that
+        depend on it are recomputed without a value.
+
+        Parameters:
+        now (float): The current time.monotonic().
+        started_at (float): time.monotonic() when the core started running, the
+        inputs that were never read are stale counting from it.
+        """
+        for node, stale_after in enumerate(self.stale_after):
+            if not stale_after or self.stale[node]:
+                continue
+            if now - (self.updated_at[node] or started_at) > stale_after:
+                self.stale[node] = True
+                logger.warning("Input %s is stale", self.names[node])
+                self.values[node] = None
+                self.__invalidate(node)
+
+    def __invalidate(self, node: int):
+        """
+        Schedule the recomputation of the entities that depend on an entity.
+
+        Parameters:
+        node (int): The index of the entity.
+        """
+        for dependent in self.dependents[node]:
+            if dependent not in self.__pending:
+                self.__pending.add(dependent)
+                heapq.heappush(self.__dirty, dependent)
+        if self.__scheduled or not self.__dirty:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.recompute()
+            return
+        self.__scheduled = True
+        loop.call_soon(self.recompute)
+
+    def recompute(self):
+        """
+        Recompute the pending entities in topological order and set the surplus if
+        it was recomputed with a value. An entity that loses its value, because an
+        input is stale or could not be computed, passes it on to its dependents.
+        """
+        self.__scheduled = False
+        dirty = self.__dirty
+        pending = self.__pending
+        values = self.values
+        namespace = {"v": values}
+        surplus_updated = False
+        while dirty:
+            node = heapq.heappop(dirty)
+            pending.discard(node)
+            try:
+                value = float(
+                    eval(  # pylint: disable=eval-used
+                        self.codes[node], self.__globals, namespace
+                    )
+                )
+            except TypeError:
+                # An input has no value yet or is stale
+                value = None
+            except ArithmeticError as e:
+                logger.error("Could not compute %s: %s", self.names[node], e)
+                value = None
+            if value is None and values[node] is None:
+                continue
+            values[node] = value
+            if node == self.surplus and value is not None:
+                surplus_updated = True
+            for dependent in self.dependents[node]:
+                if dependent not in pending:
+                    pending.add(dependent)
+                    heapq.heappush(dirty, dependent)
+        if surplus_updated:
+            self.core.surplus = values[self.surplus]
+
+    def state(self) -> Dict[str, Any]:
+        """
+        Get the values of the inputs and derived entities.
+
+        Returns:
+        Dict[str, Any]: The values by name under "inputs" and "derived", the
+        derived surplus under "surplus" and the names of the stale inputs under
+        "stale".
+        """
+        inputs = {}
+        derived = {}
+        for node, name in enumerate(self.names):
+            if node == self.surplus:
+                continue
+            target = inputs if self.codes[node] is None else derived
+            target[name] = self.values[node]
+        return {
+            "inputs": inputs,
+            "derived": derived,
+            "surplus": None if self.surplus is None else self.values[self.surplus],
+            "stale": [name for node, name in enumerate(self.names) if self.stale[node]],
+        }
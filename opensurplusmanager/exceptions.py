@@ -11,3 +11,15 @@ class InvalidDeviceType(Exception):
 
 class IntegrationConnectionError(Exception):
     """Raised when an error occurs when managin a device connection."""
+
+
+class InvalidConfigurationChange(Exception):
+    """Raised when a requested configuration change is not valid."""
+
+    def __init__(self, errors: list):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+
+
+class SubscriptionClosed(Exception):
+    """Raised when waiting for an event of a closed bus subscription."""
@@ -0,0 +1,220 @@
+"""
+Signal conditioning for the consumption and surplus readings.
+
+Every filter keeps a fixed amount of state allocated when it is created, so
+processing a sample never allocates. It costs O(1), except for the rolling median
+that moves up to `window` elements of its sorted array, the windows are small.
+"""
+
+from __future__ import annotations
+
+import math
+from abc import ABC, abstractmethod
+from array import array
+from bisect import bisect_left
+from typing import Dict, List
+
+
+class Filter(ABC):
+    """Base class of the filters."""
+
+    __slots__ = ()
+
+    @abstractmethod
+    def update(self, value: float) -> float | None:
+        """
+        Process a sample.
+
+        Parameters:
+            value (float): The sample.
+
+        Returns:
+            float | None: The filtered value or None if the sample is rejected.
+        """
+
+
+class Ewma(Filter):
+    """Exponentially weighted moving average."""
+
+    __slots__ = ("alpha", "value")
+
+    def __init__(self, alpha: float = 0.5):
+        if not 0 < alpha <= 1:
+            raise ValueError("alpha must be in (0, 1]")
+        self.alpha = alpha
+        self.value = None
+
+    def update(self, value: float) -> float:
+        if self.value is None:
+            self.value = value
+        else:
+            self.value += self.alpha * (value - self.value)
+        return self.value
+
+
+class RollingMedian(Filter):
+    """Median of the last `window` samples."""
+
+    __slots__ = ("window", "samples", "ordered", "head", "size")
+
+    def __init__(self, window: int = 5):
+        if window < 1:
+            raise ValueError("window must be at least 1")
+        self.window = window
+        # Samples in arrival order, a ring buffer
+        self.samples = array("d", bytes(8 * window))
+        # The same samples kept sorted in the first `size` elements
+        self.ordered = array("d", bytes(8 * window))
+        self.head = 0
+        self.size = 0
+
+    def update(self, value: float) -> float:
+        ordered = self.ordered
+        if self.size == self.window:
+            # The new sample takes the place of the oldest one
+            index = bisect_left(ordered, self.samples[self.head], 0, self.size)
+        else:
+            index = self.size
+            self.size += 1
+        self.samples[self.head] = value
+        self.head = (self.head + 1) % self.window
+        # Shift the neighbours in place until the new sample is in order
+        while index > 0 and ordered[index - 1] > value:
+            ordered[index] = ordered[index - 1]
+            index -= 1
+        while index < self.size - 1 and ordered[index + 1] < value:
+            ordered[index] = ordered[index + 1]
+            index += 1
+        ordered[index] = value
+        middle = self.size // 2
+        if self.size % 2:
+            return ordered[middle]
+        return (ordered[middle - 1] + ordered[middle]) / 2
+
+
+class OutlierRejector(Filter):
+    """
+    Rejects the samples further than `threshold` standard deviations from the mean
+    of the last `window` accepted samples. After `max_rejections` consecutive
+    rejections the sample is accepted, so a real change of level is followed.
+    """
+
+    __slots__ = (
+        "threshold",
+        "window",
+        "min_deviation",
+        "max_rejections",
+        "samples",
+        "head",
+        "size",
+        "sum",
+        "sum_squares",
+        "rejections",
+    )
+
+    def __init__(
+        self,
+        threshold: float = 4,
+        window: int = 20,
+        min_deviation: float = 10,
+        max_rejections: int = 3,
+    ):
+        if window < 2:
+            raise ValueError("window must be at least 2")
+        self.threshold = threshold
+        self.window = window
+        # Deviations below this are never rejected, avoids rejecting everything
+        # when the signal is flat
+        self.min_deviation = min_deviation
+        self.max_rejections = max_rejections
+        self.samples = array("d", bytes(8 * window))
+        self.head = 0
+        self.size = 0
+        self.sum = 0.0
+        self.sum_squares = 0.0
+        self.rejections = 0
+
+    def update(self, value: float) -> float | None:
+        if self.size >= 2 and self.rejections < self.max_rejections:
+            mean = self.sum / self.size
+            variance = max(self.sum_squares / self.size - mean * mean, 0.0)
+            deviation = abs(value - mean)
+            if (
+                deviation > self.min_deviation
+                and deviation > self.threshold * math.sqrt(variance)
+            ):
+                self.rejections += 1
+                return None
+        self.rejections = 0
+        if self.size == self.window:
+            oldest = self.samples[self.head]
+            self.sum -= oldest
+            self.sum_squares -= oldest * oldest
+        else:
+            self.size += 1
+        self.samples[self.head] = value
+        self.head = (self.head + 1) % self.window
+        self.sum += value
+        self.sum_squares += value * value
+        return value
+
+
+FILTERS: Dict[str, type] = {
+    "ewma": Ewma,
+    "median": RollingMedian,
+    "outlier": OutlierRejector,
+}
+
+
+class FilterChain:
+    """Filters applied in order. A rejected sample stops the chain."""
+
+    __slots__ = ("filters",)
+
+    def __init__(self, filters: List[Filter]):
+        self.filters = filters
+
+    def update(self, value: float) -> float | None:
+        """
+        Process a sample through all the filters.
+
+        Parameters:
+            value (float): The raw sample.
+
+        Returns:
+            float | None: The filtered value or None if the sample is rejected.
+        """
+        for sample_filter in self.filters:
+            value = sample_filter.update(value)
+            if value is None:
+                return None
+        return value
+
+    @classmethod
+    def from_config(cls, config: List[Dict] | None) -> FilterChain | None:
+        """
+        Build a chain from the `filters` list of an entity config, for example
+        [{"type": "outlier", "threshold": 4}, {"type": "ewma", "alpha": 0.3}].
+
+        Parameters:
+            config (List[Dict] | None): The filters config.
+
+        Returns:
+            FilterChain | None: The chain or None if there are no filters.
+
+        Raises:
+            ValueError: If a filter type or parameter is not valid.
+        """
+        if not config:
+            return None
+        filters = []
+        for filter_config in config:
+            parameters = dict(filter_config)
+            filter_type = parameters.pop("type", None)
+            if filter_type not in FILTERS:
+                raise ValueError(f"Unknown filter type {filter_type}")
+            try:
+                filters.append(FILTERS[filter_type](**parameters))
+            except TypeError as e:
+                raise ValueError(f"Invalid parameters for {filter_type}: {e}") from e
+        return cls(filters)
@@ -0,0 +1,215 @@
+"""
+In-memory history of the surplus and the consumption of the devices.
+
+Every series keeps the raw samples and rollups at several resolutions in
+preallocated `array('d')` ring buffers, so the memory used by a series is fixed
+when it is created and no object is allocated per sample.
+"""
+
+from __future__ import annotations
+
+import math
+import time
+from array import array
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+# Rollup resolution -> seconds of history kept, both in seconds
+ROLLUPS = {10: 3600, 60: 86400, 900: 7 * 86400}
+
+
+class RingBuffer:
+    """Fixed size ring buffer of rows of floats stored in parallel arrays."""
+
+    __slots__ = ("capacity", "columns", "head", "size")
+
+    def __init__(self, capacity: int, columns: int):
+        self.capacity = capacity
+        self.columns = [array("d", bytes(8 * capacity)) for _ in range(columns)]
+        # Index where the next row is written
+        self.head = 0
+        self.size = 0
+
+    def append(self, *row: float):
+        """Write a row, overwriting the oldest one if the buffer is full."""
+        head = self.head
+        for column, value in zip(self.columns, row):
+            column[head] = value
+        self.head = (head + 1) % self.capacity
+        if self.size < self.capacity:
+            self.size += 1
+
+    def rows(self, since: float = -math.inf, until: float = math.inf) -> List[Tuple]:
+        """
+        Get the rows whose first column (the timestamp) is in [since, until], in
+        chronological order.
+
+        Parameters:
+            since (float): The first timestamp to include.
+            until (float): The last timestamp to include.
+
+        Returns:
+            List[Tuple]: The rows.
+        """
+        start = (self.head - self.size) % self.capacity
+        times = self.columns[0]
+        # Binary search of the first row at or after `since`
+        first, last = 0, self.size
+        while first < last:
+            middle = (first + last) // 2
+            if times[(start + middle) % self.capacity] < since:
+                first = middle + 1
+            else:
+                last = middle
+        result = []
+        for i in range(first, self.size):
+            index = (start + i) % self.capacity
+            if times[index] > until:
+                break
+            result.append(tuple(column[index] for column in self.columns))
+        return result
+
+
+class Rollup:
+    """
+    Aggregates the samples of a series in fixed time buckets with their minimum,
+    maximum and mean. The current bucket is kept in scalars and written to the ring
+    buffer when a sample of a later bucket arrives.
+    """
+
+    __slots__ = ("step", "buffer", "start", "min", "max", "sum", "count")
+
+    def __init__(self, step: int, capacity: int):
+        self.step = step
+        # Columns: bucket start, min, max, mean
+        self.buffer = RingBuffer(capacity, 4)
+        self.start = -math.inf
+        self.min = math.inf
+        self.max = -math.inf
+        self.sum = 0.0
+        self.count = 0
+
+    def add(self, timestamp: float, value: float):
+        """Add a sample to the rollup."""
+        start = timestamp - timestamp % self.step
+        if start != self.start:
+            self.flush()
+            self.start = start
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        self.sum += value
+        self.count += 1
+
+    def flush(self):
+        """Write the current bucket to the ring buffer."""
+        if self.count:
+            self.buffer.append(self.start, self.min, self.max, self.sum / self.count)
+        self.min = math.inf
+        self.max = -math.inf
+        self.sum = 0.0
+        self.count = 0
+
+    def rows(self, since: float, until: float) -> List[Tuple]:
+        """Get the closed buckets and the current one in [since, until]."""
+        rows = self.buffer.rows(since, until)
+        if self.count and since <= self.start <= until:
+            rows.append((self.start, self.min, self.max, self.sum / self.count))
+        return rows
+
+
+class Series:
+    """The raw samples and the rollups of a single series."""
+
+    __slots__ = ("raw", "rollups")
+
+    def __init__(self, raw_samples: int, rollups: Dict[int, int]):
+        self.raw = RingBuffer(raw_samples, 2)
+        self.rollups = {
+            step: Rollup(step, math.ceil(retention / step))
+            for step, retention in sorted(rollups.items())
+        }
+
+    def add(self, timestamp: float, value: float):
+        """Record a sample."""
+        self.raw.append(timestamp, value)
+        for rollup in self.rollups.values():
+            rollup.add(timestamp, value)
+
+
+@dataclass
+class History:
+    """
+    History of all the series recorded by the core. The series are created the
+    first time they are recorded.
+    """
+
+    raw_samples: int = 2048
+    rollups: Dict[int, int] = field(default_factory=lambda: dict(ROLLUPS))
+    series: Dict[str, Series] = field(default_factory=dict)
+
+    def record(self, name: str, value: float, timestamp: float | None = None):
+        """
+        Record a sample of a series.
+
+        Parameters:
+            name (str): The name of the series.
+            value (float): The value of the sample.
+            timestamp (float | None): Unix time of the sample, now if None.
+        """
+        series = self.series.get(name)
+        if series is None:
+            series = Series(self.raw_samples, self.rollups)
+            self.series[name] = series
+        series.add(time.time() if timestamp is None else timestamp, value)
+
+    def query(
+        self,
+        name: str,
+        since: float = -math.inf,
+        until: float = math.inf,
+        step: int | None = None,
+    ) -> Tuple[int, List[Tuple]] | None:
+        """
+        Get the samples of a series in a time range.
+
+        Parameters:
+            name (str): The name of the series.
+            since (float): Unix time of the start of the range.
+            until (float): Unix time of the end of the range.
+            step (int | None): 0 for the raw samples or one of the rollup steps.
+            If None, the finest resolution that still covers `since` is used.
+
+        Returns:
+            Tuple[int, List[Tuple]] | None: The step used and the rows, (timestamp,
+            value) for raw samples and (timestamp, min, max, mean) for rollups. None
+            if the series does not exist.
+
+        Raises:
+            ValueError: If the step is not valid.
+        """
+        series = self.series.get(name)
+        if series is None:
+            return None
+        if step is None:
+            step = self.__resolution(series, since)
+        if step == 0:
+            return 0, series.raw.rows(since, until)
+        if step not in series.rollups:
+            raise ValueError(f"Step must be 0 or one of {list(series.rollups)}")
+        return step, series.rollups[step].rows(since, until)
+
+    @staticmethod
+    def __resolution(series: Series, since: float) -> int:
+        """Finest resolution whose oldest sample is older than `since`."""
+        raw = series.raw
+        if raw.size < raw.capacity:
+            return 0
+        if raw.columns[0][raw.head] <= since:
+            return 0
+        for step, rollup in series.rollups.items():
+            buffer = rollup.buffer
+            if buffer.size < buffer.capacity or buffer.columns[0][buffer.head] <= since:
+                return step
+        return max(series.rollups, default=0)
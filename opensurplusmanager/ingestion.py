@@ -0,0 +1,460 @@
+"""
+Consumption integrations running in worker processes.
+
+The workers run the unchanged `http_get`, `mqtt_sub` and `modbus_tcp` integrations
+against a stand-in core that writes every reading into a shared memory block
+instead of updating the devices. The block has a slot per entity with a sequence
+counter and the last value. After writing, a worker wakes the event loop of the core
+through a pipe, only if it is not already woken, and the core reads the changed
+slots straight from the shared memory and applies them as normal readings.
+
+The workers are restarted if they die, the control loop keeps running with the
+last values meanwhile and the freshness checks mark them as stale.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import copy
+import multiprocessing
+import os
+import time
+from dataclasses import dataclass, field
+from multiprocessing.connection import Connection
+from multiprocessing.shared_memory import SharedMemory
+from typing import TYPE_CHECKING, Any, Dict, List, Tuple
+
+from opensurplusmanager.models.entity import ConsumptionType
+from opensurplusmanager.utils import forward_logs, logger, receive_logs
+
+if TYPE_CHECKING:
+    from opensurplusmanager.core import Core
+
+# Consumption integrations that can run in a worker process
+WORKER_INTEGRATIONS = ("http_get", "mqtt_sub", "modbus_tcp")
+# Slot of the surplus, the devices use the next ones
+SURPLUS_SLOT = 0
+# Seconds between checks of the worker processes
+SUPERVISE_INTERVAL = 1
+# Maximum seconds between restarts of a worker that keeps dying
+MAX_RESTART_DELAY = 60
+
+
+class SlotTable:
+    """
+    View of the shared memory block. The layout is a dirty flag followed by a
+    column of sequence counters and a column of values, one row per slot. Each
+    slot has a single writer that makes the counter odd while it writes the value
+    (a seqlock), so readers never use a half written value.
+    """
+
+    def __init__(self, buffer: memoryview, size: int):
+        self.size = size
+        self.dirty = buffer[:8].cast("Q")
+        self.sequences = buffer[8 : 8 + 8 * size].cast("Q")
+        self.values = buffer[8 + 8 * size : 8 + 16 * size].cast("d")
+
+    @staticmethod
+    def bytes_needed(size: int) -> int:
+        """Size of the shared memory block for `size` slots."""
+        return 8 + 16 * size
+
+    def write(self, slot: int, value: float) -> bool:
+        """
+        Write the value of a slot and mark the table dirty.
+
+        Parameters:
+            slot (int): The slot.
+            value (float): The value.
+
+        Returns:
+            bool: Whether the reader has to be woken, False if it already was.
+        """
+        sequence = self.sequences[slot]
+        self.sequences[slot] = sequence + 1
+        self.values[slot] = value
+        self.sequences[slot] = sequence + 2
+        if self.dirty[0]:
+            return False
+        self.dirty[0] = 1
+        return True
+
+    def release(self):
+        """Release the views so the shared memory can be closed."""
+        self.dirty.release()
+        self.sequences.release()
+        self.values.release()
+
+
+class _WorkerDevice:
+    """Device of the stand-in core, writes its consumption and state in its slots."""
+
+    __slots__ = ("name", "slot", "state_slot", "writer")
+
+    def __init__(
+        self, name: str, slot: int | None, state_slot: int | None, writer: _WorkerCore
+    ):
+        self.name = name
+        self.slot = slot
+        self.state_slot = state_slot
+        self.writer = writer
+
+    @property
+    def consumption(self) -> float:
+        """The last consumption written."""
+        return self.writer.table.values[self.slot]
+
+    @consumption.setter
+    def consumption(self, value: float):
+        self.writer.write(self.slot, value)
+
+    @property
+    def reported_powered(self) -> bool:
+        """The last state written."""
+        return bool(self.writer.table.values[self.state_slot])
+
+    @reported_powered.setter
+    def reported_powered(self, value: bool):
+        self.writer.write(self.state_slot, float(value))
+
+
+class _WorkerCore:
+    """Stand-in of the core used by the integrations in a worker process."""
+
+    def __init__(
+        self,
+        config: Dict,
+        slots: Dict[str, int],
+        state_slots: Dict[str, int],
+        input_slots: Dict[str, int],
+        table: SlotTable,
+        wake,
+    ):
+        self.config = config
+        self.name = None
+        self.table = table
+        self.wake = wake
+        self.devices = {
+            name: _WorkerDevice(name, slots.get(name), state_slots.get(name), self)
+            for name in {**slots, **state_slots}
+        }
+        self.input_slots = input_slots
+
+    @property
+    def surplus(self) -> float:
+        """The last surplus written."""
+        return self.table.values[SURPLUS_SLOT]
+
+    @surplus.setter
+    def surplus(self, value: float):
+        self.write(SURPLUS_SLOT, value)
+
+    def get_device(self, name: str) -> _WorkerDevice | None:
+        """Get a device by name."""
+        return self.devices.get(name)
+
+    def set_input(self, name: str, value: float):
+        """Write the reading of an input."""
+        self.write(self.input_slots[name], value)
+
+    def write(self, slot: int, value: float):
+        """Write a reading and wake the core if needed."""
+        if self.table.write(slot, value):
+            try:
+                os.write(self.wake.fileno(), b"\0")
+            except BlockingIOError:
+                # The pipe is full, the core has pending wake-ups anyway
+                pass
+
+
+def _worker_main(
+    integration_name: str,
+    config: Dict,
+    slots: Dict[str, int],
+    state_slots: Dict[str, int],
+    input_slots: Dict[str, int],
+    memory_name: str,
+    size: int,
+    wake: Connection,
+    log_queue: Any,
+):
+    """Entry point of a worker process."""
+    forward_logs(log_queue)
+    memory = SharedMemory(name=memory_name)
+    table = SlotTable(memory.buf, size)
+    os.set_blocking(wake.fileno(), False)
+    core = _WorkerCore(config, slots, state_slots, input_slots, table, wake)
+
+    async def run():
+        # pylint: disable=import-outside-toplevel
+        from opensurplusmanager.integrations import load_module
+
+        await load_module(integration_name).setup(core)
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        table.release()
+        memory.close()
+
+
+@dataclass
+class Worker:
+    """A worker process and what it reads."""
+
+    integration_name: str
+    config: Dict
+    # Consumption slots by device name
+    slots: Dict[str, int]
+    # State slots by device name
+    state_slots: Dict[str, int] = field(default_factory=dict)
+    # Slots by input name
+    input_slots: Dict[str, int] = field(default_factory=dict)
+    process: multiprocessing.Process | None = None
+    restarts: int = 0
+    # time.monotonic() before which the worker is not restarted
+    restart_at: float = 0
+
+
+@dataclass
+class IngestionSupervisor:
+    """
+    Runs the consumption integrations of a core in worker processes and applies
+    their readings.
+    """
+
+    core: Core
+    # Worker processes for the http_get entities. The mqtt_sub and modbus_tcp
+    # entities always use one process, they share connections and read requests
+    processes: int = 1
+    workers: List[Worker] = field(default_factory=list)
+    # Device or input names by slot, None for the surplus
+    slot_names: List[str | None] = field(default_factory=list)
+    # What each slot holds: the surplus, or the consumption or state of a device,
+    # or an input
+    slot_kinds: List[ConsumptionType] = field(default_factory=list)
+    __memory: SharedMemory | None = field(init=False, default=None)
+    __table: SlotTable | None = field(init=False, default=None)
+    __reader: Connection | None = field(init=False, default=None)
+    __writer: Connection | None = field(init=False, default=None)
+    # Records of the workers, logged by the listener in the core process
+    __log_queue: Any = field(init=False, default=None)
+    __log_listener: Any = field(init=False, default=None)
+    __last_sequences: List[int] = field(init=False, default_factory=list)
+    __task: asyncio.Task | None = field(init=False, default=None)
+    __context: Any = field(
+        init=False, default_factory=lambda: multiprocessing.get_context("spawn")
+    )
+
+    def __post_init__(self):
+        if self.processes < 1:
+            raise ValueError("ingestion processes must be at least 1")
+        self.slot_names = [None]
+        self.slot_kinds = [ConsumptionType.SURPLUS]
+        # Devices by integration with their consumption and state slots
+        assigned: Dict[str, Dict[str, Tuple[Dict, int | None, int | None]]] = {}
+        for device in self.core.config.get("devices", []):
+            for key, is_state in (
+                ("consumption_integration", False),
+                ("state_integration", True),
+            ):
+                integration = (device.get(key) or {}).get("name")
+                if integration not in WORKER_INTEGRATIONS:
+                    continue
+                entry = assigned.setdefault(integration, {}).get(
+                    device["name"], (device, None, None)
+                )
+                slot = len(self.slot_names)
+                if is_state:
+                    entry = (device, entry[1], slot)
+                else:
+                    entry = (device, slot, entry[2])
+                assigned[integration][device["name"]] = entry
+                self.slot_names.append(device["name"])
+                self.slot_kinds.append(
+                    ConsumptionType.STATE if is_state else ConsumptionType.DEVICE
+                )
+        # Input slots by integration
+        inputs: Dict[str, Dict[str, int]] = {}
+        for input_config in self.core.config.get("inputs", None) or []:
+            integration = input_config["consumption_integration"].get("name")
+            if integration in WORKER_INTEGRATIONS:
+                inputs.setdefault(integration, {})[input_config["name"]] = len(
+                    self.slot_names
+                )
+                self.slot_names.append(input_config["name"])
+                self.slot_kinds.append(ConsumptionType.INPUT)
+        surplus = self.core.config.get("surplus", None) or {}
+        for integration in WORKER_INTEGRATIONS:
+            enabled = integration in self.core.config.get("integrations", {})
+            if not enabled or (
+                integration not in assigned
+                and integration not in surplus
+                and integration not in inputs
+            ):
+                continue
+            devices = list(assigned.get(integration, {}).values())
+            count = self.processes if integration == "http_get" else 1
+            count = max(1, min(count, len(devices)))
+            for index in range(count):
+                config = copy.deepcopy(self.core.config)
+                part = devices[index::count]
+                config["devices"] = [device for device, _, _ in part]
+                if index != 0:
+                    # The surplus and the inputs are read by the first worker
+                    config.pop("surplus", None)
+                    config.pop("inputs", None)
+                self.workers.append(
+                    Worker(
+                        integration_name=integration,
+                        config=config,
+                        slots={
+                            device["name"]: slot
+                            for device, slot, _ in part
+                            if slot is not None
+                        },
+                        state_slots={
+                            device["name"]: slot
+                            for device, _, slot in part
+                            if slot is not None
+                        },
+                        input_slots=inputs.get(integration, {}) if index == 0 else {},
+                    )
+                )
+
+    @property
+    def integrations(self) -> Tuple[str, ...]:
+        """Names of the integrations run by the workers."""
+        return tuple({worker.integration_name for worker in self.workers})
+
+    def start(self):
+        """Create the shared memory, start the workers and listen to them."""
+        size = len(self.slot_names)
+        self.__memory = SharedMemory(create=True, size=SlotTable.bytes_needed(size))
+        self.__table = SlotTable(self.__memory.buf, size)
+        self.__last_sequences = [0] * size
+        self.__reader, self.__writer = self.__context.Pipe(duplex=False)
+        os.set_blocking(self.__reader.fileno(), False)
+        self.__log_queue = self.__context.Queue()
+        self.__log_listener = receive_logs(self.__log_queue)
+        asyncio.get_running_loop().add_reader(self.__reader.fileno(), self.__on_wake)
+        for worker in self.workers:
+            self.__spawn(worker)
+        self.__task = asyncio.create_task(self.__supervise())
+        logger.info(
+            "Ingestion started with %s workers for %s slots", len(self.workers), size
+        )
+
+    def __spawn(self, worker: Worker):
+        """Start the process of a worker."""
+        worker.process = self.__context.Process(
+            target=_worker_main,
+            args=(
+                worker.integration_name,
+                worker.config,
+                worker.slots,
+                worker.state_slots,
+                worker.input_slots,
+                self.__memory.name,
+                self.__table.size,
+                self.__writer,
+                self.__log_queue,
+            ),
+            name=f"ingestion-{worker.integration_name}",
+            daemon=True,
+        )
+        worker.process.start()
+
+    def __on_wake(self):
+        """Read the wake-ups of the workers and apply the changed slots."""
+        try:
+            while os.read(self.__reader.fileno(), 4096):
+                pass
+        except BlockingIOError:
+            pass
+        self.apply()
+
+    def apply(self):
+        """Apply the readings of the slots that changed since the last call."""
+        table = self.__table
+        table.dirty[0] = 0
+        sequences = table.sequences
+        values = table.values
+        last = self.__last_sequences
+        for slot in range(table.size):
+            sequence = sequences[slot]
+            if sequence == last[slot] or sequence & 1:
+                # Unchanged, or being written and the writer will wake us again
+                continue
+            value = values[slot]
+            if sequences[slot] != sequence:
+                # Overwritten while reading, the writer will wake us again
+                continue
+            last[slot] = sequence
+            kind = self.slot_kinds[slot]
+            if kind == ConsumptionType.SURPLUS:
+                self.core.surplus = value
+            elif kind == ConsumptionType.INPUT:
+                self.core.set_input(self.slot_names[slot], value)
+            else:
+                device = self.core.get_device(self.slot_names[slot])
+                if device is None:
+                    continue
+                if kind == ConsumptionType.STATE:
+                    device.reported_powered = bool(value)
+                else:
+                    device.consumption = value
+
+    async def __supervise(self):
+        """Restart the workers that died, with an increasing delay."""
+        while True:
+            await asyncio.sleep(SUPERVISE_INTERVAL)
+            now = time.monotonic()
+            for worker in self.workers:
+                if worker.process is None or worker.process.is_alive():
+                    continue
+                if not worker.restart_at:
+                    delay = min(2**worker.restarts, MAX_RESTART_DELAY)
+                    logger.error(
+                        "Ingestion worker %s exited with code %s, restarting in %ss",
+                        worker.integration_name,
+                        worker.process.exitcode,
+                        delay,
+                    )
+                    worker.restart_at = now + delay
+                elif now >= worker.restart_at:
+                    worker.restarts += 1
+                    worker.restart_at = 0
+                    self.__spawn(worker)
+
+    def close(self):
+        """Stop the workers and release the shared memory."""
+        if self.__task is not None:
+            self.__task.cancel()
+            self.__task = None
+        for worker in self.workers:
+            if worker.process is not None and worker.process.is_alive():
+                worker.process.terminate()
+                worker.process.join(5)
+        if self.__reader is not None:
+            try:
+                asyncio.get_running_loop().remove_reader(self.__reader.fileno())
+            except RuntimeError:
+                # No running loop, the reader went with the loop
+                pass
+            self.__reader.close()
+            self.__writer.close()
+            self.__reader = None
+        if self.__log_listener is not None:
+            self.__log_listener.stop()
+            self.__log_queue.close()
+            self.__log_listener = None
+        if self.__memory is not None:
+            self.__table.release()
+            self.__memory.close()
+            self.__memory.unlink()
+            self.__memory = None
+        logger.info("Ingestion closed")
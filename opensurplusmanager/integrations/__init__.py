@@ -0,0 +1,74 @@
+"""
+Integrations of Open Surplus Manager. Every subpackage is an integration with a
+`setup(core)` coroutine that is called for each core that enables it in its config.
+"""
+
+from __future__ import annotations
+
+import importlib.util
+import os
+from types import ModuleType
+from typing import TYPE_CHECKING, Any, Dict, List
+
+from opensurplusmanager.exceptions import IntegrationInitializationError
+from opensurplusmanager.utils import logger
+
+if TYPE_CHECKING:
+    from opensurplusmanager.core import Core
+
+INTEGRATIONS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+# Integration modules by name, loaded once and set up for every core
+__modules: Dict[str, ModuleType | None] = {}
+
+
+def load_module(integration_name: str) -> ModuleType | None:
+    """
+    Load the module of an integration.
+
+    Parameters:
+        integration_name (str): The name of the integration folder.
+
+    Returns:
+        ModuleType | None: The module or None if the integration does not exist.
+    """
+    if integration_name not in __modules:
+        module = None
+        init_file = os.path.join(INTEGRATIONS_FOLDER, integration_name, "__init__.py")
+        if os.path.exists(init_file):
+            spec = importlib.util.spec_from_file_location("__init__", init_file)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        __modules[integration_name] = module
+    return __modules[integration_name]
+
+
+async def setup_integrations(core: Core, integrations: List[Any]):
+    """
+    Set up the integrations enabled in the config of a core.
+
+    Parameters:
+        core (Core): The core.
+        integrations (List[Any]): The integrations set up are appended to it, to
+        close them when the core stops, even if a later one fails.
+
+    Raises:
+        IntegrationInitializationError: If an integration can not be initialized.
+    """
+    for integration_name in core.config.get("integrations", {}):
+        if core.ingestion is not None and (
+            integration_name in core.ingestion.integrations
+        ):
+            # Runs in the ingestion worker processes
+            continue
+        module = load_module(integration_name)
+        if module is None or not hasattr(module, "setup"):
+            logger.warning("Integration %s not found", integration_name)
+            continue
+        try:
+            integration = await module.setup(core)
+        except IntegrationInitializationError as e:
+            logger.error("Error initializing integration %s: %s", integration_name, e)
+            raise
+        if integration is not None:
+            integrations.append(integration)
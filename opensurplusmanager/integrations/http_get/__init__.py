@@ -1,14 +1,31 @@
 """HTTP GET integration module."""
 
 import asyncio
+import time
 from dataclasses import dataclass, field
 
 import aiohttp
 
 from opensurplusmanager.core import Core
 from opensurplusmanager.integrations.http_get.entity import HTTPGetEntity
-from opensurplusmanager.models.entity import ConsumptionType
+from opensurplusmanager.integrations.shared import (
+    acquire_http_session,
+    release_http_session,
+)
+from opensurplusmanager.metrics import (
+    INTEGRATION_ERRORS,
+    INTEGRATION_REQUEST_DURATION,
+    READINGS,
+    Counter,
+    Histogram,
+)
+from opensurplusmanager.models.entity import (
+    ConsumptionType,
+    entity_kwargs,
+    parse_state,
+)
 from opensurplusmanager.models.integration import ConsumptionIntegration
+from opensurplusmanager.tracing import tracer
 from opensurplusmanager.utils import logger
 
 
@@ -18,6 +35,12 @@ class HttpGet(ConsumptionIntegration):
 
     client: aiohttp.ClientSession = field(init=False)
     __timeout: int = field(default=30)
+    __request_duration: Histogram = field(init=False)
+    __errors: Counter = field(init=False)
+    __readings: Counter = field(init=False)
+    # Task of `run`, cancelled when the integration is closed
+    task: asyncio.Task | None = field(init=False, default=None)
+    __trace_lane: str = field(init=False, default="http_get")
 
     def __load_entities(self):
         """Load entities from the core configuration."""
@@ -26,7 +49,7 @@ class HttpGet(ConsumptionIntegration):
                 device=None,
                 consumption_type=ConsumptionType.SURPLUS,
                 name="Surplus",
-                **self.core.config["surplus"]["http_get"],
+                **entity_kwargs(self.core.config["surplus"]["http_get"]),
             )
             self.entities.append(surplus)
 
@@ -40,13 +63,42 @@ class HttpGet(ConsumptionIntegration):
                 consumption_entity = HTTPGetEntity(
                     consumption_type=ConsumptionType.DEVICE,
                     device=device,
-                    **device_config,
+                    **entity_kwargs(device_config),
                 )
                 self.entities.append(consumption_entity)
 
+        for device in self.core.config.get("devices", []):
+            state_config = dict(device.get("state_integration", None) or {})
+            if state_config.pop("name", None) == "http_get":
+                logger.debug("Loading state of device %s", device["name"])
+                state_entity = HTTPGetEntity(
+                    name=f"{device['name']} state",
+                    consumption_type=ConsumptionType.STATE,
+                    device=self.core.get_device(device["name"]),
+                    **entity_kwargs(state_config),
+                )
+                self.entities.append(state_entity)
+
+        for input_config in self.core.config.get("inputs", None) or []:
+            entity_config = dict(input_config["consumption_integration"])
+            if entity_config.pop("name", None) == "http_get":
+                logger.debug("Loading input %s", input_config["name"])
+                input_entity = HTTPGetEntity(
+                    name=input_config["name"],
+                    consumption_type=ConsumptionType.INPUT,
+                    device=None,
+                    **entity_kwargs(entity_config),
+                )
+                self.entities.append(input_entity)
+
     def __post_init__(self):
         logger.info("Initializing HTTP GET integration...")
-        self.client = aiohttp.ClientSession()
+        self.client = acquire_http_session()
+        self.__request_duration = INTEGRATION_REQUEST_DURATION.labels("http_get")
+        self.__errors = INTEGRATION_ERRORS.labels("http_get")
+        self.__readings = READINGS.labels("http_get")
+        if self.core.name is not None:
+            self.__trace_lane = f"http_get {self.core.name}"
         self.__load_entities()
         self.__timeout = self.core.config["integrations"]["http_get"].get(
             "timeout", self.__timeout
@@ -58,29 +110,39 @@ class HttpGet(ConsumptionIntegration):
         logger.info("Running HTTP GET integration...")
         while True:
             for entity in self.entities:
+                start = time.perf_counter()
                 try:
-                    async with self.client.get(entity.path) as response:
-                        logger.debug(
-                            "Got response from %s: %s. Content: %s",
-                            entity.name,
-                            response.status,
-                            await response.text(),
-                        )
-                        try:
-                            consumption = float(await response.text())
-                            if entity.consumption_type == ConsumptionType.SURPLUS:
-                                self.core.surplus = consumption
-                            elif entity.consumption_type == ConsumptionType.DEVICE:
-                                entity.device.consumption = consumption
-                        except ValueError:
-                            logger.error(
-                                "Invalid API response for entity %s", entity.name
-                            )
+                    with tracer.span("poll", self.__trace_lane, entity.path):
+                        async with self.client.get(entity.path) as response:
+                            text = await response.text()
+                    self.__request_duration.observe(time.perf_counter() - start)
+                    logger.debug(
+                        "Got response from %s: %s. Content: %s",
+                        entity.name,
+                        response.status,
+                        text,
+                    )
+                    try:
+                        if entity.consumption_type == ConsumptionType.STATE:
+                            entity.device.reported_powered = parse_state(text)
+                            continue
+                        consumption = float(text)
+                        self.__readings.inc()
+                        if entity.consumption_type == ConsumptionType.SURPLUS:
+                            self.core.surplus = consumption
+                        elif entity.consumption_type == ConsumptionType.DEVICE:
+                            entity.device.consumption = consumption
+                        elif entity.consumption_type == ConsumptionType.INPUT:
+                            self.core.set_input(entity.name, consumption)
+                    except ValueError:
+                        self.__errors.inc()
+                        logger.error("Invalid API response for entity %s", entity.name)
                 except (
                     aiohttp.ClientConnectionError,
                     aiohttp.ClientError,
                     asyncio.TimeoutError,
                 ):
+                    self.__errors.inc()
                     logger.error(
                         "Could not connect to %s from entity %s. Trying again in %ss",
                         entity.path,
@@ -92,7 +154,9 @@ class HttpGet(ConsumptionIntegration):
     async def close(self):
         """Safely closes the HTTP GET integration"""
         logger.info("Closing HTTP GET integration...")
-        await self.client.close()
+        if self.task is not None:
+            self.task.cancel()
+        await release_http_session()
 
 
 async def setup(core: Core) -> HttpGet:
@@ -107,6 +171,6 @@ async def setup(core: Core) -> HttpGet:
         if needed.
     """
     http_get = HttpGet(core)
-    asyncio.create_task(http_get.run())
+    http_get.task = asyncio.create_task(http_get.run())
 
     return http_get
@@ -1,11 +1,22 @@
 """HTTP Post integration module."""
 
+import time
 from dataclasses import dataclass, field
 
 import aiohttp
 
 from opensurplusmanager.core import Core
 from opensurplusmanager.integrations.http_post.entity import HTTPPostEntity
+from opensurplusmanager.integrations.shared import (
+    acquire_http_session,
+    release_http_session,
+)
+from opensurplusmanager.metrics import (
+    INTEGRATION_ERRORS,
+    INTEGRATION_REQUEST_DURATION,
+    Counter,
+    Histogram,
+)
 from opensurplusmanager.models.integration import ControlIntegration
 from opensurplusmanager.utils import logger
 
@@ -15,6 +26,8 @@ class HTTPPost(ControlIntegration):
     """HTTP Post integration class, inherits from ControlIntegration."""
 
     client: aiohttp.ClientSession = field(init=False)
+    __request_duration: Histogram = field(init=False)
+    __errors: Counter = field(init=False)
 
     def __load_entities(self):
         """Load entities from the core configuration."""
@@ -61,7 +74,9 @@ class HTTPPost(ControlIntegration):
 
     def __post_init__(self):
         logger.info("Initializing HTTP Post integration...")
-        self.client = aiohttp.ClientSession()
+        self.client = acquire_http_session()
+        self.__request_duration = INTEGRATION_REQUEST_DURATION.labels("http_post")
+        self.__errors = INTEGRATION_ERRORS.labels("http_post")
         self.__load_entities()
 
     async def turn_on(self, device_name: str):
@@ -73,12 +88,7 @@ class HTTPPost(ControlIntegration):
         """
         entity = self.turn_on_entities.get(device_name)
         if entity:
-            async with self.client.post(
-                entity.path, headers=entity.headers, json=entity.body
-            ) as response:
-                logger.debug(
-                    "Got response from device %s: %s", entity.name, response.status
-                )
+            await self.__post(entity, entity.body)
         else:
             logger.error("Device %s not found in control integration", device_name)
 
@@ -91,12 +101,7 @@ class HTTPPost(ControlIntegration):
         """
         entity = self.turn_off_entities.get(device_name)
         if entity:
-            async with self.client.post(
-                entity.path, headers=entity.headers, json=entity.body
-            ) as response:
-                logger.debug(
-                    "Got response from device %s: %s", entity.name, response.status
-                )
+            await self.__post(entity, entity.body)
         else:
             logger.error("Device %s not found in control integration", device_name)
 
@@ -115,19 +120,36 @@ class HTTPPost(ControlIntegration):
             if value == "$power":
                 send_body[key] = power
         if entity:
+            await self.__post(entity, send_body)
+        else:
+            logger.error("Device %s not found in control integration", device_name)
+
+    async def __post(self, entity: HTTPPostEntity, body: dict):
+        """
+        Send the request of an entity, recording its duration and errors.
+
+        Parameters
+        entity (HTTPPostEntity): The entity to send the request to.
+        body (dict): The JSON body of the request.
+        """
+        start = time.perf_counter()
+        try:
             async with self.client.post(
-                entity.path, headers=entity.headers, json=send_body
+                entity.path, headers=entity.headers, json=body
             ) as response:
                 logger.debug(
                     "Got response from device %s: %s", entity.name, response.status
                 )
-        else:
-            logger.error("Device %s not found in control integration", device_name)
+        except Exception:
+            self.__errors.inc()
+            raise
+        finally:
+            self.__request_duration.observe(time.perf_counter() - start)
 
     async def close(self):
         """Safe close of the integration."""
         logger.info("Closing HTTP Post integration...")
-        await self.client.close()
+        await release_http_session()
 
 
 async def setup(core: Core) -> HTTPPost:
@@ -0,0 +1,390 @@
+"""Modbus TCP integration module."""
+
+import asyncio
+import struct
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+from opensurplusmanager.core import Core
+from opensurplusmanager.exceptions import IntegrationInitializationError
+from opensurplusmanager.integrations.modbus_tcp.entity import (
+    REGISTER_TYPES,
+    ModbusTCPEntity,
+)
+from opensurplusmanager.metrics import (
+    INTEGRATION_ERRORS,
+    INTEGRATION_REQUEST_DURATION,
+    READINGS,
+    Counter,
+    Histogram,
+)
+from opensurplusmanager.models.entity import ConsumptionType, entity_kwargs
+from opensurplusmanager.models.integration import ConsumptionIntegration
+from opensurplusmanager.tracing import tracer
+from opensurplusmanager.utils import logger
+
+# Transaction id, protocol id, length, unit id
+MBAP = struct.Struct(">HHHB")
+# Function code, start address, quantity of registers
+READ_REQUEST = struct.Struct(">BHH")
+# Maximum registers of a read request in the Modbus specification
+MAX_REGISTERS = 125
+
+
+class ModbusError(Exception):
+    """Error reading from a Modbus device."""
+
+
+@dataclass
+class Block:
+    """A contiguous range of registers read with one request."""
+
+    function: int
+    start: int
+    count: int
+    entities: List[ModbusTCPEntity] = field(default_factory=list)
+
+
+def build_blocks(
+    entities: List[ModbusTCPEntity], max_registers: int, max_gap: int
+) -> List[Block]:
+    """
+    Merge the registers of the entities of one unit into the fewest contiguous
+    blocks, joining ranges separated by up to `max_gap` unused registers.
+
+    Parameters:
+        entities (List[ModbusTCPEntity]): The entities of the unit.
+        max_registers (int): Maximum registers of a block.
+        max_gap (int): Maximum unused registers between two merged ranges.
+
+    Returns:
+        List[Block]: The blocks.
+    """
+    blocks: List[Block] = []
+    for entity in sorted(entities, key=lambda e: (e.register_type, e.address)):
+        function = REGISTER_TYPES[entity.register_type]
+        end = entity.address + entity.count
+        block = blocks[-1] if blocks else None
+        if (
+            block is not None
+            and block.function == function
+            and entity.address - (block.start + block.count) <= max_gap
+            and max(end, block.start + block.count) - block.start <= max_registers
+        ):
+            block.count = max(end, block.start + block.count) - block.start
+        else:
+            block = Block(function, entity.address, entity.count)
+            blocks.append(block)
+        block.entities.append(entity)
+    return blocks
+
+
+def decode(entity: ModbusTCPEntity, registers: bytes) -> float:
+    """
+    Decode the value of an entity from its registers.
+
+    Parameters:
+        entity (ModbusTCPEntity): The entity.
+        registers (bytes): The big endian registers of the value.
+
+    Returns:
+        float: The scaled value.
+    """
+    if entity.count == 2 and entity.word_order == "little":
+        registers = registers[2:4] + registers[0:2]
+    value = struct.unpack(
+        {
+            "int16": ">h",
+            "uint16": ">H",
+            "int32": ">i",
+            "uint32": ">I",
+            "float32": ">f",
+        }[entity.data_type],
+        registers,
+    )[0]
+    return value * entity.scale
+
+
+@dataclass
+class ModbusConnection:
+    """
+    Persistent connection to a Modbus TCP server. Several requests can be sent
+    without waiting for the responses, which are matched by their transaction id.
+    """
+
+    host: str
+    port: int
+    timeout: float
+    __reader: asyncio.StreamReader | None = field(init=False, default=None)
+    __writer: asyncio.StreamWriter | None = field(init=False, default=None)
+    __receiver: asyncio.Task | None = field(init=False, default=None)
+    __pending: Dict[int, asyncio.Future] = field(init=False, default_factory=dict)
+    __transaction: int = field(init=False, default=0)
+    __lock: asyncio.Lock = field(init=False, default_factory=asyncio.Lock)
+
+    async def __connect(self):
+        """Open the connection if it is not open."""
+        async with self.__lock:
+            if self.__writer is not None:
+                return
+            self.__reader, self.__writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.timeout
+            )
+            self.__receiver = asyncio.create_task(self.__receive())
+            logger.info("Connected to Modbus server %s:%s", self.host, self.port)
+
+    async def __receive(self):
+        """
+        Read the responses and resolve the futures of their requests. On any error,
+        e.g. a malformed frame, the connection is closed so the next read opens a
+        new one.
+        """
+        try:
+            while True:
+                header = await self.__reader.readexactly(MBAP.size)
+                transaction, _, length, _ = MBAP.unpack(header)
+                if length < 2:
+                    raise ModbusError(f"Invalid frame length {length}")
+                pdu = await self.__reader.readexactly(length - 1)
+                future = self.__pending.pop(transaction, None)
+                if future is not None and not future.done():
+                    future.set_result(pdu)
+        except ModbusError as e:
+            self.__fail(e)
+        except (OSError, asyncio.IncompleteReadError) as e:
+            self.__fail(ModbusError(f"Connection lost: {e}"))
+        except Exception as e:  # pylint: disable=broad-except
+            self.__fail(ModbusError(f"Receiver failed: {e}"))
+
+    def __fail(self, error: Exception):
+        """Close the connection and fail the pending requests."""
+        for future in self.__pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self.__pending.clear()
+        if self.__writer is not None:
+            self.__writer.close()
+        self.__reader = self.__writer = None
+
+    async def read(self, unit: int, function: int, start: int, count: int) -> bytes:
+        """
+        Read a block of registers.
+
+        Parameters:
+            unit (int): The unit id.
+            function (int): The function code, 3 for holding or 4 for input.
+            start (int): The first register.
+            count (int): The number of registers.
+
+        Returns:
+            bytes: The registers.
+
+        Raises:
+            ModbusError: If the request fails or the server returns an exception.
+        """
+        try:
+            await self.__connect()
+        except (OSError, asyncio.TimeoutError) as e:
+            raise ModbusError(f"Could not connect: {e}") from e
+        writer = self.__writer
+        if writer is None:
+            raise ModbusError("Connection lost")
+        self.__transaction = (self.__transaction + 1) % 0x10000
+        transaction = self.__transaction
+        future = asyncio.get_running_loop().create_future()
+        self.__pending[transaction] = future
+        writer.write(
+            MBAP.pack(transaction, 0, READ_REQUEST.size + 1, unit)
+            + READ_REQUEST.pack(function, start, count)
+        )
+        try:
+            pdu = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError as e:
+            self.__pending.pop(transaction, None)
+            raise ModbusError("Request timed out") from e
+        if len(pdu) < 2:
+            raise ModbusError("Response too short")
+        if pdu[0] & 0x80:
+            raise ModbusError(f"Modbus exception {pdu[1]}")
+        data = pdu[2 : 2 + pdu[1]]
+        if len(data) != 2 * count:
+            raise ModbusError("Invalid response length")
+        return data
+
+    def close(self):
+        """Close the connection."""
+        if self.__receiver is not None:
+            self.__receiver.cancel()
+            self.__receiver = None
+        self.__fail(ModbusError("Connection closed"))
+
+
+@dataclass
+class ModbusTCP(ConsumptionIntegration):
+    """Modbus TCP integration class, inherits from ConsumptionIntegration."""
+
+    # Blocks to read by connection and unit
+    blocks: Dict[Tuple[str, int], List[Tuple[int, Block]]] = field(
+        init=False, default_factory=dict
+    )
+    connections: Dict[Tuple[str, int], ModbusConnection] = field(
+        init=False, default_factory=dict
+    )
+    task: asyncio.Task | None = field(init=False, default=None)
+    __interval: float = field(default=5)
+    __timeout: float = field(default=3)
+    __request_duration: Histogram = field(init=False)
+    __errors: Counter = field(init=False)
+    __readings: Counter = field(init=False)
+    __trace_lane: str = field(init=False, default="modbus_tcp")
+
+    def __load_entities(self):
+        """Load entities from the core configuration."""
+        if (
+            "surplus" in self.core.config
+            and "modbus_tcp" in self.core.config["surplus"]
+        ):
+            surplus = ModbusTCPEntity(
+                device=None,
+                consumption_type=ConsumptionType.SURPLUS,
+                name="Surplus",
+                **entity_kwargs(self.core.config["surplus"]["modbus_tcp"]),
+            )
+            self.entities.append(surplus)
+
+        for device in self.core.config.get("devices", []):
+            integration_name = device["consumption_integration"]["name"]
+            if integration_name == "modbus_tcp":
+                device_config = dict(device["consumption_integration"])
+                device_config.pop("name")
+                logger.debug("Loading device %s", device["name"])
+                consumption_entity = ModbusTCPEntity(
+                    name=device["name"],
+                    consumption_type=ConsumptionType.DEVICE,
+                    device=self.core.get_device(device["name"]),
+                    **entity_kwargs(device_config),
+                )
+                self.entities.append(consumption_entity)
+
+        for input_config in self.core.config.get("inputs", None) or []:
+            entity_config = dict(input_config["consumption_integration"])
+            if entity_config.pop("name", None) == "modbus_tcp":
+                logger.debug("Loading input %s", input_config["name"])
+                input_entity = ModbusTCPEntity(
+                    name=input_config["name"],
+                    consumption_type=ConsumptionType.INPUT,
+                    device=None,
+                    **entity_kwargs(entity_config),
+                )
+                self.entities.append(input_entity)
+
+    def __post_init__(self):
+        logger.info("Initializing Modbus TCP integration...")
+        config = self.core.config["integrations"].get("modbus_tcp", None) or {}
+        self.__interval = config.get("interval", self.__interval)
+        self.__timeout = config.get("timeout", self.__timeout)
+        self.__request_duration = INTEGRATION_REQUEST_DURATION.labels("modbus_tcp")
+        self.__errors = INTEGRATION_ERRORS.labels("modbus_tcp")
+        self.__readings = READINGS.labels("modbus_tcp")
+        if self.core.name is not None:
+            self.__trace_lane = f"modbus_tcp {self.core.name}"
+        try:
+            self.__load_entities()
+        except (TypeError, ValueError) as e:
+            raise IntegrationInitializationError(str(e)) from e
+
+        units: Dict[Tuple[str, int, int], List[ModbusTCPEntity]] = {}
+        for entity in self.entities:
+            units.setdefault((entity.host, entity.port, entity.unit), []).append(entity)
+        max_registers = min(config.get("max_registers", MAX_REGISTERS), MAX_REGISTERS)
+        max_gap = config.get("max_gap", 10)
+        for (host, port, unit), entities in units.items():
+            blocks = build_blocks(entities, max_registers, max_gap)
+            self.blocks.setdefault((host, port), []).extend(
+                (unit, block) for block in blocks
+            )
+            if (host, port) not in self.connections:
+                self.connections[(host, port)] = ModbusConnection(
+                    host, port, self.__timeout
+                )
+        logger.info(
+            "Modbus TCP reads %s entities with %s requests",
+            len(self.entities),
+            sum(len(blocks) for blocks in self.blocks.values()),
+        )
+
+    async def __read_block(self, connection: ModbusConnection, unit: int, block: Block):
+        """Read a block and update the core with the values of its entities."""
+        start = time.perf_counter()
+        try:
+            data = await connection.read(unit, block.function, block.start, block.count)
+        except ModbusError as e:
+            self.__errors.inc()
+            logger.error(
+                "Could not read registers %s-%s of unit %s from %s:%s: %s",
+                block.start,
+                block.start + block.count - 1,
+                unit,
+                connection.host,
+                connection.port,
+                e,
+            )
+            return
+        self.__request_duration.observe(time.perf_counter() - start)
+        for entity in block.entities:
+            offset = 2 * (entity.address - block.start)
+            value = decode(entity, data[offset : offset + 2 * entity.count])
+            self.__readings.inc()
+            if entity.consumption_type == ConsumptionType.SURPLUS:
+                self.core.surplus = value
+            elif entity.consumption_type == ConsumptionType.DEVICE:
+                entity.device.consumption = value
+            elif entity.consumption_type == ConsumptionType.INPUT:
+                self.core.set_input(entity.name, value)
+
+    async def poll(self):
+        """
+        Read all the blocks once. The requests of every connection are pipelined
+        and the connections are read concurrently.
+        """
+        with tracer.span("poll", self.__trace_lane):
+            await asyncio.gather(
+                *(
+                    self.__read_block(self.connections[key], unit, block)
+                    for key, blocks in self.blocks.items()
+                    for unit, block in blocks
+                )
+            )
+
+    async def run(self):
+        """Indefinitely reads the configured entities every `interval` seconds."""
+        logger.info("Running Modbus TCP integration...")
+        while True:
+            await self.poll()
+            await asyncio.sleep(self.__interval)
+
+    async def close(self):
+        """Safely closes the Modbus TCP integration."""
+        logger.info("Closing Modbus TCP integration...")
+        if self.task is not None:
+            self.task.cancel()
+        for connection in self.connections.values():
+            connection.close()
+
+
+async def setup(core: Core) -> ModbusTCP:
+    """
+    Method called by main to initialize the Modbus TCP integration.
+
+    Parameters:
+        core (Core): The core instance.
+
+    Returns:
+        ModbusTCP: The initialized Modbus TCP integration to close the integration
+        if needed.
+    """
+    modbus_tcp = ModbusTCP(core)
+    modbus_tcp.task = asyncio.create_task(modbus_tcp.run())
+
+    return modbus_tcp
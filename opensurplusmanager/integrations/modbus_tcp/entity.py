@@ -0,0 +1,38 @@
+"""Entity for Modbus TCP consumption."""
+
+from dataclasses import dataclass
+
+from opensurplusmanager.models.entity import ConsumptionEntity
+
+# Registers used by every data type
+DATA_TYPES = {"int16": 1, "uint16": 1, "int32": 2, "uint32": 2, "float32": 2}
+# Function codes of the register types
+REGISTER_TYPES = {"holding": 3, "input": 4}
+
+
+@dataclass
+class ModbusTCPEntity(ConsumptionEntity):
+    """Model for a Modbus TCP consumption entity, inherits from ConsumptionEntity."""
+
+    host: str
+    address: int
+    port: int = 502
+    unit: int = 1
+    data_type: str = "int16"
+    scale: float = 1
+    # Order of the registers of 32 bit values: "big" is the high word first
+    word_order: str = "big"
+    register_type: str = "holding"
+
+    def __post_init__(self):
+        if self.data_type not in DATA_TYPES:
+            raise ValueError(f"Invalid Modbus data type {self.data_type}")
+        if self.word_order not in ("big", "little"):
+            raise ValueError("Modbus word order must be big or little")
+        if self.register_type not in REGISTER_TYPES:
+            raise ValueError("Modbus register type must be holding or input")
+
+    @property
+    def count(self) -> int:
+        """Number of registers of the value."""
+        return DATA_TYPES[self.data_type]
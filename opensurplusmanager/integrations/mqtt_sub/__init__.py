@@ -1,14 +1,22 @@
 """MQTT Subscribe integration module."""
 
-import asyncio
+import functools
 from dataclasses import dataclass, field
 
-import aiomqtt
-
 from opensurplusmanager.core import Core
 from opensurplusmanager.exceptions import IntegrationInitializationError
 from opensurplusmanager.integrations.mqtt_sub.entity import MQTTSubEntity
-from opensurplusmanager.models.entity import ConsumptionType
+from opensurplusmanager.integrations.shared import (
+    MqttConnection,
+    acquire_mqtt_connection,
+    release_mqtt_connection,
+)
+from opensurplusmanager.metrics import INTEGRATION_ERRORS, READINGS, Counter
+from opensurplusmanager.models.entity import (
+    ConsumptionType,
+    entity_kwargs,
+    parse_state,
+)
 from opensurplusmanager.models.integration import ConsumptionIntegration
 from opensurplusmanager.utils import logger
 
@@ -17,7 +25,10 @@ from opensurplusmanager.utils import logger
 class MQTTSub(ConsumptionIntegration):
     """MQTT Subscribe integration class, inherits from ConsumptionIntegration."""
 
-    client: aiomqtt.Client = field(init=False)
+    connection: MqttConnection = field(init=False)
+    __errors: Counter = field(init=False)
+    __readings: Counter = field(init=False)
+    __callbacks: list = field(init=False, default_factory=list)
 
     def __load_entities(self):
         """Load entities from the core configuration."""
@@ -26,7 +37,7 @@ class MQTTSub(ConsumptionIntegration):
                 device=None,
                 consumption_type=ConsumptionType.SURPLUS,
                 name="Surplus",
-                **self.core.config["surplus"]["mqtt_sub"],
+                **entity_kwargs(self.core.config["surplus"]["mqtt_sub"]),
             )
             self.entities.append(surplus)
 
@@ -40,10 +51,34 @@ class MQTTSub(ConsumptionIntegration):
                 consumption_entity = MQTTSubEntity(
                     consumption_type=ConsumptionType.DEVICE,
                     device=device,
-                    **device_config,
+                    **entity_kwargs(device_config),
                 )
                 self.entities.append(consumption_entity)
 
+        for device in self.core.config.get("devices", []):
+            state_config = dict(device.get("state_integration", None) or {})
+            if state_config.pop("name", None) == "mqtt_sub":
+                logger.debug("Loading state of device %s", device["name"])
+                state_entity = MQTTSubEntity(
+                    name=f"{device['name']} state",
+                    consumption_type=ConsumptionType.STATE,
+                    device=self.core.get_device(device["name"]),
+                    **entity_kwargs(state_config),
+                )
+                self.entities.append(state_entity)
+
+        for input_config in self.core.config.get("inputs", None) or []:
+            entity_config = dict(input_config["consumption_integration"])
+            if entity_config.pop("name", None) == "mqtt_sub":
+                logger.debug("Loading input %s", input_config["name"])
+                input_entity = MQTTSubEntity(
+                    name=input_config["name"],
+                    consumption_type=ConsumptionType.INPUT,
+                    device=None,
+                    **entity_kwargs(entity_config),
+                )
+                self.entities.append(input_entity)
+
     def __post_init__(self):
         logger.info("Initializing MQTT Subscribe integration...")
         try:
@@ -53,49 +88,52 @@ class MQTTSub(ConsumptionIntegration):
         username = self.core.config["integrations"]["mqtt_sub"].get("username", None)
         password = self.core.config["integrations"]["mqtt_sub"].get("password", None)
         port = self.core.config["integrations"]["mqtt_sub"].get("port", 1883)
-        self.client = aiomqtt.Client(
-            hostname=hostname,
-            identifier="opensurplusmanager",
-            username=username,
-            password=password,
-            port=port,
-        )
+        self.__errors = INTEGRATION_ERRORS.labels("mqtt_sub")
+        self.__readings = READINGS.labels("mqtt_sub")
+        self.connection = acquire_mqtt_connection(hostname, port, username, password)
         self.__load_entities()
 
-    async def run(self):
+    def __on_message(self, entity: MQTTSubEntity, payload: bytes):
+        """Update the core with the consumption value of a message."""
+        logger.debug("Got message from %s: %s", entity.name, payload.decode())
+        if entity.consumption_type == ConsumptionType.STATE:
+            try:
+                entity.device.reported_powered = parse_state(payload.decode())
+            except ValueError:
+                self.__errors.inc()
+                logger.error("Error parsing state from message: %s", payload)
+            return
+        try:
+            consumption = float(payload.decode())
+        except ValueError:
+            self.__errors.inc()
+            logger.error("Error parsing consumption value from message: %s", payload)
+            return
+        self.__readings.inc()
+        if entity.consumption_type == ConsumptionType.SURPLUS:
+            self.core.surplus = consumption
+        elif entity.consumption_type == ConsumptionType.DEVICE:
+            entity.device.consumption = consumption
+        elif entity.consumption_type == ConsumptionType.INPUT:
+            self.core.set_input(entity.name, consumption)
+
+    def run(self):
         """
-        Indefinitely runs the MQTT Subscribe integration. It will subscribe to the
-        configured entities and update the core with the consumption values.
+        Subscribe to the topics of the configured entities. The messages are
+        received through the connection to the broker shared by all the cores and
+        update the core with the consumption values.
         """
         logger.info("Running MQTT Subscribe integration...")
         for entity in self.entities:
-            try:
-                async with self.client:
-                    await self.client.subscribe(entity.topic)
-                    logger.debug("Subscribed to topic %s", entity.topic)
-                    async for message in self.client.messages:
-                        logger.debug(
-                            "Got message from %s: %s",
-                            entity.name,
-                            message.payload.decode(),
-                        )
-                        try:
-                            consumption = float(message.payload.decode())
-                            if entity.consumption_type == ConsumptionType.SURPLUS:
-                                self.core.surplus = consumption
-                            elif entity.consumption_type == ConsumptionType.DEVICE:
-                                entity.device.consumption = consumption
-                        except ValueError:
-                            logger.error(
-                                "Error parsing consumption value from message: %s",
-                                message.payload,
-                            )
-            except aiomqtt.exceptions.MqttError as e:
-                logger.error("Error subscribing to topic %s: %s", entity.topic, e)
+            callback = functools.partial(self.__on_message, entity)
+            self.__callbacks.append(callback)
+            self.connection.subscribe(entity.topic, callback)
+            logger.debug("Subscribed to topic %s", entity.topic)
 
     async def close(self):
         """Close the MQTT Subscribe integration."""
         logger.info("Closing MQTT Subscribe integration...")
+        release_mqtt_connection(self.connection, self.__callbacks)
 
 
 async def setup(core: Core) -> MQTTSub:
@@ -110,6 +148,6 @@ async def setup(core: Core) -> MQTTSub:
         if needed.
     """
     mqtt_sub = MQTTSub(core)
-    asyncio.create_task(mqtt_sub.run())
+    mqtt_sub.run()
 
     return mqtt_sub
@@ -0,0 +1,191 @@
+"""
+Connections shared by the integrations of every core in the process.
+
+All the HTTP integrations use one client session, so its connection pool is reused
+for every endpoint, and the MQTT integrations share one connection per broker
+that dispatches the messages to the subscribers of each topic. Both are released
+when the last integration using them is closed.
+"""
+
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Tuple
+
+import aiohttp
+import aiomqtt
+
+from opensurplusmanager.utils import logger
+
+# Seconds to wait before reconnecting to a MQTT broker
+MQTT_RECONNECT_INTERVAL = 5
+
+__http_session: aiohttp.ClientSession | None = None
+__http_users = 0
+
+
+def acquire_http_session() -> aiohttp.ClientSession:
+    """
+    Get the shared HTTP client session, creating it if needed. Every call must be
+    paired with a call to `release_http_session`.
+
+    Returns:
+        aiohttp.ClientSession: The shared session.
+    """
+    global __http_session, __http_users  # pylint: disable=global-statement
+    if __http_session is None or __http_session.closed:
+        __http_session = aiohttp.ClientSession()
+    __http_users += 1
+    return __http_session
+
+
+async def release_http_session():
+    """Release the shared HTTP client session, closing it if it is not used."""
+    global __http_session, __http_users  # pylint: disable=global-statement
+    __http_users -= 1
+    if __http_users <= 0 and __http_session is not None:
+        await __http_session.close()
+        __http_session = None
+        __http_users = 0
+
+
+@dataclass
+class MqttConnection:
+    """A connection to a MQTT broker shared by all its subscribers."""
+
+    hostname: str
+    port: int = 1883
+    username: str | None = None
+    password: str | None = None
+    subscribers: Dict[str, List[Callable[[bytes], None]]] = field(default_factory=dict)
+    users: int = 0
+    __task: asyncio.Task | None = field(init=False, default=None)
+    __client: aiomqtt.Client | None = field(init=False, default=None)
+
+    def subscribe(self, topic: str, callback: Callable[[bytes], None]):
+        """
+        Call `callback` with the payload of every message received on a topic. The
+        connection is started with the first subscription.
+
+        Parameters:
+            topic (str): The topic.
+            callback (Callable[[bytes], None]): The callback.
+        """
+        callbacks = self.subscribers.setdefault(topic, [])
+        callbacks.append(callback)
+        if self.__task is None:
+            self.__task = asyncio.create_task(self.__run())
+        elif len(callbacks) == 1 and self.__client is not None:
+            asyncio.create_task(self.__subscribe(topic))
+
+    async def __subscribe(self, topic: str):
+        """Subscribe to a topic added while connected."""
+        try:
+            await self.__client.subscribe(topic)
+        except aiomqtt.MqttError as e:
+            logger.error("Error subscribing to topic %s: %s", topic, e)
+
+    async def __run(self):
+        """Keep the connection open and dispatch the messages, reconnect on errors."""
+        while True:
+            client = aiomqtt.Client(
+                hostname=self.hostname,
+                identifier="opensurplusmanager",
+                port=self.port,
+                username=self.username,
+                password=self.password,
+            )
+            try:
+                async with client:
+                    self.__client = client
+                    for topic in self.subscribers:
+                        await client.subscribe(topic)
+                    logger.info(
+                        "Connected to MQTT broker %s:%s", self.hostname, self.port
+                    )
+                    async for message in client.messages:
+                        for callback in self.subscribers.get(str(message.topic), ()):
+                            try:
+                                callback(message.payload)
+                            except Exception as e:  # pylint: disable=broad-except
+                                logger.error(
+                                    "Error handling message from %s: %s",
+                                    message.topic,
+                                    e,
+                                )
+            except aiomqtt.MqttError as e:
+                logger.error(
+                    "MQTT broker %s:%s error: %s. Reconnecting in %ss",
+                    self.hostname,
+                    self.port,
+                    e,
+                    MQTT_RECONNECT_INTERVAL,
+                )
+            finally:
+                self.__client = None
+            await asyncio.sleep(MQTT_RECONNECT_INTERVAL)
+
+    def close(self):
+        """Stop the connection."""
+        if self.__task is not None:
+            self.__task.cancel()
+            self.__task = None
+
+
+__mqtt_connections: Dict[Tuple, MqttConnection] = {}
+
+
+def acquire_mqtt_connection(
+    hostname: str,
+    port: int = 1883,
+    username: str | None = None,
+    password: str | None = None,
+) -> MqttConnection:
+    """
+    Get the shared connection to a MQTT broker, creating it if needed. Every call
+    must be paired with a call to `release_mqtt_connection`.
+
+    Parameters:
+        hostname (str): The hostname of the broker.
+        port (int): The port of the broker.
+        username (str | None): The username.
+        password (str | None): The password.
+
+    Returns:
+        MqttConnection: The shared connection.
+    """
+    key = (hostname, port, username, password)
+    connection = __mqtt_connections.get(key)
+    if connection is None:
+        connection = MqttConnection(hostname, port, username, password)
+        __mqtt_connections[key] = connection
+    connection.users += 1
+    return connection
+
+
+def release_mqtt_connection(
+    connection: MqttConnection, callbacks: List[Callable[[bytes], None]]
+):
+    """
+    Remove the callbacks of a subscriber and release a shared MQTT connection,
+    closing it if it is not used.
+
+    Parameters:
+        connection (MqttConnection): The connection.
+        callbacks (List[Callable[[bytes], None]]): The callbacks to remove.
+    """
+    for topic, subscribed in list(connection.subscribers.items()):
+        subscribed[:] = [c for c in subscribed if c not in callbacks]
+        if not subscribed:
+            del connection.subscribers[topic]
+    connection.users -= 1
+    if connection.users <= 0:
+        connection.close()
+        key = (
+            connection.hostname,
+            connection.port,
+            connection.username,
+            connection.password,
+        )
+        __mqtt_connections.pop(key, None)
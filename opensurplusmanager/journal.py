@@ -0,0 +1,481 @@
+"""
+Append-only binary journal of the inputs and decisions of the core.
+
+The journal is a directory of segment files. Every segment starts with a JSON
+header with the config and the runtime state of the core when it was created,
+followed by fixed size records written into a memory mapped file. When a segment
+is full a new one is created and the oldest segments are deleted.
+
+Run `python -m opensurplusmanager.journal --help` to decode, export or replay a
+journal.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import csv
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, NamedTuple, Tuple
+
+from opensurplusmanager.utils import logger
+
+if TYPE_CHECKING:
+    from opensurplusmanager.core import Core
+
+MAGIC = b"OSMJRNL1"
+# Magic, header length
+PREFIX = struct.Struct("<8sI")
+# Unix time, kind, success flag, device slot, value, cycle
+RECORD = struct.Struct("<dBBHdI4x")
+NO_DEVICE = 0xFFFF
+# Records kept free at the end of a segment for the current control cycle
+RESERVED_RECORDS = 256
+
+
+class RecordKind(IntEnum):
+    """Enumerate the kinds of journal records."""
+
+    SURPLUS = 1
+    CONSUMPTION = 2
+    CYCLE = 3
+    TURN_ON = 4
+    TURN_OFF = 5
+    REGULATE = 6
+    SURPLUS_MARGIN = 16
+    GRID_MARGIN = 17
+    IDLE_POWER = 18
+    POWERED = 19
+    ENABLED = 20
+    EXPECTED_CONSUMPTION = 21
+    MAX_CONSUMPTION = 22
+    COOLDOWN = 23
+    STALE = 24
+    REPORTED = 25
+    RECONCILE = 26
+
+
+# Attributes notified by the core that are journaled
+ATTRIBUTE_KINDS = {
+    "surplus_margin": RecordKind.SURPLUS_MARGIN,
+    "grid_margin": RecordKind.GRID_MARGIN,
+    "idle_power": RecordKind.IDLE_POWER,
+    "powered": RecordKind.POWERED,
+    "enabled": RecordKind.ENABLED,
+    "expected_consumption": RecordKind.EXPECTED_CONSUMPTION,
+    "max_consumption": RecordKind.MAX_CONSUMPTION,
+    "cooldown": RecordKind.COOLDOWN,
+    "stale": RecordKind.STALE,
+    "reported_powered": RecordKind.REPORTED,
+}
+COMMAND_KINDS = {
+    "turn_on": RecordKind.TURN_ON,
+    "turn_off": RecordKind.TURN_OFF,
+    "regulate": RecordKind.REGULATE,
+}
+
+
+class Record(NamedTuple):
+    """A decoded journal record."""
+
+    timestamp: float
+    kind: RecordKind
+    success: bool
+    device: str | None
+    value: float
+    cycle: int
+
+
+@dataclass
+class Journal:
+    """Writer of the journal, owned by the core."""
+
+    core: Core
+    path: str = "journal"
+    # Bytes of every segment file
+    segment_size: int = 4 * 1024 * 1024
+    # Segments kept, the oldest are deleted
+    max_segments: int = 16
+    __file: Any = field(init=False, default=None)
+    __map: mmap.mmap | None = field(init=False, default=None)
+    __offset: int = field(init=False, default=0)
+
+    def open(self):
+        """Create the journal directory and start a new segment."""
+        os.makedirs(self.path, exist_ok=True)
+        self.__rotate()
+        logger.info("Journal started on %s", self.path)
+
+    def rotate(self):
+        """
+        Start a new segment from the current state of the core, after it was
+        changed outside of the journaled records, e.g. restored from a snapshot.
+        """
+        if self.__map is not None:
+            self.__rotate()
+
+    def close(self):
+        """Flush and close the current segment."""
+        if self.__map is not None:
+            self.__close_segment()
+            logger.info("Journal closed")
+
+    def write(
+        self,
+        kind: RecordKind,
+        slot: int = NO_DEVICE,
+        value: float = 0,
+        success: bool = True,
+        cycle: int = 0,
+    ):
+        """
+        Append a record.
+
+        Parameters:
+            kind (RecordKind): The kind of the record.
+            slot (int): The slot of the device or NO_DEVICE.
+            value (float): The value of the record.
+            success (bool): Whether the command succeeded, for commands.
+            cycle (int): The control cycle of the record.
+        """
+        if self.__map is None:
+            return
+        # Segments are rotated before a surplus reading, the start of a control
+        # cycle, so every segment can be replayed from its header. The last
+        # records of a segment are reserved to finish the current cycle.
+        if self.__offset + RECORD.size > self.segment_size or (
+            kind == RecordKind.SURPLUS
+            and self.__offset + RESERVED_RECORDS * RECORD.size > self.segment_size
+        ):
+            self.__rotate()
+        RECORD.pack_into(
+            self.__map,
+            self.__offset,
+            time.time(),
+            kind,
+            success,
+            slot,
+            float(value) if value is not None else float("nan"),
+            cycle,
+        )
+        self.__offset += RECORD.size
+
+    def __rotate(self):
+        """Close the current segment, create a new one and delete the oldest."""
+        if self.__map is not None:
+            self.__close_segment()
+        name = os.path.join(self.path, f"{time.time_ns():020d}.jrnl")
+        header = json.dumps(self.__header()).encode()
+        header_size = PREFIX.size + len(header)
+        # Records start aligned to the record size
+        header_size += -header_size % RECORD.size
+        size = max(self.segment_size, header_size + RESERVED_RECORDS * RECORD.size)
+        self.__file = open(name, "w+b")  # pylint: disable=consider-using-with
+        self.__file.truncate(size)
+        self.__map = mmap.mmap(self.__file.fileno(), size)
+        PREFIX.pack_into(self.__map, 0, MAGIC, len(header))
+        self.__map[PREFIX.size : PREFIX.size + len(header)] = header
+        self.__offset = header_size
+        self.segment_size = size
+        segments = sorted(f for f in os.listdir(self.path) if f.endswith(".jrnl"))
+        for old in segments[: -self.max_segments]:
+            os.remove(os.path.join(self.path, old))
+
+    def __close_segment(self):
+        """Flush the current segment to the disk and unmap it."""
+        self.__map.flush()
+        self.__map.close()
+        self.__file.close()
+        self.__map = None
+
+    def __header(self) -> Dict[str, Any]:
+        """The config and the runtime state of the core for a new segment."""
+        core = self.core
+        state = core.state
+        return {
+            "created": time.time(),
+            "config": core.config,
+            "surplus": core.surplus,
+            "devices": list(state.names),
+            "powered": [bool(v) for v in state.powered],
+            "enabled": [bool(v) for v in state.enabled],
+            "consumption": list(state.consumption),
+            "reported": list(state.reported),
+        }
+
+
+def read_segment(path: str) -> Tuple[Dict[str, Any], Iterator[Record]]:
+    """
+    Read a segment file.
+
+    Parameters:
+        path (str): The path of the segment.
+
+    Returns:
+        Tuple[Dict[str, Any], Iterator[Record]]: The header and the records.
+
+    Raises:
+        ValueError: If the file is not a journal segment.
+    """
+    with open(path, "rb") as file:
+        data = file.read()
+    magic, header_length = PREFIX.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a journal segment")
+    header = json.loads(data[PREFIX.size : PREFIX.size + header_length])
+    offset = PREFIX.size + header_length
+    offset += -offset % RECORD.size
+    names = header["devices"]
+
+    def records() -> Iterator[Record]:
+        for timestamp, kind, success, slot, value, cycle in RECORD.iter_unpack(
+            data[offset : len(data) - (len(data) - offset) % RECORD.size]
+        ):
+            # The unused space of a segment is zeroed
+            if timestamp == 0:
+                return
+            device = names[slot] if slot != NO_DEVICE else None
+            yield Record(
+                timestamp, RecordKind(kind), bool(success), device, value, cycle
+            )
+
+    return header, records()
+
+
+def segments(path: str) -> List[str]:
+    """Get the segment files of a journal directory in chronological order."""
+    return sorted(
+        os.path.join(path, f) for f in os.listdir(path) if f.endswith(".jrnl")
+    )
+
+
+def read(path: str) -> Iterator[Tuple[Dict[str, Any], Record]]:
+    """
+    Read all the records of a journal directory.
+
+    Parameters:
+        path (str): The journal directory.
+
+    Returns:
+        Iterator[Tuple[Dict[str, Any], Record]]: The header of the segment and the
+        record, for every record.
+    """
+    for segment in segments(path):
+        header, records = read_segment(segment)
+        for record in records:
+            yield header, record
+
+
+Command = Tuple[str, str, float | None]
+
+
+class _ReplayIntegration:
+    """
+    Control integration that records the commands by cycle instead of sending
+    them.
+    """
+
+    def __init__(self, core: Core):
+        self.core = core
+        self.commands: Dict[int, List[Command]] = {}
+
+    def __add(self, command: Command):
+        self.commands.setdefault(self.core.cycle, []).append(command)
+
+    async def turn_on(self, device_name: str):
+        self.__add(("turn_on", device_name, None))
+
+    async def turn_off(self, device_name: str):
+        self.__add(("turn_off", device_name, None))
+
+    async def regulate(self, device_name: str, power: float):
+        self.__add(("regulate", device_name, power))
+
+
+async def replay(path: str) -> int:
+    """
+    Feed the inputs of a journal into a new core and compare its commands with the
+    journaled ones. Every segment is replayed from the state of its header.
+
+    The inputs are applied without running the control, a cycle runs where a
+    CYCLE record was journaled, so the readings the live core applied before a
+    cycle are all applied before the replayed one. The commands are compared by
+    cycle, a divergence never shifts the comparison of the next cycles. The
+    cooldowns are not timed, the journaled enabled changes are applied instead.
+    Reconciliation is not evaluated again either, it depends on the time since
+    the last command, the journaled reconciliations are applied at the start of
+    their cycle instead.
+
+    Parameters:
+        path (str): The journal directory.
+
+    Returns:
+        int: The number of commands that differ.
+    """
+    # pylint: disable=import-outside-toplevel
+    from opensurplusmanager.core import Core
+
+    mismatches = 0
+    for segment in segments(path):
+        header, records = read_segment(segment)
+        core = Core(auto_update=False)
+        core.config = json.loads(json.dumps(header["config"]))
+        core.config.pop("journal", None)
+        core.config.pop("storage", None)
+        core.config.pop("calibration", None)
+        core.config.pop("snapshot", None)
+        for device_config in core.config.get("devices", []):
+            # Cooldowns are replayed from the journaled enabled changes
+            device_config.pop("cooldown", None)
+        core.load_config()
+        core.save_config = lambda: None
+        integration = _ReplayIntegration(core)
+        for device in core.devices.values():
+            device.control_integration = integration
+        for slot, name in enumerate(header["devices"]):
+            device = core.get_device(name)
+            if device is not None:
+                device.powered = header["powered"][slot]
+                device.enabled = header["enabled"][slot]
+                device.consumption = header["consumption"][slot]
+                reported = header.get("reported", [])
+                if slot < len(reported) and reported[slot] >= 0:
+                    device.reported_powered = bool(reported[slot])
+        records = list(records)
+        reconciled: Dict[int, List[Record]] = {}
+        for record in records:
+            if record.kind == RecordKind.RECONCILE:
+                reconciled.setdefault(record.cycle, []).append(record)
+
+        def reconcile(core=core, reconciled=reconciled):
+            for record in reconciled.get(core.cycle, ()):
+                device = core.get_device(record.device)
+                if device is not None:
+                    core.reconcile_device(device, bool(record.value))
+
+        core.reconcile = reconcile
+        expected: Dict[int, List[Command]] = {}
+        for record in records:
+            device = core.get_device(record.device) if record.device else None
+            if record.kind == RecordKind.SURPLUS:
+                core.surplus = record.value
+            elif record.kind == RecordKind.CYCLE:
+                # The core counts the cycle when it starts it
+                core.cycle = record.cycle - 1
+                await core.run_cycle()
+            elif record.kind == RecordKind.CONSUMPTION and device is not None:
+                device.consumption = record.value
+            elif record.kind == RecordKind.ENABLED and device is not None:
+                device.enabled = bool(record.value)
+            elif record.kind == RecordKind.STALE and device is not None:
+                device.stale = bool(record.value)
+            elif record.kind == RecordKind.REPORTED and device is not None:
+                device.reported_powered = bool(record.value)
+            elif record.kind in (
+                RecordKind.TURN_ON,
+                RecordKind.TURN_OFF,
+                RecordKind.REGULATE,
+            ):
+                if record.success:
+                    value = record.value if record.kind == RecordKind.REGULATE else None
+                    expected.setdefault(record.cycle, []).append(
+                        (record.kind.name.lower(), record.device, value)
+                    )
+            elif record.kind in (
+                RecordKind.SURPLUS_MARGIN,
+                RecordKind.GRID_MARGIN,
+                RecordKind.IDLE_POWER,
+            ):
+                setattr(core, record.kind.name.lower(), record.value)
+            elif record.kind in (
+                RecordKind.EXPECTED_CONSUMPTION,
+                RecordKind.MAX_CONSUMPTION,
+            ):
+                if device is not None:
+                    setattr(device, record.kind.name.lower(), record.value)
+            # Let the tasks started by the input or the cycle run
+            while len(asyncio.all_tasks()) > 1:
+                await asyncio.sleep(0)
+        produced = integration.commands
+        name = os.path.basename(segment)
+        for cycle in sorted(expected.keys() | produced.keys()):
+            journaled = expected.get(cycle, [])
+            replayed = produced.get(cycle, [])
+            if journaled == replayed:
+                continue
+            mismatches += sum(
+                1
+                for index in range(max(len(journaled), len(replayed)))
+                if index >= len(journaled)
+                or index >= len(replayed)
+                or journaled[index] != replayed[index]
+            )
+            print(f"{name} cycle {cycle}: journal {journaled} replay {replayed}")
+        print(
+            f"{name}: {sum(map(len, expected.values()))} journaled commands, "
+            f"{sum(map(len, produced.values()))} replayed"
+        )
+    return mismatches
+
+
+def main(argv: List[str] | None = None) -> int:
+    """Command line interface to decode, export and replay a journal."""
+    parser = argparse.ArgumentParser(
+        prog="python -m opensurplusmanager.journal",
+        description="Decode, export and replay a decision journal.",
+    )
+    parser.add_argument("command", choices=("decode", "csv", "replay"))
+    parser.add_argument("path", help="journal directory")
+    parser.add_argument("--from", dest="since", type=float, help="Unix time")
+    parser.add_argument("--to", dest="until", type=float, help="Unix time")
+    parser.add_argument("--device", help="only records of this device")
+    parser.add_argument(
+        "--kind",
+        action="append",
+        choices=[kind.name.lower() for kind in RecordKind],
+        help="only records of this kind, can be repeated",
+    )
+    args = parser.parse_args(argv)
+
+    if args.command == "replay":
+        mismatches = asyncio.run(replay(args.path))
+        print(f"{mismatches} mismatches")
+        return 1 if mismatches else 0
+
+    kinds = {RecordKind[kind.upper()] for kind in args.kind} if args.kind else None
+    writer = csv.writer(sys.stdout) if args.command == "csv" else None
+    if writer is not None:
+        writer.writerow(["timestamp", "cycle", "kind", "device", "value", "success"])
+    for _, record in read(args.path):
+        if args.since is not None and record.timestamp < args.since:
+            continue
+        if args.until is not None and record.timestamp > args.until:
+            continue
+        if args.device is not None and record.device != args.device:
+            continue
+        if kinds is not None and record.kind not in kinds:
+            continue
+        row = [
+            record.timestamp,
+            record.cycle,
+            record.kind.name.lower(),
+            record.device or "",
+            record.value,
+            int(record.success),
+        ]
+        if writer is not None:
+            writer.writerow(row)
+        else:
+            print(*row, sep="\t")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
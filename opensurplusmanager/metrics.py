@@ -0,0 +1,273 @@
+"""
+Prometheus compatible metrics. Exports the registry and the metrics used by the
+package.
+
+Instruments are bound to their labels once with `labels()` and then updated with
+plain attribute arithmetic, the text exposition is only rendered when scraped.
+"""
+
+from __future__ import annotations
+
+from bisect import bisect_left
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, List, Tuple
+
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+def _escape(value: str) -> str:
+    """Escape a label value for the text exposition format."""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    """
+    Format a label set for the text exposition format.
+
+    Parameters:
+        names (Tuple[str, ...]): The label names.
+        values (Tuple[str, ...]): The label values.
+
+    Returns:
+        str: The label set between braces or an empty string if there are no labels.
+    """
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape(str(v))}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    """A monotonically increasing value."""
+
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        """Increase the counter."""
+        self.value += amount
+
+    def samples(self, name: str, labels: str) -> Iterable[str]:
+        """Yield the exposition lines of the counter."""
+        yield f"{name}{labels} {self.value}"
+
+
+class Gauge:
+    """A value that can go up and down."""
+
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value: float):
+        """Set the gauge to a value."""
+        self.value = value
+
+    def inc(self, amount: float = 1.0):
+        """Increase the gauge."""
+        self.value += amount
+
+    def samples(self, name: str, labels: str) -> Iterable[str]:
+        """Yield the exposition lines of the gauge."""
+        yield f"{name}{labels} {self.value}"
+
+
+class Histogram:
+    """Distribution of observed values in fixed buckets."""
+
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.bounds = bounds
+        # One count per bucket plus the +Inf bucket, not cumulative.
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        """Record an observation."""
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def samples(self, name: str, labels: str) -> Iterable[str]:
+        """Yield the exposition lines of the histogram."""
+        # The le label is appended to the label set of the child
+        prefix = labels[:-1] + "," if labels else "{"
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            yield f'{name}_bucket{prefix}le="{bound}"}} {cumulative}'
+        cumulative += self.counts[-1]
+        yield f'{name}_bucket{prefix}le="+Inf"}} {cumulative}'
+        yield f"{name}_sum{labels} {self.sum}"
+        yield f"{name}_count{labels} {cumulative}"
+
+
+@dataclass
+class MetricFamily:
+    """A metric with a name, a help text and one child per label set."""
+
+    name: str
+    documentation: str
+    metric_type: str
+    factory: Callable[[], Counter | Gauge | Histogram]
+    label_names: Tuple[str, ...] = ()
+    children: Dict[Tuple[str, ...], Tuple[str, Counter | Gauge | Histogram]] = field(
+        default_factory=dict
+    )
+
+    def labels(self, *values: str) -> Counter | Gauge | Histogram:
+        """
+        Get the child for a label set, creating it the first time. Call it once at
+        setup and keep the returned instrument for the hot path.
+
+        Parameters:
+            values (str): The label values, in the order of the label names.
+
+        Returns:
+            Counter | Gauge | Histogram: The instrument for the label set.
+        """
+        if len(values) != len(self.label_names):
+            raise ValueError(f"Expected labels {self.label_names} for {self.name}")
+        child = self.children.get(values)
+        if child is None:
+            child = (format_labels(self.label_names, values), self.factory())
+            self.children[values] = child
+        return child[1]
+
+    def remove(self, *values: str):
+        """Remove the child of a label set."""
+        self.children.pop(values, None)
+
+    def render(self) -> Iterable[str]:
+        """Yield the exposition lines of the family."""
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.metric_type}"
+        for labels, instrument in self.children.values():
+            yield from instrument.samples(self.name, labels)
+
+
+@dataclass
+class Registry:
+    """
+    Holds the metric families of the process and the collectors that produce
+    metrics from the current state when scraped.
+    """
+
+    families: List[MetricFamily] = field(default_factory=list)
+    collectors: List[Callable[[], Iterable[str]]] = field(default_factory=list)
+
+    def counter(
+        self, name: str, documentation: str, label_names: Tuple[str, ...] = ()
+    ) -> MetricFamily:
+        """Create and register a counter family."""
+        return self.__register(name, documentation, "counter", Counter, label_names)
+
+    def gauge(
+        self, name: str, documentation: str, label_names: Tuple[str, ...] = ()
+    ) -> MetricFamily:
+        """Create and register a gauge family."""
+        return self.__register(name, documentation, "gauge", Gauge, label_names)
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> MetricFamily:
+        """Create and register a histogram family."""
+        return self.__register(
+            name, documentation, "histogram", lambda: Histogram(buckets), label_names
+        )
+
+    def __register(self, name, documentation, metric_type, factory, label_names):
+        family = MetricFamily(name, documentation, metric_type, factory, label_names)
+        self.families.append(family)
+        return family
+
+    def add_collector(self, collector: Callable[[], Iterable[str]]):
+        """
+        Register a callable that yields exposition lines when the registry is
+        rendered.
+
+        Parameters:
+            collector (Callable[[], Iterable[str]]): The collector.
+        """
+        self.collectors.append(collector)
+
+    def remove_collector(self, collector: Callable[[], Iterable[str]]):
+        """Unregister a collector."""
+        if collector in self.collectors:
+            self.collectors.remove(collector)
+
+    def render(self) -> str:
+        """
+        Render all the metrics in the Prometheus text exposition format.
+
+        Returns:
+            str: The exposition.
+        """
+        lines = []
+        for family in self.families:
+            lines.extend(family.render())
+        for collector in self.collectors:
+            lines.extend(collector())
+        lines.append("")
+        return "\n".join(lines)
+
+
+registry = Registry()
+
+CYCLE_DURATION = registry.histogram(
+    "osm_cycle_duration_seconds",
+    "Duration of the control cycles by phase (plan or dispatch).",
+    ("phase",),
+)
+INTEGRATION_REQUEST_DURATION = registry.histogram(
+    "osm_integration_request_duration_seconds",
+    "Duration of the requests made by the integrations.",
+    ("integration",),
+)
+INTEGRATION_ERRORS = registry.counter(
+    "osm_integration_errors_total",
+    "Errors of the integrations (connection errors and invalid payloads).",
+    ("integration",),
+)
+READINGS = registry.counter(
+    "osm_readings_total",
+    "Consumption and surplus readings ingested by the integrations.",
+    ("integration",),
+)
+CONFIG_SAVES = registry.counter(
+    "osm_config_saves_total", "Number of times the config file was written."
+)
+EVENT_LOOP_LAG = registry.histogram(
+    "osm_event_loop_lag_seconds",
+    "Delay of the event loop running a callback after it was due.",
+)
+EVENT_LOOP_BLOCKED = registry.counter(
+    "osm_event_loop_blocked_total",
+    "Times a callback blocked the event loop longer than the slow threshold.",
+)
+BUS_EVENTS_DROPPED = registry.counter(
+    "osm_bus_events_dropped_total",
+    "Events of the internal bus dropped because a subscriber queue was full.",
+    ("subscriber",),
+)
@@ -3,13 +3,20 @@
 from __future__ import annotations
 
 import asyncio
+import time
 from enum import StrEnum
 from typing import TYPE_CHECKING
 
+from opensurplusmanager.bus import Reading
+from opensurplusmanager.control import PIDController
 from opensurplusmanager.exceptions import IntegrationConnectionError, InvalidDeviceType
+from opensurplusmanager.filters import FilterChain
+from opensurplusmanager.journal import RecordKind
+from opensurplusmanager.tracing import tracer
 from opensurplusmanager.utils import logger
 
 from .integration import ControlIntegration
+from .state import Command
 
 if TYPE_CHECKING:
     from opensurplusmanager.core import Core
@@ -23,21 +30,38 @@ class DeviceType(StrEnum):
 
 
 class Device:
-    """Model for a device."""
+    """
+    Model for a device. The runtime state (consumption, powered, enabled, cooldown
+    and last command) lives in the state table of the core, the device is a view
+    over its slot in the table.
+    """
+
+    __slots__ = (
+        "name",
+        "core",
+        "device_type",
+        "slot",
+        "control_integration",
+        "history_series",
+        "filters",
+        "controller",
+        "source",
+        "__state",
+        "__expected_consumption",
+        "__max_consumption",
+        "__cooldown",
+    )
 
     name: str
     core: Core
     device_type: DeviceType
-    expected_consumption: float
-    __expected_consumption: float
-    max_consumption: float
-    __max_consumption: float
-    cooldown: int
-    __cooldown: int
-    consumption: float = 0
-    powered: bool = False
-    enabled: bool = True
-    control_integration: ControlIntegration | None = None
+    slot: int
+    control_integration: ControlIntegration | None
+    history_series: str
+    filters: FilterChain | None
+    # Closed-loop power controller of a regulated device
+    controller: PIDController | None
+    source: str | None
 
     def __init__(
         self,
@@ -47,6 +71,10 @@ class Device:
         expected_consumption: float,
         max_consumption: float | None = None,
         cooldown: int | None = None,
+        filters: FilterChain | None = None,
+        source: str | None = None,
+        stale_after: float | None = None,
+        controller: PIDController | None = None,
     ):
         self.name = name
         self.core = core
@@ -54,6 +82,142 @@ class Device:
         self.__expected_consumption = expected_consumption
         self.__max_consumption = max_consumption
         self.__cooldown = cooldown
+        self.__state = core.state
+        self.slot = core.state.allocate(name)
+        self.control_integration = None
+        self.history_series = f"consumption.{name}"
+        self.filters = filters
+        self.controller = controller
+        self.source = source
+        self.__state.stale_after[self.slot] = stale_after or 0
+
+    @property
+    def consumption(self) -> float:
+        """Get the last consumption reading of the device."""
+        return self.__state.consumption[self.slot]
+
+    @consumption.setter
+    def consumption(self, value):
+        """
+        Set the consumption of the device. The reading goes through the filters of
+        the device if they are configured, rejected readings are ignored. Records it
+        in the history and the calibration and notifies the core if it changed.
+        """
+        if self.core.journal is not None:
+            self.core.journal.write(
+                RecordKind.CONSUMPTION, self.slot, value, cycle=self.core.cycle
+            )
+        if self.core.bus.subscribed(Reading):
+            self.core.bus.publish(Reading(self.name, value))
+        self.__state.raw_consumption[self.slot] = value
+        self.__state.updated_at[self.slot] = time.monotonic()
+        self.core.touch()
+        if self.__state.stale[self.slot]:
+            self.stale = False
+        if self.filters is not None:
+            value = self.filters.update(value)
+            if value is None:
+                logger.debug("Consumption reading of %s rejected", self.name)
+                return
+        self.core.record_reading(self.history_series, value)
+        if self.core.calibrator is not None:
+            self.core.calibrator.add_reading(self, value)
+        if value != self.__state.consumption[self.slot]:
+            self.__state.consumption[self.slot] = value
+            self.core.notify_device_change(self, "consumption")
+
+    @property
+    def raw_consumption(self) -> float:
+        """Get the last consumption reading of the device before filtering."""
+        return self.__state.raw_consumption[self.slot]
+
+    @property
+    def updated_at(self) -> float:
+        """time.monotonic() of the last consumption reading, 0 if there is none."""
+        return self.__state.updated_at[self.slot]
+
+    @property
+    def stale_after(self) -> float:
+        """Seconds after which the consumption is stale, 0 to never be stale."""
+        return self.__state.stale_after[self.slot]
+
+    @property
+    def stale(self) -> bool:
+        """
+        Whether the consumption reading is too old to be trusted. Updated by the
+        freshness check of the core and by every new reading.
+        """
+        return bool(self.__state.stale[self.slot])
+
+    @stale.setter
+    def stale(self, value):
+        """Set the stale state of the device. Notifies the core if it changed."""
+        if value != self.__state.stale[self.slot]:
+            self.__state.stale[self.slot] = value
+            self.core.notify_device_change(self, "stale")
+
+    @property
+    def powered(self) -> bool:
+        """Whether the device has been powered on by the core."""
+        return bool(self.__state.powered[self.slot])
+
+    @powered.setter
+    def powered(self, value):
+        """Set the powered state of the device. Notifies the core if it changed."""
+        if value != self.__state.powered[self.slot]:
+            self.__state.powered[self.slot] = value
+            self.core.notify_device_change(self, "powered")
+
+    @property
+    def reported_powered(self) -> bool | None:
+        """State read from the state entity of the device, None if there is none."""
+        reported = self.__state.reported[self.slot]
+        return None if reported < 0 else bool(reported)
+
+    @reported_powered.setter
+    def reported_powered(self, value: bool):
+        """
+        Set the state read from the state entity of the device. Notifies the core
+        if it changed.
+        """
+        if int(value) != self.__state.reported[self.slot]:
+            self.__state.reported[self.slot] = bool(value)
+            self.core.notify_device_change(self, "reported_powered")
+
+    @property
+    def state_mismatches(self) -> int:
+        """Times the powered state did not match the actual state of the device."""
+        return self.__state.mismatches[self.slot]
+
+    @property
+    def actual_powered(self) -> bool | None:
+        """
+        Actual state of the device: the reported state if there is a state entity,
+        otherwise inferred from the consumption if the core is configured to, None
+        if it is unknown.
+        """
+        reported = self.__state.reported[self.slot]
+        if reported >= 0:
+            return bool(reported)
+        if (
+            self.core.infer_state
+            and self.__state.updated_at[self.slot]
+            and not self.__state.stale[self.slot]
+        ):
+            return self.__state.consumption[self.slot] > self.core.idle_power
+        return None
+
+    @property
+    def enabled(self) -> bool:
+        """Whether the device can be controlled (it is not in cooldown)."""
+        return bool(self.__state.enabled[self.slot])
+
+    @enabled.setter
+    def enabled(self, value):
+        """Set the enabled state of the device. Notifies the core if it changed."""
+        if value != self.__state.enabled[self.slot]:
+            self.__state.enabled[self.slot] = value
+            self.core.notify_device_change(self, "enabled")
 
     @property
     def max_consumption(self) -> float:
@@ -65,6 +229,7 @@ class Device:
         """Set the maximum consumption of the device. Will also update the config."""
         logger.info("Setting max consumption for device %s to %s", self.name, value)
         self.__max_consumption = value
+        self.core.notify_device_change(self, "max_consumption")
         device_config = self.core.config.get("devices", [])
         for device in device_config:
             if device["name"] == self.name:
@@ -84,6 +249,7 @@ class Device:
             "Setting expected consumption for device %s to %s", self.name, value
         )
         self.__expected_consumption = value
+        self.core.notify_device_change(self, "expected_consumption")
         device_config = self.core.config.get("devices", [])
         for device in device_config:
             if device["name"] == self.name:
@@ -101,6 +267,7 @@ class Device:
         """Set the cooldown of the device. Will also update the config."""
         logger.info("Setting cooldown for device %s to %s", self.name, value)
         self.__cooldown = value
+        self.core.notify_device_change(self, "cooldown")
         device_config = self.core.config.get("devices", [])
         for device in device_config:
             if device["name"] == self.name:
@@ -108,6 +275,16 @@ class Device:
                 self.core.save_config()
                 break
 
+    @property
+    def cooldown_until(self) -> float:
+        """time.monotonic() deadline of the current cooldown, 0 if there is none."""
+        return self.__state.cooldown_until[self.slot]
+
+    @property
+    def last_command(self) -> Command:
+        """The last command successfully sent to the device."""
+        return Command(self.__state.last_command[self.slot])
+
     async def turn_on(self):
         """
         Turn on the device. Will call the turn_on method of the control integration.
@@ -117,10 +294,15 @@ class Device:
         """
         logger.info("Turning on device %s", self.name)
         try:
-            await self.control_integration.turn_on(device_name=self.name)
+            with tracer.span("turn_on", self.core.trace_lane, self.name):
+                await self.control_integration.turn_on(device_name=self.name)
         except Exception as e:
             logger.error("Error turning on device %s: %s", self.name, e)
+            self.core.record_action(self.name, "turn_on", None, False)
             raise IntegrationConnectionError() from e
+        self.core.record_action(self.name, "turn_on", None, True)
+        self.__state.last_command[self.slot] = Command.TURN_ON
+        self.__state.commanded_at[self.slot] = time.monotonic()
         self.powered = True
         asyncio.create_task(self.__start_cooldown())
 
@@ -133,11 +315,18 @@ class Device:
         """
         logger.info("Turning off device %s", self.name)
         try:
-            await self.control_integration.turn_off(device_name=self.name)
+            with tracer.span("turn_off", self.core.trace_lane, self.name):
+                await self.control_integration.turn_off(device_name=self.name)
         except Exception as e:
             logger.error("Error turning off device %s: %s", self.name, e)
+            self.core.record_action(self.name, "turn_off", None, False)
             raise IntegrationConnectionError() from e
+        self.core.record_action(self.name, "turn_off", None, True)
+        self.__state.last_command[self.slot] = Command.TURN_OFF
+        self.__state.commanded_at[self.slot] = time.monotonic()
         self.powered = False
+        if self.controller is not None:
+            self.controller.reset()
         asyncio.create_task(self.__start_cooldown())
 
     async def regulate(self, power: float):
@@ -156,18 +345,44 @@ class Device:
 
         logger.info("Regulating device %s to %s", self.name, power)
         try:
-            await self.control_integration.regulate(device_name=self.name, power=power)
+            with tracer.span("regulate", self.core.trace_lane, self.name):
+                await self.control_integration.regulate(
+                    device_name=self.name, power=power
+                )
         except Exception as e:
             logger.error("Error regulating device %s: %s", self.name, e)
+            self.core.record_action(self.name, "regulate", power, False)
             raise IntegrationConnectionError() from e
+        self.core.record_action(self.name, "regulate", power, True)
+        self.__state.last_command[self.slot] = Command.REGULATE
+        self.__state.last_power[self.slot] = power
 
-    async def __start_cooldown(self):
+    def resume_cooldown(self, remaining: float):
+        """
+        Resume a cooldown that was pending when the application stopped.
+
+        Parameters:
+            remaining (float): Seconds left of the cooldown.
+        """
+        # Disabled right away so the state restored with it is consistent
+        self.__state.cooldown_until[self.slot] = time.monotonic() + remaining
+        self.enabled = False
+        asyncio.create_task(self.__start_cooldown(remaining))
+
+    async def __start_cooldown(self, duration: float | None = None):
         """
         Starts the device cooldown because some devices requires some time
         before they can be turned on or off again.
+
+        Parameters:
+            duration (float | None): Seconds of the cooldown, the configured
+            cooldown if None.
         """
-        if self.cooldown:
+        duration = self.cooldown if duration is None else duration
+        if duration:
             logger.info("Starting cooldown for device %s", self.name)
+            self.__state.cooldown_until[self.slot] = time.monotonic() + duration
             self.enabled = False
-            await asyncio.sleep(self.cooldown)
+            await asyncio.sleep(duration)
+            self.__state.cooldown_until[self.slot] = 0
             self.enabled = True
@@ -5,11 +5,53 @@ from __future__ import annotations
 from abc import ABC
 from dataclasses import dataclass
 from enum import Enum
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Dict
 
 if TYPE_CHECKING:
     from .device import Device
 
+# Keys of an entity config used by the core instead of the integration
+CORE_ENTITY_KEYS = ("filters", "stale_after")
+# Payloads of a state entity, compared in lower case
+ON_STATES = ("on", "true", "yes")
+OFF_STATES = ("off", "false", "no")
+
+
+def entity_kwargs(config: Dict) -> Dict:
+    """
+    Get the keyword arguments to build an integration entity from its config,
+    without the keys handled by the core.
+
+    Parameters:
+    config (Dict): The entity config.
+
+    Returns:
+    Dict: The config without the core keys.
+    """
+    return {key: value for key, value in config.items() if key not in CORE_ENTITY_KEYS}
+
+
+def parse_state(payload: str) -> bool:
+    """
+    Parse the payload of a state entity.
+
+    Parameters:
+    payload (str): "on", "true", "yes", "off", "false", "no" in any case, or a
+    number that is on when it is not 0.
+
+    Returns:
+    bool: True if the device is on.
+
+    Raises:
+    ValueError: If the payload is not a valid state.
+    """
+    payload = payload.strip().lower()
+    if payload in ON_STATES:
+        return True
+    if payload in OFF_STATES:
+        return False
+    return float(payload) != 0
+
 
 @dataclass
 class ControlEntity(ABC):
@@ -28,6 +70,10 @@ class ConsumptionType(Enum):
 
     SURPLUS = 1
     DEVICE = 2
+    # Actual on/off state of a device
+    STATE = 3
+    # Input of the derived entities
+    INPUT = 4
 
 
 @dataclass
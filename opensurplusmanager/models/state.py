@@ -0,0 +1,79 @@
+"""Array backed table with the runtime state of the devices."""
+
+from __future__ import annotations
+
+from array import array
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import List
+
+
+class Command(IntEnum):
+    """Enumerate the commands that can be sent to a device."""
+
+    NONE = 0
+    TURN_ON = 1
+    TURN_OFF = 2
+    REGULATE = 3
+
+
+@dataclass
+class DeviceStateTable:
+    """
+    Runtime state of all the devices of a core stored column by column. Every
+    device owns a slot, the index of its row in every column, and `Device` reads and
+    writes its state through it. Planners, snapshots and the API can read whole
+    columns instead of walking the device objects.
+    """
+
+    names: List[str] = field(default_factory=list)
+    consumption: array = field(default_factory=lambda: array("d"))
+    # Last consumption reading before filtering
+    raw_consumption: array = field(default_factory=lambda: array("d"))
+    powered: array = field(default_factory=lambda: array("b"))
+    enabled: array = field(default_factory=lambda: array("b"))
+    # time.monotonic() deadline of the current cooldown, 0 if there is none
+    cooldown_until: array = field(default_factory=lambda: array("d"))
+    last_command: array = field(default_factory=lambda: array("b"))
+    # Power of the last regulate command
+    last_power: array = field(default_factory=lambda: array("d"))
+    # time.monotonic() of the last consumption reading, 0 if there is none
+    updated_at: array = field(default_factory=lambda: array("d"))
+    # Seconds after which the consumption is stale, 0 to never be stale
+    stale_after: array = field(default_factory=lambda: array("d"))
+    stale: array = field(default_factory=lambda: array("b"))
+    # State read from the state entity of the device, 1 on, 0 off, -1 unknown
+    reported: array = field(default_factory=lambda: array("b"))
+    # time.monotonic() of the last turn on or turn off command, 0 if there is none
+    commanded_at: array = field(default_factory=lambda: array("d"))
+    # Times the powered state did not match the actual state of the device
+    mismatches: array = field(default_factory=lambda: array("Q"))
+
+    def allocate(self, name: str) -> int:
+        """
+        Add a row for a new device with the initial state.
+
+        Parameters:
+        name (str): The name of the device.
+
+        Returns:
+        int: The slot of the device.
+        """
+        self.names.append(name)
+        self.consumption.append(0)
+        self.raw_consumption.append(0)
+        self.powered.append(False)
+        self.enabled.append(True)
+        self.cooldown_until.append(0)
+        self.last_command.append(Command.NONE)
+        self.last_power.append(0)
+        self.updated_at.append(0)
+        self.stale_after.append(0)
+        self.stale.append(False)
+        self.reported.append(-1)
+        self.commanded_at.append(0)
+        self.mismatches.append(0)
+        return len(self.names) - 1
+
+    def __len__(self) -> int:
+        return len(self.names)
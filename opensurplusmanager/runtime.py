@@ -0,0 +1,160 @@
+"""
+Event loop of the application: loop selection, shutdown and lag monitoring.
+
+The loop implementation is chosen with the EVENT_LOOP environment variable:
+"auto" (the default) uses uvloop when it is installed, "uvloop" requires it and
+"asyncio" always uses the standard loop.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+from dataclasses import dataclass, field
+from typing import Any, Callable, Coroutine
+
+from opensurplusmanager.metrics import EVENT_LOOP_BLOCKED, EVENT_LOOP_LAG
+from opensurplusmanager.utils import logger
+
+# Frames of the blocked code written in the slow callback logs
+STACK_LIMIT = 8
+
+LOOP_LAG = EVENT_LOOP_LAG.labels()
+LOOP_BLOCKED = EVENT_LOOP_BLOCKED.labels()
+
+
+def loop_factory() -> Callable[[], asyncio.AbstractEventLoop]:
+    """
+    Get the factory of the event loop selected with EVENT_LOOP.
+
+    Returns:
+        Callable[[], asyncio.AbstractEventLoop]: The loop factory.
+
+    Raises:
+        ValueError: If EVENT_LOOP is not valid.
+        ImportError: If EVENT_LOOP is "uvloop" and it is not installed.
+    """
+    selected = os.getenv("EVENT_LOOP", "auto").lower()
+    if selected not in ("auto", "uvloop", "asyncio"):
+        raise ValueError("EVENT_LOOP must be auto, uvloop or asyncio")
+    if selected != "asyncio":
+        try:
+            import uvloop  # pylint: disable=import-outside-toplevel
+
+            return uvloop.new_event_loop
+        except ImportError:
+            if selected == "uvloop":
+                raise
+    return asyncio.new_event_loop
+
+
+def run(main: Callable[[], Coroutine[Any, Any, Any]]) -> Any:
+    """
+    Run a coroutine function in the selected event loop.
+
+    Parameters:
+        main (Callable[[], Coroutine[Any, Any, Any]]): The coroutine function.
+
+    Returns:
+        Any: The result of the coroutine.
+    """
+    factory = loop_factory()
+    logger.info("Using %s event loop", factory.__module__.split(".")[0])
+    with asyncio.Runner(loop_factory=factory) as runner:
+        return runner.run(main())
+
+
+def shutdown_event() -> asyncio.Event:
+    """
+    Create an event that is set when the process receives SIGINT or SIGTERM.
+    Must be called from the running loop.
+
+    Returns:
+        asyncio.Event: The event.
+    """
+    event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signal_number, event.set)
+        except (NotImplementedError, RuntimeError):
+            # Not supported on this platform, KeyboardInterrupt is raised instead
+            pass
+    return event
+
+
+@dataclass
+class LoopMonitor:
+    """
+    Measures the scheduling delay of the event loop. A task sleeps `interval`
+    seconds and records how late it wakes up in a histogram. A watchdog thread
+    logs the task and the code that blocks the loop when the task has not woken up
+    `slow_threshold` seconds after it was due.
+    """
+
+    # Seconds between measures
+    interval: float = 0.5
+    # Seconds of delay logged as a slow callback, 0 to disable the watchdog
+    slow_threshold: float = 0.1
+    __loop: asyncio.AbstractEventLoop | None = field(init=False, default=None)
+    __loop_thread: int = field(init=False, default=0)
+    # time.monotonic() when the monitor task is due to wake up
+    __due: float = field(init=False, default=0)
+    __stopped: threading.Event = field(init=False, default_factory=threading.Event)
+    __task: asyncio.Task | None = field(init=False, default=None)
+
+    def start(self):
+        """Start measuring the running loop."""
+        self.__loop = asyncio.get_running_loop()
+        self.__loop_thread = threading.get_ident()
+        self.__task = asyncio.create_task(self.__measure(), name="loop-monitor")
+        if self.slow_threshold > 0:
+            threading.Thread(
+                target=self.__watch, name="loop-watchdog", daemon=True
+            ).start()
+
+    async def __measure(self):
+        """Indefinitely measures how late the loop runs a timer."""
+        while True:
+            self.__due = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(time.monotonic() - self.__due, 0)
+            LOOP_LAG.observe(lag)
+            if self.slow_threshold and lag > self.slow_threshold:
+                logger.warning("Event loop lag of %.3fs", lag)
+
+    def __watch(self):
+        """Watchdog thread, logs what the loop is running while it is blocked."""
+        reported = 0.0
+        while not self.__stopped.wait(self.slow_threshold / 2):
+            due = self.__due
+            blocked = time.monotonic() - due
+            if not due or blocked < self.slow_threshold or due == reported:
+                continue
+            reported = due
+            LOOP_BLOCKED.inc()
+            task = asyncio.current_task(self.__loop)
+            frame = sys._current_frames().get(  # pylint: disable=protected-access
+                self.__loop_thread
+            )
+            if frame is None:
+                continue
+            stack = "".join(traceback.format_stack(frame, limit=STACK_LIMIT))
+            logger.warning(
+                "Event loop blocked for %.3fs by task %s:\n%s",
+                blocked,
+                task.get_name() if task is not None else None,
+                stack.rstrip(),
+            )
+
+    def stop(self):
+        """Stop the measures and the watchdog."""
+        self.__stopped.set()
+        if self.__task is not None:
+            self.__task.cancel()
+            self.__task = None
@@ -0,0 +1,396 @@
+"""
+Shadow planners, to see what other settings or strategies would have done with
+the live data before changing them.
+
+A shadow planner runs the same planning as the core on the surplus of every
+control cycle, with its own `surplus_margin`, `grid_margin`, `idle_power` and
+strategy, but never sends a command. It keeps a simulated powered state, power
+and cooldown for every device instead. The power of the rest of the house is the
+same for all the planners, the live surplus plus the consumption of the devices,
+so the surplus a shadow planner sees is that power minus the estimated
+consumption of its devices:
+
+- A device in the same state in the shadow and live planners consumes what is
+  measured.
+- A switch that is only on in the shadow planner consumes its expected
+  consumption, and a regulated device the power it was set to.
+- A device that is only on in the live planner consumes nothing.
+
+The shadow planners regulate like the devices without a controller. They run in
+their own task after the live cycle has finished, never inside it. When they fall
+behind they skip to the latest cycle, the time between the cycles they evaluate
+is still accounted.
+
+For every planner, the live one included, the estimated self-consumption (energy
+of the devices covered by the surplus), grid import and commands sent are
+accumulated and served by the API side by side.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import math
+import time
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Dict, List
+
+from opensurplusmanager.bus import COALESCE, CommandResult, Decision
+from opensurplusmanager.models.device import DeviceType
+from opensurplusmanager.utils import logger
+
+if TYPE_CHECKING:
+    from opensurplusmanager.core import Core
+    from opensurplusmanager.models.device import Device
+
+# "priority" plans like the core, in the order of the devices in the config.
+# "largest_first" turns on the devices with the largest expected consumption first
+# and turns them off last.
+STRATEGIES = ("priority", "largest_first")
+LIVE = "live"
+# Pending live commands counted between two evaluated cycles
+MAX_PENDING_COMMANDS = 10000
+
+
+@dataclass
+class PlanStatistics:
+    """Estimated outcome of a planner since it started."""
+
+    cycles: int = 0
+    commands: int = 0
+    # Energy of the devices covered by the surplus, in Wh
+    self_consumption: float = 0.0
+    # Energy imported from the grid, in Wh
+    grid_import: float = 0.0
+
+    def add_interval(self, available: float, load: float, duration: float):
+        """
+        Account the energy of an interval between two cycles.
+
+        Parameters:
+        available (float): Power left for the devices by the rest of the house,
+        negative if the house alone imports from the grid.
+        load (float): Consumption of the devices.
+        duration (float): Seconds of the interval.
+        """
+        hours = duration / 3600
+        self.self_consumption += min(load, max(available, 0.0)) * hours
+        self.grid_import += max(load - available, 0.0) * hours
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Get the statistics as a dict.
+
+        Returns:
+        Dict[str, Any]: The statistics.
+        """
+        return {
+            "cycles": self.cycles,
+            "commands": self.commands,
+            "self_consumption_wh": round(self.self_consumption, 3),
+            "grid_import_wh": round(self.grid_import, 3),
+        }
+
+
+@dataclass
+class ShadowPlanner:
+    """
+    A planner evaluated on the live data without actuating. The settings that are
+    None follow the current value of the core.
+    """
+
+    core: Core
+    name: str
+    surplus_margin: float | None = None
+    grid_margin: float | None = None
+    idle_power: float | None = None
+    strategy: str = "priority"
+    statistics: PlanStatistics = field(default_factory=PlanStatistics)
+    # Simulated state of the devices, indexed by their slot
+    __powered: List[bool] = field(init=False, default_factory=list)
+    # Power a regulated device was set to
+    __power: List[float] = field(init=False, default_factory=list)
+    __cooldown_until: List[float] = field(init=False, default_factory=list)
+    # Estimated consumption of the devices in the current cycle
+    __load: List[float] = field(init=False, default_factory=list)
+    __last_available: float = field(init=False, default=0.0)
+    __last_load: float = field(init=False, default=0.0)
+    __last_time: float | None = field(init=False, default=None)
+
+    def __post_init__(self):
+        if self.strategy not in STRATEGIES:
+            raise ValueError(
+                f"Shadow planner {self.name} strategy must be one of "
+                f"{', '.join(STRATEGIES)}"
+            )
+
+    def settings(self) -> Dict[str, Any]:
+        """
+        Get the settings the planner uses.
+
+        Returns:
+        Dict[str, Any]: The margins, idle power and strategy.
+        """
+        return {
+            "surplus_margin": self.__setting("surplus_margin"),
+            "grid_margin": self.__setting("grid_margin"),
+            "idle_power": self.__setting("idle_power"),
+            "strategy": self.strategy,
+        }
+
+    def __setting(self, name: str) -> float:
+        value = getattr(self, name)
+        return getattr(self.core, name) if value is None else value
+
+    def reset(self):
+        """Start again from the live state of the devices."""
+        state = self.core.state
+        count = len(self.core.devices)
+        self.__powered = [bool(state.powered[slot]) for slot in range(count)]
+        self.__power = [state.last_power[slot] for slot in range(count)]
+        self.__cooldown_until = [state.cooldown_until[slot] for slot in range(count)]
+        self.__load = [0.0] * count
+        self.__last_time = None
+        self.statistics = PlanStatistics()
+
+    def step(self, available: float, now: float):
+        """
+        Plan a control cycle on the simulated state.
+
+        Parameters:
+        available (float): Power left for the devices by the rest of the house.
+        now (float): time.monotonic() of the cycle.
+        """
+        if self.__last_time is None:
+            self.reset()
+        if self.__last_time is not None:
+            self.statistics.add_interval(
+                self.__last_available, self.__last_load, now - self.__last_time
+            )
+        self.statistics.cycles += 1
+        devices = list(self.core.devices.values())
+        surplus = available - self.__estimate(devices)
+        if self.strategy == "largest_first":
+            devices.sort(key=lambda device: device.expected_consumption, reverse=True)
+        if surplus > 0:
+            self.__turn_on_priority(devices, surplus, now)
+        elif surplus < -self.__setting("grid_margin"):
+            self.__turn_off_priority(
+                reversed(devices), self.__setting("surplus_margin") - surplus, now
+            )
+        # Held until the next cycle
+        self.__last_available = available
+        self.__last_load = sum(self.__load)
+        self.__last_time = now
+
+    def __estimate(self, devices: List[Device]) -> float:
+        """Estimate the consumption of every device, returns the total."""
+        state = self.core.state
+        load = self.__load
+        for device in devices:
+            slot = device.slot
+            powered = self.__powered[slot]
+            if powered == bool(state.powered[slot]) and (
+                not powered or device.device_type == DeviceType.SWITCH
+            ):
+                load[slot] = state.consumption[slot]
+            elif not powered:
+                load[slot] = 0.0
+            elif device.device_type == DeviceType.SWITCH:
+                load[slot] = device.expected_consumption
+            else:
+                load[slot] = self.__power[slot]
+        return sum(load)
+
+    def __switch(self, device: Device, powered: bool, now: float):
+        """Simulate a turn on or turn off command."""
+        slot = device.slot
+        self.__powered[slot] = powered
+        self.__load[slot] = device.expected_consumption if powered else 0.0
+        if device.cooldown:
+            self.__cooldown_until[slot] = now + device.cooldown
+        self.statistics.commands += 1
+
+    def __regulate(self, device: Device, power: float):
+        """Simulate a regulate command."""
+        self.__power[device.slot] = power
+        self.__load[device.slot] = power
+        self.statistics.commands += 1
+
+    def __turn_on_priority(self, devices: List[Device], available: float, now: float):
+        """Turn on or regulate devices in order, like the core."""
+        idle_power = self.__setting("idle_power")
+        for device in devices:
+            slot = device.slot
+            if self.__cooldown_until[slot] > now:
+                continue
+            powered = self.__powered[slot]
+            expected = device.expected_consumption
+            if device.device_type == DeviceType.SWITCH:
+                if expected < available and not powered:
+                    self.__switch(device, True, now)
+                    available -= expected
+                continue
+            high = device.max_consumption
+            if high is None:
+                high = math.inf
+            if expected < available and not powered:
+                self.__switch(device, True, now)
+                power = min(high, available)
+                self.__regulate(device, power)
+                available -= power
+            elif powered and self.__load[slot] > idle_power:
+                consumption = self.__load[slot]
+                power = min(high, consumption + available)
+                self.__regulate(device, power)
+                available -= power - consumption
+
+    def __turn_off_priority(self, devices, exceeded: float, now: float):
+        """Turn off or regulate devices in reverse order, like the core."""
+        idle_power = self.__setting("idle_power")
+        for device in devices:
+            slot = device.slot
+            if self.__cooldown_until[slot] > now:
+                continue
+            consumption = self.__load[slot]
+            if self.__powered[slot] and consumption > idle_power:
+                if device.device_type == DeviceType.SWITCH:
+                    self.__switch(device, False, now)
+                    exceeded -= device.expected_consumption
+                elif exceeded > consumption - device.expected_consumption:
+                    self.__switch(device, False, now)
+                    exceeded -= device.expected_consumption
+                else:
+                    self.__regulate(device, consumption - exceeded)
+                    break
+            if exceeded < 0:
+                break
+
+
+@dataclass
+class ShadowPlanners:
+    """Runs the shadow planners of a core and the statistics of the live one."""
+
+    core: Core
+    planners: List[ShadowPlanner] = field(default_factory=list)
+    live: PlanStatistics = field(default_factory=PlanStatistics)
+    __last_available: float = field(init=False, default=0.0)
+    __last_load: float = field(init=False, default=0.0)
+    __last_time: float | None = field(init=False, default=None)
+
+    @classmethod
+    def from_config(cls, core: Core, config: List[Dict[str, Any]]) -> ShadowPlanners:
+        """
+        Build the shadow planners from the `shadows` config, a list of planners
+        with a name and the settings that differ from the core, for example
+        [{"name": "wide", "surplus_margin": 300, "strategy": "largest_first"}].
+
+        Parameters:
+        core (Core): The core.
+        config (List[Dict[str, Any]]): The shadow planners config.
+
+        Returns:
+        ShadowPlanners: The shadow planners.
+
+        Raises:
+        ValueError: If a planner is not valid or its name is repeated.
+        """
+        planners = []
+        names = {LIVE}
+        for planner_config in config:
+            name = planner_config.get("name")
+            if name is None or name in names:
+                raise ValueError(f"Shadow planner name {name} is missing or repeated")
+            names.add(name)
+            try:
+                planners.append(ShadowPlanner(core=core, **planner_config))
+            except TypeError as e:
+                raise ValueError(f"Invalid shadow planner {name}: {e}") from e
+        return cls(core=core, planners=planners)
+
+    def account_live(self, now: float) -> float:
+        """
+        Account the live planner since the previous evaluation.
+
+        Parameters:
+        now (float): time.monotonic() of the evaluation.
+
+        Returns:
+        float: Power left for the devices by the rest of the house.
+        """
+        core = self.core
+        load = sum(core.state.consumption)
+        available = core.surplus + load
+        if self.__last_time is not None:
+            self.live.add_interval(
+                self.__last_available, self.__last_load, now - self.__last_time
+            )
+        self.live.cycles += 1
+        self.__last_available = available
+        self.__last_load = load
+        self.__last_time = now
+        return available
+
+    async def step(self, now: float):
+        """
+        Evaluate the live state of the core in every planner, yielding between
+        them so a pending live cycle waits for one planner at most.
+
+        Parameters:
+        now (float): time.monotonic() of the evaluation.
+        """
+        available = self.account_live(now)
+        for planner in self.planners:
+            planner.step(available, now)
+            await asyncio.sleep(0)
+
+    def state(self) -> Dict[str, Any]:
+        """
+        Get the statistics of the live and shadow planners.
+
+        Returns:
+        Dict[str, Any]: The settings and statistics by planner name.
+        """
+        core = self.core
+        result = {
+            LIVE: {
+                "settings": {
+                    "surplus_margin": core.surplus_margin,
+                    "grid_margin": core.grid_margin,
+                    "idle_power": core.idle_power,
+                    "strategy": "priority",
+                },
+                "statistics": self.live.to_dict(),
+            }
+        }
+        for planner in self.planners:
+            result[planner.name] = {
+                "settings": planner.settings(),
+                "statistics": planner.statistics.to_dict(),
+            }
+        return result
+
+    async def run(self):
+        """
+        Indefinitely evaluates the planners after every live control cycle. Only the
+        last finished cycle is kept pending, so the planners skip the cycles they
+        could not keep up with.
+        """
+        bus = self.core.bus
+        decisions = bus.subscribe(Decision, maxsize=1, overflow=COALESCE, name="shadow")
+        commands = bus.subscribe(
+            CommandResult, maxsize=MAX_PENDING_COMMANDS, name="shadow_commands"
+        )
+        dropped = 0
+        logger.info("Running %s shadow planners", len(self.planners))
+        try:
+            async for _ in decisions:
+                while len(commands):
+                    commands.get_nowait()
+                    self.live.commands += 1
+                # Commands lost while the queue was full were sent anyway
+                self.live.commands += commands.dropped - dropped
+                dropped = commands.dropped
+                await self.step(time.monotonic())
+        finally:
+            decisions.close()
+            commands.close()
@@ -0,0 +1,983 @@
+"""
+Simulator of a farm of devices and of the solar production, to test the whole
+application at scale on one machine without real hardware or network.
+
+It serves over HTTP, with a configurable latency and error rate:
+
+- `GET /<device>/consumption` and `GET /<device>/state` for `http_get`.
+- `POST /<device>/switch` ({"state": "on"}) and `POST /<device>/regulate`
+  ({"power": 1000}) for `http_post`.
+- `GET /surplus_production` with the surplus, production minus the base load of
+  the house minus the consumption of the devices.
+- `GET /status` with a summary of the simulation.
+
+The devices reach the commanded power with a first-order lag, like a real heater or
+charger. A fraction of them publishes its consumption to `sim/<device>/consumption`
+through a minimal MQTT 3.1.1 broker (QoS 0, no retained messages nor sessions)
+running in the same process, for `mqtt_sub`.
+
+A minimal Modbus TCP server serves the input and holding registers of unit 1
+for `modbus_tcp`, every value as a big endian float32 over two registers: the
+surplus at 0, the production at 2 and the consumption of the n-th device at
+2 * (n + 1).
+
+The production follows a surplus profile over a simulated day that runs `speed`
+times faster than real time: "sunny" is a clear sky and "clouds" adds passing
+clouds that cut the production for some minutes.
+
+Generate a matching config and run the simulator:
+
+    python -m opensurplusmanager.simulator --devices 1000 --write-config config.yaml
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import math
+import random
+import struct
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Set, Tuple
+
+import yaml
+from aiohttp import web
+
+from opensurplusmanager.utils import json_loads, logger
+
+PROFILES = ("sunny", "clouds")
+SWITCH = "switch"
+REGULATED = "regulated"
+# Every REGULATED_EVERY-th device is regulated, the others are switches
+REGULATED_EVERY = 5
+MQTT_TOPIC = "sim/{name}/consumption"
+# Modbus registers of the surplus and the production, the devices follow
+MODBUS_SURPLUS = 0
+MODBUS_PRODUCTION = 2
+MODBUS_UNIT = 1
+# Modbus TCP header: transaction id, protocol id, length, unit id
+MBAP = struct.Struct(">HHHB")
+# Modbus exception codes
+ILLEGAL_FUNCTION = 1
+ILLEGAL_ADDRESS = 2
+ILLEGAL_VALUE = 3
+GATEWAY_TARGET_FAILED = 11
+
+# MQTT control packet types
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+
+@dataclass(slots=True)
+class SimulatedDevice:
+    """A device with its physical state."""
+
+    name: str
+    type: str
+    # Consumption when switched on, or the maximum of a regulated device
+    power: float
+    powered: bool = False
+    # Power the device is moving towards
+    target: float = 0.0
+    consumption: float = 0.0
+    # Power set by the last regulate command, the full power if never regulated
+    regulated: float | None = None
+    mqtt: bool = False
+
+
+def solar_production(hour: float, peak: float) -> float:
+    """
+    Clear sky production of a day with sunrise at 6:00 and sunset at 20:00.
+
+    Parameters:
+    hour (float): Hour of the day, 0 to 24.
+    peak (float): Production at solar noon in watts.
+
+    Returns:
+    float: The production in watts.
+    """
+    if not 6 < hour < 20:
+        return 0.0
+    return peak * math.sin(math.pi * (hour - 6) / 14) ** 1.5
+
+
+@dataclass
+class Simulation:
+    """The devices, the production and the house of the simulation."""
+
+    devices: Dict[str, SimulatedDevice]
+    profile: str = "sunny"
+    # Production at solar noon in watts
+    peak: float = 5000.0
+    # Consumption of the rest of the house in watts
+    base_load: float = 300.0
+    # Seconds to reach 63% of a new power
+    lag: float = 5.0
+    # Simulated seconds per real second
+    speed: float = 1.0
+    start_hour: float = 12.0
+    # Standard deviation of the consumption readings in watts
+    noise: float = 5.0
+    seed: int | None = None
+    cloud_factor: float = field(init=False, default=1.0)
+    # Attenuation and simulated end time of the cloud passing, if any
+    __cloud: Tuple[float, float] | None = field(init=False, default=None)
+    __random: random.Random = field(init=False)
+    __started: float = field(init=False, default=0.0)
+    __last_step: float = field(init=False, default=0.0)
+    production: float = field(init=False, default=0.0)
+    total_consumption: float = field(init=False, default=0.0)
+
+    def __post_init__(self):
+        if self.profile not in PROFILES:
+            raise ValueError(f"profile must be one of {', '.join(PROFILES)}")
+        self.__random = random.Random(self.seed)
+        self.__started = time.monotonic()
+        self.__last_step = self.__started
+        self.production = solar_production(self.start_hour, self.peak)
+
+    @property
+    def elapsed(self) -> float:
+        """Simulated seconds since the start."""
+        return (self.__last_step - self.__started) * self.speed
+
+    @property
+    def hour(self) -> float:
+        """Simulated hour of the day."""
+        return (self.start_hour + self.elapsed / 3600) % 24
+
+    @property
+    def surplus(self) -> float:
+        """Production minus the base load and the consumption of the devices."""
+        return self.production - self.base_load - self.total_consumption
+
+    def step(self, now: float | None = None):
+        """
+        Advance the simulation to a time.
+
+        Parameters:
+        now (float | None): The time.monotonic() to advance to, now if None.
+        """
+        if now is None:
+            now = time.monotonic()
+        dt = (now - self.__last_step) * self.speed
+        if dt <= 0:
+            return
+        self.__last_step = now
+        if self.profile == "clouds":
+            self.__step_clouds(dt)
+        self.production = solar_production(self.hour, self.peak) * self.cloud_factor
+
+        # Devices respond in real time, only the day is accelerated
+        response = 1 - math.exp(-dt / self.speed / self.lag) if self.lag > 0 else 1
+        total = 0.0
+        for device in self.devices.values():
+            if device.consumption != device.target:
+                device.consumption += (device.target - device.consumption) * response
+                if abs(device.target - device.consumption) < 1:
+                    device.consumption = device.target
+            total += device.consumption
+        self.total_consumption = total
+
+    def __step_clouds(self, dt: float):
+        """Start and end the passing clouds and smooth their attenuation."""
+        elapsed = self.elapsed
+        if self.__cloud is not None and elapsed >= self.__cloud[1]:
+            self.__cloud = None
+        # On average a cloud every 20 simulated minutes
+        if self.__cloud is None and self.__random.random() < dt / 1200:
+            depth = self.__random.uniform(0.3, 0.8)
+            self.__cloud = (depth, elapsed + self.__random.uniform(60, 600))
+        target = 1 - self.__cloud[0] if self.__cloud is not None else 1.0
+        # Cloud edges take about 30 simulated seconds
+        self.cloud_factor += (target - self.cloud_factor) * (1 - math.exp(-dt / 30))
+
+    def reading(self, device: SimulatedDevice) -> float:
+        """
+        Consumption reading of a device with the measurement noise.
+
+        Parameters:
+        device (SimulatedDevice): The device.
+
+        Returns:
+        float: The reading in watts, never negative.
+        """
+        if not device.consumption:
+            return 0.0
+        return max(0.0, device.consumption + self.__random.gauss(0, self.noise))
+
+    def switch(self, device: SimulatedDevice, powered: bool):
+        """
+        Turn a device on or off.
+
+        Parameters:
+        device (SimulatedDevice): The device.
+        powered (bool): Whether to turn it on.
+        """
+        device.powered = powered
+        if not powered:
+            device.target = 0.0
+        elif device.regulated is not None:
+            device.target = device.regulated
+        else:
+            device.target = device.power
+
+    def regulate(self, device: SimulatedDevice, power: float):
+        """
+        Set the power of a regulated device, it is applied while it is on.
+
+        Parameters:
+        device (SimulatedDevice): The device.
+        power (float): The power in watts, clamped to the power of the device.
+        """
+        device.regulated = min(max(power, 0.0), device.power)
+        if device.powered:
+            device.target = device.regulated
+
+    def status(self) -> Dict[str, Any]:
+        """
+        Summary of the simulation.
+
+        Returns:
+        Dict[str, Any]: The summary.
+        """
+        return {
+            "hour": round(self.hour, 3),
+            "profile": self.profile,
+            "cloud_factor": round(self.cloud_factor, 3),
+            "production": round(self.production, 1),
+            "base_load": self.base_load,
+            "consumption": round(self.total_consumption, 1),
+            "surplus": round(self.surplus, 1),
+            "devices": len(self.devices),
+            "powered": sum(device.powered for device in self.devices.values()),
+        }
+
+
+def build_devices(
+    count: int, mqtt_fraction: float = 0.0, seed: int | None = None
+) -> Dict[str, SimulatedDevice]:
+    """
+    Build the devices of a simulation. Every fifth device is regulated, the power
+    of the switches is between 200 and 2000 W.
+
+    Parameters:
+    count (int): Number of devices, 1 to 10000.
+    mqtt_fraction (float): Fraction of the devices that publish their consumption
+    to the MQTT broker instead of serving it over HTTP.
+    seed (int | None): Seed of the random powers.
+
+    Returns:
+    Dict[str, SimulatedDevice]: The devices by name.
+
+    Raises:
+    ValueError: If the count or the fraction is out of range.
+    """
+    if not 1 <= count <= 10000:
+        raise ValueError("The number of devices must be between 1 and 10000")
+    if not 0 <= mqtt_fraction <= 1:
+        raise ValueError("The MQTT fraction must be between 0 and 1")
+    rng = random.Random(seed)
+    mqtt_devices = round(count * mqtt_fraction)
+    devices = {}
+    for index in range(count):
+        name = f"device{index + 1}"
+        regulated = index % REGULATED_EVERY == REGULATED_EVERY - 1
+        devices[name] = SimulatedDevice(
+            name=name,
+            type=REGULATED if regulated else SWITCH,
+            power=2000.0 if regulated else float(rng.randrange(200, 2001, 50)),
+            # The last devices publish over MQTT
+            mqtt=index >= count - mqtt_devices,
+        )
+    return devices
+
+
+def build_config(
+    simulation: Simulation,
+    url: str,
+    mqtt_port: int | None = None,
+    poll_interval: float = 5,
+    state: bool = False,
+    modbus_port: int | None = None,
+) -> Dict[str, Any]:
+    """
+    Build the config of the application for the devices of a simulation.
+
+    Parameters:
+    simulation (Simulation): The simulation.
+    url (str): Base URL of the HTTP server of the simulator.
+    mqtt_port (int | None): Port of the MQTT broker, None if it is not running.
+    poll_interval (float): Seconds between two polls of the http_get entities.
+    state (bool): Whether to read the actual state of the devices.
+    modbus_port (int | None): Port of the Modbus TCP server, the surplus is read
+    from it if it is running.
+
+    Returns:
+    Dict[str, Any]: The config.
+    """
+    integrations: Dict[str, Any] = {"http_get": {"timeout": poll_interval}}
+    integrations["http_post"] = None
+    if mqtt_port is not None:
+        integrations["mqtt_sub"] = {"hostname": "localhost", "port": mqtt_port}
+
+    def post(name: str, action: str, body: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "name": "http_post",
+            "path": f"{url}/{name}/{action}",
+            "method": "POST",
+            "headers": {"Content-Type": "application/json"},
+            "body": body,
+        }
+
+    devices = []
+    for device in simulation.devices.values():
+        if device.mqtt and mqtt_port is not None:
+            consumption = {
+                "name": "mqtt_sub",
+                "topic": MQTT_TOPIC.format(name=device.name),
+            }
+        else:
+            consumption = {
+                "name": "http_get",
+                "path": f"{url}/{device.name}/consumption",
+            }
+        control = {
+            "turn_on": post(device.name, "switch", {"state": "on"}),
+            "turn_off": post(device.name, "switch", {"state": "off"}),
+        }
+        config: Dict[str, Any] = {"name": device.name, "type": device.type}
+        if device.type == REGULATED:
+            config["expected_consumption"] = device.power * 0.3
+            config["max_consumption"] = device.power
+            control["regulate"] = post(device.name, "regulate", {"power": "$power"})
+        else:
+            config["expected_consumption"] = device.power
+        config["consumption_integration"] = consumption
+        if state:
+            config["state_integration"] = {
+                "name": "http_get",
+                "path": f"{url}/{device.name}/state",
+            }
+        config["control_integration"] = control
+        devices.append(config)
+
+    if modbus_port is not None:
+        integrations["modbus_tcp"] = {"interval": poll_interval}
+        surplus = {
+            "modbus_tcp": {
+                "host": "localhost",
+                "port": modbus_port,
+                "unit": MODBUS_UNIT,
+                "address": MODBUS_SURPLUS,
+                "data_type": "float32",
+                "stale_after": poll_interval * 6,
+            }
+        }
+    else:
+        surplus = {
+            "http_get": {
+                "path": f"{url}/surplus_production",
+                "stale_after": poll_interval * 6,
+            }
+        }
+    return {
+        "integrations": integrations,
+        "surplus": surplus,
+        "surplus_margin": 100,
+        "grid_margin": 100,
+        "devices": devices,
+    }
+
+
+def encode_length(length: int) -> bytes:
+    """Encode the remaining length of a MQTT packet."""
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+
+def encode_string(value: str) -> bytes:
+    """Encode a length prefixed MQTT string."""
+    data = value.encode()
+    return struct.pack("!H", len(data)) + data
+
+
+def topic_matches(pattern: str, topic: str) -> bool:
+    """
+    Whether a topic matches a subscription pattern with + and # wildcards.
+
+    Parameters:
+    pattern (str): The subscription pattern.
+    topic (str): The topic of a message.
+
+    Returns:
+    bool: True if it matches.
+    """
+    pattern_levels = pattern.split("/")
+    topic_levels = topic.split("/")
+    for index, level in enumerate(pattern_levels):
+        if level == "#":
+            return True
+        if index >= len(topic_levels):
+            return False
+        if level not in ("+", topic_levels[index]):
+            return False
+    return len(pattern_levels) == len(topic_levels)
+
+
+@dataclass
+class MqttBroker:
+    """
+    Minimal MQTT 3.1.1 broker, enough for the mqtt_sub integration: QoS 0
+    publishing, wildcard subscriptions and keep alive. Messages published by the
+    clients are forwarded to the subscribers too.
+    """
+
+    host: str = "localhost"
+    port: int = 1883
+    # Subscription patterns of every connected client
+    clients: Dict[asyncio.StreamWriter, Set[str]] = field(default_factory=dict)
+    __server: asyncio.AbstractServer | None = field(init=False, default=None)
+    # Tasks serving the clients, awaited when the broker closes
+    __handlers: Set[asyncio.Task] = field(init=False, default_factory=set)
+
+    async def start(self):
+        """Start accepting connections."""
+        self.__server = await asyncio.start_server(self.__handle, self.host, self.port)
+        logger.info("MQTT broker listening on %s:%s", self.host, self.port)
+
+    async def close(self):
+        """Disconnect the clients and stop the server."""
+        if self.__server is not None:
+            self.__server.close()
+        for writer in list(self.clients):
+            writer.close()
+        # The handlers end when their connection is closed. Cancelled handlers
+        # would be logged as errors by asyncio.
+        await asyncio.gather(*self.__handlers, return_exceptions=True)
+        self.clients.clear()
+
+    def publish(self, topic: str, payload: bytes):
+        """
+        Send a message to the subscribers of its topic. Clients that can not keep
+        up are disconnected, like a real broker does.
+
+        Parameters:
+        topic (str): The topic.
+        payload (bytes): The payload.
+        """
+        packet = None
+        for writer, patterns in self.clients.items():
+            if not any(topic_matches(pattern, topic) for pattern in patterns):
+                continue
+            if packet is None:
+                body = encode_string(topic) + payload
+                packet = bytes([PUBLISH << 4]) + encode_length(len(body)) + body
+            if writer.transport.get_write_buffer_size() > 1 << 24:
+                logger.warning("Disconnecting slow MQTT client")
+                writer.close()
+                continue
+            writer.write(packet)
+
+    async def __read_packet(self, reader: asyncio.StreamReader) -> Tuple[int, bytes]:
+        """Read a packet, returns its first byte and its body."""
+        header = (await reader.readexactly(1))[0]
+        length = 0
+        multiplier = 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            if not byte & 0x80:
+                break
+            multiplier *= 128
+        return header, await reader.readexactly(length)
+
+    async def __handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        """Serve a client until it disconnects."""
+        patterns: Set[str] = set()
+        handler = asyncio.current_task()
+        self.__handlers.add(handler)
+        # Registered before the CONNECT so `close` can end every connection
+        self.clients[writer] = patterns
+        try:
+            header, body = await self.__read_packet(reader)
+            if header >> 4 != CONNECT:
+                return
+            keep_alive = struct.unpack_from("!H", body, 8)[0] if len(body) >= 10 else 0
+            writer.write(bytes([CONNACK << 4, 2, 0, 0]))
+            # A client is disconnected after 1.5 keep alive periods of silence
+            timeout = keep_alive * 1.5 if keep_alive else None
+            while True:
+                header, body = await asyncio.wait_for(
+                    self.__read_packet(reader), timeout
+                )
+                packet_type = header >> 4
+                if packet_type == PUBLISH:
+                    self.__on_publish(header, body, writer)
+                elif packet_type in (SUBSCRIBE, UNSUBSCRIBE):
+                    self.__on_subscribe(packet_type, body, patterns, writer)
+                elif packet_type == PINGREQ:
+                    writer.write(bytes([PINGRESP << 4, 0]))
+                elif packet_type == DISCONNECT:
+                    return
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            self.clients.pop(writer, None)
+            self.__handlers.discard(handler)
+            writer.close()
+
+    def __on_publish(self, header: int, body: bytes, writer: asyncio.StreamWriter):
+        """Forward a message published by a client."""
+        length = struct.unpack_from("!H", body)[0]
+        topic = body[2 : 2 + length].decode()
+        offset = 2 + length
+        qos = (header >> 1) & 0x03
+        if qos:
+            packet_id = body[offset : offset + 2]
+            offset += 2
+            writer.write(bytes([PUBACK << 4, 2]) + packet_id)
+        self.publish(topic, body[offset:])
+
+    def __on_subscribe(
+        self,
+        packet_type: int,
+        body: bytes,
+        patterns: Set[str],
+        writer: asyncio.StreamWriter,
+    ):
+        """Add or remove the topics of a subscribe or unsubscribe packet."""
+        packet_id = body[:2]
+        offset = 2
+        granted = bytearray()
+        while offset < len(body):
+            length = struct.unpack_from("!H", body, offset)[0]
+            pattern = body[offset + 2 : offset + 2 + length].decode()
+            offset += 2 + length
+            if packet_type == SUBSCRIBE:
+                # Requested QoS, only QoS 0 is granted
+                offset += 1
+                patterns.add(pattern)
+                granted.append(0)
+            else:
+                patterns.discard(pattern)
+        if packet_type == SUBSCRIBE:
+            length = encode_length(2 + len(granted))
+            writer.write(bytes([SUBACK << 4]) + length + packet_id + bytes(granted))
+        else:
+            writer.write(bytes([UNSUBACK << 4, 2]) + packet_id)
+
+
+def modbus_address(index: int) -> int:
+    """
+    Modbus register of the consumption of a device.
+
+    Parameters:
+    index (int): Position of the device in the simulation, from 0.
+
+    Returns:
+    int: The first of its two registers.
+    """
+    return MODBUS_PRODUCTION + 2 * (index + 1)
+
+
+@dataclass
+class ModbusServer:
+    """
+    Minimal Modbus TCP server, enough for the modbus_tcp integration: reads of
+    holding and input registers (functions 3 and 4), which hold the same values,
+    with pipelined requests answered in order.
+    """
+
+    simulation: Simulation
+    host: str = "localhost"
+    # 0 to listen on a free port, set to the actual port by `start`
+    port: int = 5020
+    requests: int = field(init=False, default=0)
+    __server: asyncio.AbstractServer | None = field(init=False, default=None)
+    __devices: List[SimulatedDevice] = field(init=False, default_factory=list)
+    __handlers: Set[asyncio.Task] = field(init=False, default_factory=set)
+    __writers: Set[asyncio.StreamWriter] = field(init=False, default_factory=set)
+
+    async def start(self):
+        """Start accepting connections."""
+        self.__devices = list(self.simulation.devices.values())
+        self.__server = await asyncio.start_server(self.__handle, self.host, self.port)
+        self.port = self.__server.sockets[0].getsockname()[1]
+        logger.info("Modbus TCP server listening on %s:%s", self.host, self.port)
+
+    async def close(self):
+        """Disconnect the clients and stop the server."""
+        if self.__server is not None:
+            self.__server.close()
+        for writer in list(self.__writers):
+            writer.close()
+        await asyncio.gather(*self.__handlers, return_exceptions=True)
+
+    def value(self, index: int) -> float:
+        """
+        Value of the n-th float32 of the register map.
+
+        Parameters:
+        index (int): Register divided by two.
+
+        Returns:
+        float: The surplus, the production or the reading of a device.
+        """
+        if index == MODBUS_SURPLUS // 2:
+            return self.simulation.surplus
+        if index == MODBUS_PRODUCTION // 2:
+            return self.simulation.production
+        return self.simulation.reading(self.__devices[index - 2])
+
+    def respond(self, unit: int, pdu: bytes) -> bytes:
+        """
+        Build the response PDU of a request.
+
+        Parameters:
+        unit (int): The unit id of the request.
+        pdu (bytes): The request PDU.
+
+        Returns:
+        bytes: The response PDU, an exception response if the request is not valid.
+        """
+        function = pdu[0]
+        if unit != MODBUS_UNIT:
+            return bytes([function | 0x80, GATEWAY_TARGET_FAILED])
+        if function not in (3, 4):
+            return bytes([function | 0x80, ILLEGAL_FUNCTION])
+        if len(pdu) != 5:
+            return bytes([function | 0x80, ILLEGAL_VALUE])
+        start, count = struct.unpack_from(">HH", pdu, 1)
+        if not 1 <= count <= 125:
+            return bytes([function | 0x80, ILLEGAL_VALUE])
+        if start + count > modbus_address(len(self.__devices)):
+            return bytes([function | 0x80, ILLEGAL_ADDRESS])
+        first = start // 2
+        last = (start + count + 1) // 2
+        values = struct.pack(
+            f">{last - first}f", *(self.value(index) for index in range(first, last))
+        )
+        offset = 2 * (start - 2 * first)
+        data = values[offset : offset + 2 * count]
+        return bytes([function, len(data)]) + data
+
+    async def __handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        """Serve a client until it disconnects or sends a malformed frame."""
+        handler = asyncio.current_task()
+        self.__handlers.add(handler)
+        self.__writers.add(writer)
+        try:
+            while True:
+                transaction, protocol, length, unit = MBAP.unpack(
+                    await reader.readexactly(MBAP.size)
+                )
+                if protocol != 0 or length < 2:
+                    return
+                pdu = await reader.readexactly(length - 1)
+                self.requests += 1
+                response = self.respond(unit, pdu)
+                writer.write(MBAP.pack(transaction, 0, len(response) + 1, unit))
+                writer.write(response)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.__writers.discard(writer)
+            self.__handlers.discard(handler)
+            writer.close()
+
+
+@dataclass
+class Simulator:
+    """Serves a simulation over HTTP, MQTT and Modbus TCP."""
+
+    simulation: Simulation
+    host: str = "localhost"
+    port: int = 8001
+    # Port of the MQTT broker, None to not run it
+    mqtt_port: int | None = None
+    # Port of the Modbus TCP server, None to not run it
+    modbus_port: int | None = None
+    # Mean seconds to answer a request
+    latency: float = 0.0
+    # Fraction of the requests that fail with a 503 response
+    error_rate: float = 0.0
+    # Seconds between two simulation steps and MQTT publications. The readings
+    # served in between are those of the last step.
+    interval: float = 1.0
+    broker: MqttBroker | None = field(init=False, default=None)
+    modbus: ModbusServer | None = field(init=False, default=None)
+    __runner: web.AppRunner | None = field(init=False, default=None)
+    __task: asyncio.Task | None = field(init=False, default=None)
+    __random: random.Random = field(init=False)
+    requests: int = field(init=False, default=0)
+    errors: int = field(init=False, default=0)
+
+    def __post_init__(self):
+        self.__random = random.Random(self.simulation.seed)
+
+    def build_app(self) -> web.Application:
+        """
+        Build the HTTP application.
+
+        Returns:
+        web.Application: The application.
+        """
+        app = web.Application()
+        app.router.add_get("/surplus_production", self.__surplus)
+        app.router.add_get("/status", self.__status)
+        app.router.add_get("/{name}/consumption", self.__consumption)
+        app.router.add_get("/{name}/state", self.__state)
+        app.router.add_post("/{name}/switch", self.__switch)
+        app.router.add_post("/{name}/regulate", self.__regulate)
+        return app
+
+    async def start(self):
+        """
+        Start the HTTP server, the MQTT broker and the Modbus TCP server if they
+        are configured, and the simulation.
+        """
+        self.__runner = web.AppRunner(self.build_app(), access_log=None)
+        await self.__runner.setup()
+        await web.TCPSite(self.__runner, self.host, self.port).start()
+        logger.info(
+            "Simulating %s devices on http://%s:%s",
+            len(self.simulation.devices),
+            self.host,
+            self.port,
+        )
+        if self.mqtt_port is not None:
+            self.broker = MqttBroker(self.host, self.mqtt_port)
+            await self.broker.start()
+        if self.modbus_port is not None:
+            self.modbus = ModbusServer(self.simulation, self.host, self.modbus_port)
+            await self.modbus.start()
+        self.__task = asyncio.create_task(self.run())
+
+    async def close(self):
+        """Stop the simulation and the servers."""
+        if self.__task is not None:
+            self.__task.cancel()
+        if self.broker is not None:
+            await self.broker.close()
+        if self.modbus is not None:
+            await self.modbus.close()
+        if self.__runner is not None:
+            await self.__runner.cleanup()
+
+    async def run(self):
+        """Indefinitely steps the simulation and publishes the MQTT readings."""
+        simulation = self.simulation
+        mqtt_devices = [
+            (MQTT_TOPIC.format(name=device.name), device)
+            for device in simulation.devices.values()
+            if device.mqtt
+        ]
+        while True:
+            simulation.step()
+            if self.broker is not None:
+                for topic, device in mqtt_devices:
+                    value = simulation.reading(device)
+                    self.broker.publish(topic, f"{value:.1f}".encode())
+            await asyncio.sleep(self.interval)
+
+    async def __respond(self) -> bool:
+        """Wait the latency of a request, returns False if it has to fail."""
+        self.requests += 1
+        if self.latency > 0:
+            await asyncio.sleep(self.__random.expovariate(1 / self.latency))
+        if self.__random.random() < self.error_rate:
+            self.errors += 1
+            return False
+        return True
+
+    def __device(self, request: web.Request) -> SimulatedDevice:
+        device = self.simulation.devices.get(request.match_info["name"])
+        if device is None:
+            raise web.HTTPNotFound(text="Unknown device")
+        return device
+
+    async def __surplus(self, _request: web.Request) -> web.Response:
+        if not await self.__respond():
+            return web.Response(status=503, text="Unavailable")
+        return web.Response(text=f"{self.simulation.surplus:.1f}")
+
+    async def __status(self, _request: web.Request) -> web.Response:
+        status = self.simulation.status()
+        status["requests"] = self.requests
+        status["errors"] = self.errors
+        return web.json_response(status)
+
+    async def __consumption(self, request: web.Request) -> web.Response:
+        device = self.__device(request)
+        if not await self.__respond():
+            return web.Response(status=503, text="Unavailable")
+        return web.Response(text=f"{self.simulation.reading(device):.1f}")
+
+    async def __state(self, request: web.Request) -> web.Response:
+        device = self.__device(request)
+        if not await self.__respond():
+            return web.Response(status=503, text="Unavailable")
+        return web.Response(text="on" if device.powered else "off")
+
+    async def __command(self, request: web.Request) -> Tuple[SimulatedDevice, Any]:
+        """Parse the body of a command, raises a HTTP error if it has to fail."""
+        device = self.__device(request)
+        try:
+            body = json_loads(await request.read())
+        except ValueError as e:
+            raise web.HTTPBadRequest(text="Invalid JSON") from e
+        if not await self.__respond():
+            raise web.HTTPServiceUnavailable(text="Unavailable")
+        return device, body
+
+    async def __switch(self, request: web.Request) -> web.Response:
+        device, body = await self.__command(request)
+        state = str(body.get("state", "")).lower()
+        if state not in ("on", "off"):
+            raise web.HTTPBadRequest(text="state must be on or off")
+        self.simulation.switch(device, state == "on")
+        return web.json_response({"state": state})
+
+    async def __regulate(self, request: web.Request) -> web.Response:
+        device, body = await self.__command(request)
+        if device.type != REGULATED:
+            raise web.HTTPBadRequest(text="Device is not regulated")
+        try:
+            power = float(body["power"])
+        except (KeyError, TypeError, ValueError) as e:
+            raise web.HTTPBadRequest(text="power must be a number") from e
+        self.simulation.regulate(device, power)
+        return web.json_response({"power": device.regulated})
+
+
+async def serve(simulator: Simulator):
+    """Run a simulator until the process is interrupted."""
+    await simulator.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await simulator.close()
+
+
+def main(argv: List[str] | None = None) -> int:
+    """Command line interface of the simulator."""
+    parser = argparse.ArgumentParser(
+        prog="python -m opensurplusmanager.simulator",
+        description="Simulate a farm of devices and the solar production.",
+    )
+    parser.add_argument("--devices", type=int, default=10, help="1 to 10000")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument(
+        "--mqtt-port", type=int, help="run the MQTT broker on this port"
+    )
+    parser.add_argument(
+        "--mqtt-fraction",
+        type=float,
+        default=0.5,
+        help="fraction of the devices publishing over MQTT, with --mqtt-port",
+    )
+    parser.add_argument(
+        "--modbus-port",
+        type=int,
+        help="run the Modbus TCP server on this port, the config reads the surplus",
+    )
+    parser.add_argument("--latency", type=float, default=0.0, help="mean seconds")
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="fraction of failed requests"
+    )
+    parser.add_argument(
+        "--lag", type=float, default=5.0, help="seconds to reach 63%% of a new power"
+    )
+    parser.add_argument("--profile", choices=PROFILES, default="sunny")
+    parser.add_argument(
+        "--speed", type=float, default=1.0, help="simulated seconds per second"
+    )
+    parser.add_argument("--start-hour", type=float, default=12.0)
+    parser.add_argument(
+        "--peak", type=float, help="W at solar noon, half the device power if unset"
+    )
+    parser.add_argument("--base-load", type=float, default=300.0)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--write-config", metavar="PATH", help="write a config.yaml")
+    parser.add_argument(
+        "--poll-interval", type=float, default=5, help="http_get timeout of the config"
+    )
+    parser.add_argument(
+        "--state", action="store_true", help="add state integrations to the config"
+    )
+    args = parser.parse_args(argv)
+
+    try:
+        devices = build_devices(
+            args.devices,
+            args.mqtt_fraction if args.mqtt_port is not None else 0.0,
+            args.seed,
+        )
+    except ValueError as e:
+        parser.error(str(e))
+    peak = args.peak
+    if peak is None:
+        peak = sum(device.power for device in devices.values()) / 2 + args.base_load
+    simulation = Simulation(
+        devices=devices,
+        profile=args.profile,
+        peak=peak,
+        base_load=args.base_load,
+        lag=args.lag,
+        speed=args.speed,
+        start_hour=args.start_hour,
+        seed=args.seed,
+    )
+
+    if args.write_config:
+        config = build_config(
+            simulation,
+            f"http://{args.host}:{args.port}",
+            args.mqtt_port,
+            args.poll_interval,
+            args.state,
+            args.modbus_port,
+        )
+        with open(args.write_config, "w", encoding="utf-8") as file:
+            yaml.safe_dump(config, file, sort_keys=False)
+        logger.info("Config written to %s", args.write_config)
+
+    simulator = Simulator(
+        simulation,
+        host=args.host,
+        port=args.port,
+        mqtt_port=args.mqtt_port,
+        modbus_port=args.modbus_port,
+        latency=args.latency,
+        error_rate=args.error_rate,
+    )
+    try:
+        asyncio.run(serve(simulator))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
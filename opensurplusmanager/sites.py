@@ -0,0 +1,175 @@
+"""
+Multi-site mode: one process runs an independent core for every config file of a
+directory, all served by one API.
+
+Every site has its own devices, control loop and integrations, its routes are
+served at /api/sites/{site}/... and its metrics are labeled with the site name.
+The integrations share the HTTP connection pool and the MQTT broker connections
+(see `opensurplusmanager.integrations.shared`). A site that fails to load is
+reported by /api/sites and does not stop the others.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Any, Dict, List
+
+import yaml
+from aiohttp import web
+
+from opensurplusmanager.api import Api, collect_core_metrics
+from opensurplusmanager.core import Core
+from opensurplusmanager.exceptions import IntegrationInitializationError
+from opensurplusmanager.integrations import setup_integrations
+from opensurplusmanager.metrics import registry
+from opensurplusmanager.utils import logger
+
+# Site names are used in the URLs
+SITE_NAME = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+@dataclass
+class Site:
+    """A core loaded from a config file of the sites directory."""
+
+    name: str
+    core: Core
+    integrations: List[Any] = field(default_factory=list)
+    # Why the site could not be loaded, None if it is running
+    error: str | None = None
+
+
+@dataclass
+class SiteManager:
+    """Loads, runs and closes the sites of a directory."""
+
+    path: str
+    sites: Dict[str, Site] = field(default_factory=dict)
+    runner: web.AppRunner | None = None
+
+    async def load(self):
+        """Load every .yaml or .yml config file of the directory as a site."""
+        logger.info("Loading sites from %s...", self.path)
+        for file_name in sorted(os.listdir(self.path)):
+            name, extension = os.path.splitext(file_name)
+            if extension not in (".yaml", ".yml"):
+                continue
+            if not SITE_NAME.match(name):
+                logger.warning("Ignoring site %s, invalid name", file_name)
+                continue
+            site = await self.__load_site(name, os.path.join(self.path, file_name))
+            self.sites[name] = site
+        running = sum(1 for site in self.sites.values() if site.error is None)
+        logger.info("Loaded %s sites, %s running", len(self.sites), running)
+
+    async def __load_site(self, name: str, config_file: str) -> Site:
+        """Load a site, closing what was started if it fails."""
+        site = Site(name=name, core=Core(config_file=config_file, name=name))
+        try:
+            with open(config_file, "r", encoding="utf-8") as file:
+                site.core.config = yaml.load(file, Loader=yaml.FullLoader) or {}
+            site.core.load_config()
+            await setup_integrations(site.core, site.integrations)
+        except (
+            OSError,
+            yaml.YAMLError,
+            KeyError,
+            TypeError,
+            ValueError,
+            IntegrationInitializationError,
+        ) as e:
+            logger.error("Error loading site %s: %s", name, e)
+            site.error = str(e) or e.__class__.__name__
+            await self.__close_site(site)
+        return site
+
+    async def __close_site(self, site: Site):
+        """Close the API, integrations and core of a site."""
+        if site.core.api is not None:
+            await site.core.api.close()
+        for integration in site.integrations:
+            if hasattr(integration, "close"):
+                await integration.close()
+        site.integrations.clear()
+        site.core.close()
+
+    async def run(self):
+        """Start the cores of the running sites and serve the API."""
+        app = web.Application()
+        app.router.add_get("/api/sites", self.get_sites)
+        app.router.add_get("/metrics", self.get_metrics)
+        for site in self.sites.values():
+            if site.error is not None:
+                continue
+            site.core.start()
+            site.core.api = Api(core=site.core)
+            app.add_subapp(f"/api/sites/{site.name}", site.core.api.create_app())
+        registry.add_collector(self.collect_metrics)
+
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        port = int(os.getenv("PORT", "8080"))
+        host = os.getenv("HOST", "0.0.0.0")
+        await web.TCPSite(self.runner, host, port).start()
+        logger.info("API started on %s:%s", host, port)
+
+    async def get_sites(self, _) -> web.Response:
+        """
+        Get the sites and their status.
+
+        Returns:
+        web.Response: A JSON with the list of sites.
+        """
+        return web.json_response(
+            [
+                {
+                    "name": site.name,
+                    "running": site.error is None,
+                    "error": site.error,
+                    "devices": len(site.core.devices),
+                    "surplus": site.core.surplus,
+                }
+                for site in self.sites.values()
+            ]
+        )
+
+    async def get_metrics(self, _) -> web.Response:
+        """
+        Get the metrics of all the sites in the Prometheus text exposition format.
+
+        Returns:
+        web.Response: The metrics as plain text.
+        """
+        return web.Response(
+            text=registry.render(),
+            content_type="text/plain",
+            headers={"X-Content-Type-Options": "nosniff"},
+            charset="utf-8",
+        )
+
+    def collect_metrics(self):
+        """
+        Metrics collector with the current state of the running sites.
+
+        Yields:
+        str: The lines of the exposition.
+        """
+        yield "# HELP osm_site_running 1 if the site is running."
+        yield "# TYPE osm_site_running gauge"
+        for site in self.sites.values():
+            yield f'osm_site_running{{site="{site.name}"}} {float(site.error is None)}'
+        yield from collect_core_metrics(
+            [site.core for site in self.sites.values() if site.error is None]
+        )
+
+    async def close(self):
+        """Safely close every site and the API."""
+        registry.remove_collector(self.collect_metrics)
+        for site in self.sites.values():
+            if site.error is None:
+                await self.__close_site(site)
+        if self.runner is not None:
+            await self.runner.cleanup()
+        logger.info("Sites closed")
@@ -0,0 +1,224 @@
+"""
+Runtime snapshot for warm restarts.
+
+The runtime state of the core that is not in the config (powered and cooldown of
+the devices, last commands, last readings, reported states and controllers) is
+written periodically and when the core closes to a small JSON file, replacing it
+atomically. When the core starts the snapshot is loaded if it is recent enough,
+so the first control cycles start from the state the devices are really in
+instead of assuming they are all off.
+
+The times are stored as Unix times and converted back to time.monotonic() when
+loaded, the monotonic clock does not survive a reboot.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Dict
+
+from opensurplusmanager.utils import json_dumps, logger
+
+if TYPE_CHECKING:
+    from opensurplusmanager.core import Core
+
+VERSION = 1
+
+
+def to_unix(value: float, now_unix: float, now_monotonic: float) -> float | None:
+    """Convert a time.monotonic() time to Unix time, None for 0."""
+    if not value:
+        return None
+    return now_unix - (now_monotonic - value)
+
+
+def to_monotonic(value: float | None, now_unix: float, now_monotonic: float) -> float:
+    """Convert a Unix time to time.monotonic() time, 0 for None."""
+    if value is None:
+        return 0
+    return now_monotonic - (now_unix - value)
+
+
+@dataclass
+class RuntimeSnapshot:
+    """Writes and loads the runtime snapshot of a core."""
+
+    core: Core
+    path: str = "snapshot.json"
+    # Seconds between writes
+    interval: float = 30
+    # Seconds after which a snapshot is too old to be loaded
+    max_age: float = 300
+    # Set by `load`, a core that never started must not overwrite the snapshot
+    started: bool = field(default=False)
+    # Held while writing, the periodic writes run in a thread that can still be
+    # writing when the core closes
+    __lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+    # Unix time the written snapshot was built, an older one never replaces it
+    __written_at: float = field(init=False, default=0.0)
+
+    def build(self) -> Dict[str, Any]:
+        """
+        Build the snapshot of the current state.
+
+        Returns:
+        Dict[str, Any]: The snapshot.
+        """
+        core = self.core
+        state = core.state
+        now_unix = time.time()
+        now = time.monotonic()
+        devices = {}
+        for device in core.devices.values():
+            slot = device.slot
+            data = {
+                "powered": bool(state.powered[slot]),
+                "cooldown_until": to_unix(state.cooldown_until[slot], now_unix, now),
+                "last_command": state.last_command[slot],
+                "last_power": state.last_power[slot],
+                "consumption": state.consumption[slot],
+                "raw_consumption": state.raw_consumption[slot],
+                "updated_at": to_unix(state.updated_at[slot], now_unix, now),
+                "commanded_at": to_unix(state.commanded_at[slot], now_unix, now),
+                "reported": state.reported[slot],
+                "mismatches": state.mismatches[slot],
+            }
+            controller = device.controller
+            if controller is not None and not math.isnan(controller.integral):
+                data["controller"] = {
+                    "integral": controller.integral,
+                    "last_error": controller.last_error,
+                    "last_available": controller.last_available,
+                    "last_time": to_unix(controller.last_time, now_unix, now),
+                }
+            devices[device.name] = data
+        return {
+            "version": VERSION,
+            "written_at": now_unix,
+            "cycle": core.cycle,
+            "surplus": core.surplus,
+            "raw_surplus": core.raw_surplus,
+            "surplus_updated_at": to_unix(core.surplus_updated_at, now_unix, now),
+            "devices": devices,
+        }
+
+    def write(self, data: Dict[str, Any] | None = None):
+        """
+        Write a snapshot to a temporary file and rename it over the previous one,
+        so a crash while writing never leaves a truncated snapshot. Concurrent
+        writes are serialized and a snapshot older than the written one is
+        discarded.
+
+        Parameters:
+        data (Dict[str, Any] | None): The snapshot, the current state if None.
+        """
+        if data is None:
+            data = self.build()
+        with self.__lock:
+            if data["written_at"] < self.__written_at:
+                return
+            directory, name = os.path.split(os.path.abspath(self.path))
+            with tempfile.NamedTemporaryFile(
+                dir=directory, prefix=f"{name}.", suffix=".tmp", delete=False
+            ) as file:
+                try:
+                    file.write(json_dumps(data))
+                    file.flush()
+                    os.fsync(file.fileno())
+                except OSError:
+                    os.remove(file.name)
+                    raise
+            try:
+                os.replace(file.name, self.path)
+            except OSError:
+                os.remove(file.name)
+                raise
+            self.__written_at = data["written_at"]
+
+    def load(self) -> bool:
+        """
+        Restore the state of the core from the snapshot if it exists and is not
+        older than `max_age`. The readings are restored with their age, so the
+        freshness check marks the old ones as stale.
+
+        Returns:
+        bool: Whether the snapshot was loaded.
+        """
+        self.started = True
+        try:
+            with open(self.path, "rb") as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            logger.info("No runtime snapshot at %s", self.path)
+            return False
+        except (OSError, ValueError) as e:
+            logger.error("Could not read the runtime snapshot %s: %s", self.path, e)
+            return False
+        now_unix = time.time()
+        now = time.monotonic()
+        age = now_unix - data.get("written_at", 0)
+        if data.get("version") != VERSION or not 0 <= age <= self.max_age:
+            logger.warning("Ignoring runtime snapshot written %.0fs ago", age)
+            return False
+
+        core = self.core
+        core.cycle = data["cycle"]
+        core.restore_surplus(
+            data["surplus"],
+            data["raw_surplus"],
+            to_monotonic(data["surplus_updated_at"], now_unix, now),
+        )
+        state = core.state
+        for name, device_data in data["devices"].items():
+            device = core.get_device(name)
+            if device is None:
+                continue
+            slot = device.slot
+            state.last_command[slot] = device_data["last_command"]
+            state.last_power[slot] = device_data["last_power"]
+            state.consumption[slot] = device_data["consumption"]
+            state.raw_consumption[slot] = device_data["raw_consumption"]
+            state.updated_at[slot] = to_monotonic(
+                device_data["updated_at"], now_unix, now
+            )
+            state.commanded_at[slot] = to_monotonic(
+                device_data["commanded_at"], now_unix, now
+            )
+            state.reported[slot] = device_data["reported"]
+            state.mismatches[slot] = device_data["mismatches"]
+            device.powered = device_data["powered"]
+            cooldown_until = device_data["cooldown_until"]
+            if cooldown_until is not None and cooldown_until > now_unix:
+                device.resume_cooldown(cooldown_until - now_unix)
+            controller_data = device_data.get("controller")
+            if device.controller is not None and controller_data is not None:
+                device.controller.integral = controller_data["integral"]
+                device.controller.last_error = controller_data["last_error"]
+                device.controller.last_available = controller_data["last_available"]
+                device.controller.last_time = to_monotonic(
+                    controller_data["last_time"], now_unix, now
+                )
+        core.check_freshness()
+        logger.info(
+            "Loaded runtime snapshot written %.0fs ago with %s devices",
+            age,
+            len(data["devices"]),
+        )
+        return True
+
+    async def run(self):
+        """Indefinitely writes the snapshot every `interval` seconds."""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                # Built in the loop so it is consistent, written in a thread
+                await asyncio.to_thread(self.write, self.build())
+            except OSError as e:
+                logger.error("Could not write the runtime snapshot: %s", e)
@@ -0,0 +1,314 @@
+"""
+Durable history store backed by SQLite.
+
+Samples and device actions are queued from the event loop and written in batches
+by a worker thread, one transaction per batch, so the control loop never waits
+for the disk. The same thread periodically rolls the old raw samples up into
+aggregated buckets and deletes what is past its retention.
+"""
+
+from __future__ import annotations
+
+import queue
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+from opensurplusmanager.utils import logger
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS series (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS samples (
+    series_id INTEGER NOT NULL,
+    ts REAL NOT NULL,
+    value REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS samples_series_ts ON samples (series_id, ts);
+CREATE TABLE IF NOT EXISTS rollups (
+    series_id INTEGER NOT NULL,
+    ts REAL NOT NULL,
+    min REAL NOT NULL,
+    max REAL NOT NULL,
+    mean REAL NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (series_id, ts)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS actions (
+    ts REAL NOT NULL,
+    device TEXT NOT NULL,
+    command TEXT NOT NULL,
+    value REAL,
+    success INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS actions_ts ON actions (ts);
+"""
+
+INSERT_SAMPLE = "INSERT INTO samples (series_id, ts, value) VALUES (?, ?, ?)"
+INSERT_ACTION = (
+    "INSERT INTO actions (ts, device, command, value, success) VALUES (?, ?, ?, ?, ?)"
+)
+# Aggregates the raw samples older than a cutoff into buckets of `step` seconds.
+# Buckets that already exist are merged with the new samples.
+ROLLUP = """
+INSERT INTO rollups (series_id, ts, min, max, mean, count)
+SELECT series_id, CAST(ts / :step AS INTEGER) * :step AS bucket, MIN(value),
+       MAX(value), AVG(value), COUNT(*)
+FROM samples WHERE ts < :cutoff GROUP BY series_id, bucket
+ON CONFLICT (series_id, ts) DO UPDATE SET
+    min = MIN(min, excluded.min),
+    max = MAX(max, excluded.max),
+    mean = (mean * count + excluded.mean * excluded.count)
+        / (count + excluded.count),
+    count = count + excluded.count
+"""
+
+QUERY_SAMPLES = """
+SELECT ts, value FROM samples
+WHERE series_id = (SELECT id FROM series WHERE name = :series)
+    AND ts BETWEEN :since AND :until
+ORDER BY ts
+"""
+QUERY_ROLLUPS = """
+SELECT ts, min, max, mean FROM rollups
+WHERE series_id = (SELECT id FROM series WHERE name = :series)
+    AND ts BETWEEN :since AND :until
+UNION ALL
+SELECT CAST(ts / :step AS INTEGER) * :step AS bucket, MIN(value), MAX(value),
+       AVG(value)
+FROM samples
+WHERE series_id = (SELECT id FROM series WHERE name = :series)
+    AND ts BETWEEN :since AND :until
+GROUP BY bucket
+ORDER BY 1
+"""
+
+# Kinds of the queued rows
+_SAMPLE = 0
+_ACTION = 1
+# Put in the queue to stop the worker thread
+_STOP = object()
+
+
+@dataclass
+class HistoryStore:
+    """
+    SQLite history store. `record` and `record_action` only put the data in a queue
+    and can be called from the event loop, the worker thread does the writes.
+    """
+
+    path: str = "history.db"
+    # Maximum rows written per transaction
+    batch_size: int = 1000
+    # Seconds to wait for more rows before writing a batch
+    flush_interval: float = 5
+    # Seconds the raw samples are kept before they are rolled up
+    raw_retention: int = 7 * 86400
+    # Resolution of the rollups in seconds
+    rollup_step: int = 900
+    # Seconds the rollups and actions are kept
+    rollup_retention: int = 365 * 86400
+    # Seconds between rollup and retention jobs
+    maintenance_interval: int = 3600
+    __queue: queue.SimpleQueue = field(init=False, default_factory=queue.SimpleQueue)
+    __thread: threading.Thread | None = field(init=False, default=None)
+    __series_ids: Dict[str, int] = field(init=False, default_factory=dict)
+
+    def start(self):
+        """Create the database if needed and start the worker thread."""
+        connection = self.__connect()
+        connection.executescript(SCHEMA)
+        connection.close()
+        self.__thread = threading.Thread(
+            target=self.__run, name="history-store", daemon=True
+        )
+        self.__thread.start()
+        logger.info("History store started on %s", self.path)
+
+    def close(self):
+        """Write the pending rows and stop the worker thread."""
+        if self.__thread is not None:
+            self.__queue.put(_STOP)
+            self.__thread.join()
+            self.__thread = None
+            logger.info("History store closed")
+
+    def record(self, series: str, value: float, timestamp: float | None = None):
+        """
+        Queue a sample to be written.
+
+        Parameters:
+            series (str): The name of the series.
+            value (float): The value of the sample.
+            timestamp (float | None): Unix time of the sample, now if None.
+        """
+        self.__queue.put(
+            (_SAMPLE, series, time.time() if timestamp is None else timestamp, value)
+        )
+
+    def record_action(
+        self, device: str, command: str, value: float | None, success: bool
+    ):
+        """
+        Queue a device action to be written.
+
+        Parameters:
+            device (str): The name of the device.
+            command (str): The command sent (turn_on, turn_off or regulate).
+            value (float | None): The power of a regulate command.
+            success (bool): Whether the command succeeded.
+        """
+        self.__queue.put((_ACTION, device, time.time(), command, value, success))
+
+    def query(
+        self, series: str, since: float, until: float, step: int | None = None
+    ) -> Tuple[int, List[Tuple]]:
+        """
+        Get the samples of a series in a time range. Blocking, call it from a
+        thread.
+
+        Parameters:
+            series (str): The name of the series.
+            since (float): Unix time of the start of the range.
+            until (float): Unix time of the end of the range.
+            step (int | None): 0 for the raw samples or `rollup_step` for the
+            rollups, the samples not rolled up yet are aggregated on the fly. If
+            None, the raw samples are used if they cover `since`.
+
+        Returns:
+            Tuple[int, List[Tuple]]: The step used and the rows, (ts, value) for raw
+            samples and (ts, min, max, mean) for rollups.
+
+        Raises:
+            ValueError: If the step is not valid.
+        """
+        if step is None:
+            step = 0 if since >= time.time() - self.raw_retention else self.rollup_step
+        if step not in (0, self.rollup_step):
+            raise ValueError(f"Step must be 0 or {self.rollup_step}")
+        parameters = {
+            "series": series,
+            "since": since,
+            "until": until,
+            "step": self.rollup_step,
+        }
+        connection = self.__connect()
+        try:
+            rows = connection.execute(
+                QUERY_SAMPLES if step == 0 else QUERY_ROLLUPS, parameters
+            ).fetchall()
+        finally:
+            connection.close()
+        return step, rows
+
+    def query_actions(
+        self, since: float, until: float, device: str | None = None
+    ) -> List[Tuple]:
+        """
+        Get the device actions in a time range. Blocking, call it from a thread.
+
+        Parameters:
+            since (float): Unix time of the start of the range.
+            until (float): Unix time of the end of the range.
+            device (str | None): Only return the actions of this device.
+
+        Returns:
+            List[Tuple]: The rows (ts, device, command, value, success).
+        """
+        sql = "SELECT ts, device, command, value, success FROM actions"
+        sql += " WHERE ts BETWEEN ? AND ?"
+        parameters: tuple = (since, until)
+        if device is not None:
+            sql += " AND device = ?"
+            parameters += (device,)
+        connection = self.__connect()
+        try:
+            return connection.execute(sql + " ORDER BY ts", parameters).fetchall()
+        finally:
+            connection.close()
+
+    def __connect(self) -> sqlite3.Connection:
+        """Open a connection to the database in WAL mode."""
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def __run(self):
+        """Worker thread. Writes the queued rows in batches and runs maintenance."""
+        connection = self.__connect()
+        next_maintenance = time.monotonic()
+        running = True
+        while running:
+            batch = []
+            try:
+                item = self.__queue.get(timeout=self.flush_interval)
+                while True:
+                    if item is _STOP:
+                        running = False
+                        break
+                    batch.append(item)
+                    if len(batch) >= self.batch_size:
+                        break
+                    item = self.__queue.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                if batch:
+                    self.__write(connection, batch)
+                if time.monotonic() >= next_maintenance:
+                    self.__maintenance(connection)
+                    next_maintenance = time.monotonic() + self.maintenance_interval
+            except sqlite3.Error as e:
+                logger.error("Error writing to the history store: %s", e)
+        connection.close()
+
+    def __series_id(self, connection: sqlite3.Connection, name: str) -> int:
+        """Get the id of a series, creating it if needed."""
+        series_id = self.__series_ids.get(name)
+        if series_id is None:
+            connection.execute(
+                "INSERT OR IGNORE INTO series (name) VALUES (?)", (name,)
+            )
+            series_id = connection.execute(
+                "SELECT id FROM series WHERE name = ?", (name,)
+            ).fetchone()[0]
+            self.__series_ids[name] = series_id
+        return series_id
+
+    def __write(self, connection: sqlite3.Connection, batch: List[Tuple]):
+        """Write a batch of rows in a single transaction."""
+        with connection:
+            samples = [
+                (self.__series_id(connection, name), ts, value)
+                for kind, name, ts, value in (i for i in batch if i[0] == _SAMPLE)
+            ]
+            actions = [
+                (ts, device, command, value, success)
+                for _, device, ts, command, value, success in (
+                    i for i in batch if i[0] == _ACTION
+                )
+            ]
+            connection.executemany(INSERT_SAMPLE, samples)
+            connection.executemany(INSERT_ACTION, actions)
+
+    def __maintenance(self, connection: sqlite3.Connection):
+        """Roll up the old raw samples and delete the expired rows."""
+        now = time.time()
+        # Only complete buckets are rolled up so they are never split
+        cutoff = now - self.raw_retention
+        cutoff -= cutoff % self.rollup_step
+        expired = now - self.rollup_retention
+        with connection:
+            connection.execute(ROLLUP, {"step": self.rollup_step, "cutoff": cutoff})
+            deleted = connection.execute(
+                "DELETE FROM samples WHERE ts < ?", (cutoff,)
+            ).rowcount
+            connection.execute("DELETE FROM rollups WHERE ts < ?", (expired,))
+            connection.execute("DELETE FROM actions WHERE ts < ?", (expired,))
+        if deleted:
+            logger.info("History store rolled up %s samples", deleted)
@@ -0,0 +1,228 @@
+"""
+Tracing spans of the control cycles, device commands, integration polls and config
+saves, kept in a ring buffer and exported in the Chrome trace event format (open
+it in Perfetto or chrome://tracing).
+
+Every span belongs to a lane, shown as a thread in the trace viewers: "core" for
+the control cycles and the device commands they send, one lane per integration
+and "config" for the config saves. Spans of a lane must not overlap unless they
+are nested.
+
+`profile` captures a cProfile or tracemalloc report of the running application for
+some seconds, on demand.
+
+While tracing is disabled `span` returns a shared no-op context manager, so the
+instrumented code does not allocate nor read the clock.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import cProfile
+import io
+import os
+import pstats
+import time
+import tracemalloc
+from typing import Any, Dict, List, Tuple
+
+# Recorded span: name, lane, detail, start and duration in nanoseconds
+SpanRecord = Tuple[str, str, str | None, int, int]
+
+NULL_SPAN = contextlib.nullcontext()
+PROFILE_MODES = ("cprofile", "tracemalloc")
+# Lines of a profile report
+PROFILE_LINES = 50
+
+
+class Span:
+    """A span being measured, recorded in the tracer when it exits."""
+
+    __slots__ = ("tracer", "name", "lane", "detail", "start")
+
+    def __init__(self, tracer: Tracer, name: str, lane: str, detail: str | None):
+        self.tracer = tracer
+        self.name = name
+        self.lane = lane
+        self.detail = detail
+        self.start = 0
+
+    def __enter__(self) -> Span:
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *_):
+        self.tracer.record(
+            self.name,
+            self.lane,
+            self.detail,
+            self.start,
+            time.perf_counter_ns() - self.start,
+        )
+
+
+class Tracer:
+    """Ring buffer of the most recent spans."""
+
+    def __init__(self, max_spans: int = 10000):
+        self.enabled = False
+        self.max_spans = max_spans
+        self.spans: List[SpanRecord | None] = [None] * max_spans
+        self.head = 0
+        self.size = 0
+
+    def configure(self, enabled: bool, max_spans: int | None = None):
+        """
+        Enable or disable tracing. Changing the size drops the recorded spans.
+
+        Parameters:
+        enabled (bool): Whether to record spans.
+        max_spans (int | None): Spans kept, the current size if None.
+
+        Raises:
+        ValueError: If max_spans is less than 1.
+        """
+        if max_spans is not None and max_spans != self.max_spans:
+            if max_spans < 1:
+                raise ValueError("max_spans must be at least 1")
+            self.max_spans = max_spans
+            self.clear()
+        self.enabled = enabled
+
+    def clear(self):
+        """Drop the recorded spans."""
+        self.spans = [None] * self.max_spans
+        self.head = 0
+        self.size = 0
+
+    def span(self, name: str, lane: str, detail: str | None = None):
+        """
+        Measure a block of code, use as `with tracer.span(...)`.
+
+        Parameters:
+        name (str): The name of the span, e.g. "cycle" or "turn_on".
+        lane (str): The lane of the span, e.g. "core" or the integration name.
+        detail (str | None): What the span is about, e.g. the device name.
+
+        Returns:
+        The context manager, a shared no-op one if tracing is disabled.
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, lane, detail)
+
+    def record(
+        self, name: str, lane: str, detail: str | None, start: int, duration: int
+    ):
+        """
+        Record a finished span, overwriting the oldest one if the buffer is full.
+
+        Parameters:
+        name (str): The name of the span.
+        lane (str): The lane of the span.
+        detail (str | None): What the span is about.
+        start (int): time.perf_counter_ns() when the span started.
+        duration (int): Duration of the span in nanoseconds.
+        """
+        self.spans[self.head] = (name, lane, detail, start, duration)
+        self.head = (self.head + 1) % self.max_spans
+        if self.size < self.max_spans:
+            self.size += 1
+
+    def recorded(self) -> List[SpanRecord]:
+        """
+        Get the recorded spans, oldest first.
+
+        Returns:
+        List[SpanRecord]: The spans.
+        """
+        start = (self.head - self.size) % self.max_spans
+        return [
+            self.spans[(start + index) % self.max_spans] for index in range(self.size)
+        ]
+
+    def chrome_trace(self) -> Dict[str, Any]:
+        """
+        Export the recorded spans in the Chrome trace event format.
+
+        Returns:
+        Dict[str, Any]: The trace.
+        """
+        pid = os.getpid()
+        lanes: Dict[str, int] = {}
+        events = []
+        for name, lane, detail, start, duration in self.recorded():
+            tid = lanes.setdefault(lane, len(lanes) + 1)
+            event = {
+                "name": name if detail is None else f"{name} {detail}",
+                "cat": lane,
+                "ph": "X",
+                "ts": start / 1000,
+                "dur": duration / 1000,
+                "pid": pid,
+                "tid": tid,
+            }
+            if detail is not None:
+                event["args"] = {"detail": detail}
+            events.append(event)
+        for lane, tid in lanes.items():
+            events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": pid,
+                    "tid": tid,
+                    "args": {"name": lane},
+                }
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+tracer = Tracer()
+# Held while a profile runs, only one profiler can be active at a time
+profile_lock = asyncio.Lock()
+
+
+async def profile(seconds: float, mode: str = "cprofile") -> str:
+    """
+    Profile the application for some seconds. The event loop keeps running
+    meanwhile, so the report shows what it runs.
+
+    Parameters:
+    seconds (float): How long to profile.
+    mode (str): "cprofile" for the functions with the most cumulative time, or
+    "tracemalloc" for the lines that allocated the most memory.
+
+    Returns:
+    str: The report.
+
+    Raises:
+    ValueError: If the mode is not valid.
+    """
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"mode must be one of {', '.join(PROFILE_MODES)}")
+    if mode == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+        output = io.StringIO()
+        stats = pstats.Stats(profiler, stream=output)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILE_LINES)
+        return output.getvalue()
+
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        await asyncio.sleep(seconds)
+        after = tracemalloc.take_snapshot()
+    finally:
+        if started:
+            tracemalloc.stop()
+    differences = after.compare_to(before, "lineno")[:PROFILE_LINES]
+    return "\n".join(str(difference) for difference in differences) + "\n"
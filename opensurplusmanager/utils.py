@@ -1,8 +1,71 @@
 """Utility functions for the package. Exports the logger."""
 
+import atexit
+import functools
+import json
 import logging
 import logging.handlers
+import multiprocessing
 import os
+import queue
+from typing import Any
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+
+def json_dumps(data: Any) -> bytes:
+    """
+    Serialize data to JSON bytes. Uses orjson when it is installed and falls back to
+    the standard library otherwise.
+
+    Parameters:
+        data (Any): The data to serialize.
+
+    Returns:
+        bytes: The JSON document encoded as UTF-8.
+    """
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":")).encode()
+
+
+def json_loads(data: bytes | str) -> Any:
+    """
+    Parse a JSON document. Uses orjson when it is installed and falls back to the
+    standard library otherwise.
+
+    Parameters:
+        data (bytes | str): The JSON document.
+
+    Returns:
+        Any: The parsed data.
+
+    Raises:
+        ValueError: If the document is not valid JSON.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+@functools.lru_cache(maxsize=1024)
+def relative_pathname(pathname: str) -> str:
+    """
+    Get the pathname relative to the package, cached per code location.
+
+    Parameters:
+        pathname (str): The absolute pathname.
+
+    Returns:
+        str: The pathname relative to the package or the same pathname if it is
+        outside the package.
+    """
+    if "opensurplusmanager" in pathname:
+        return pathname.split("opensurplusmanager")[1]
+    return pathname
 
 
 class RelativePathNameFilter(logging.Filter):
@@ -21,33 +84,69 @@ class RelativePathNameFilter(logging.Filter):
         Returns:
             bool: True if the log record should be included, False otherwise.
         """
-        if "opensurplusmanager" in record.pathname:
-            record.relative_pathname = record.pathname.split("opensurplusmanager")[1]
-        else:
-            record.relative_pathname = record.pathname
+        record.relative_pathname = relative_pathname(record.pathname)
         return True
 
 
+class JsonFormatter(logging.Formatter):
+    """Formats the log records as one JSON object per line."""
+
+    def format(self, record) -> str:
+        """
+        Formats the log record as JSON.
+
+        Parameters:
+            record (logging.LogRecord): The log record.
+
+        Returns:
+            str: The JSON object.
+        """
+        data = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "path": getattr(record, "relative_pathname", record.pathname),
+            "line": record.lineno,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data["exception"] = record.exc_text
+        return json_dumps(data).decode()
+
+
 def setup_logger() -> logging.Logger:
     """
     Setups the logger for the package. It will read the log level from the LOG_LEVEL
-    environment variable and the log directory from the LOG_DIR environment variable.
+    environment variable, the log directory from the LOG_DIR environment variable
+    and the format, text or json, from the LOG_FORMAT environment variable.
 
     Formats the log message with the relative pathname to the log file.
 
+    The records are put in a queue by the logger and written by the handlers in a
+    listener thread, so logging never blocks the event loop on I/O. In a worker
+    process no handler is added, see `forward_logs`.
+
     Returns:
         logging.Logger: The logger for the package.
     """
     log_level = os.getenv("LOG_LEVEL", "INFO").upper()
 
-    log_format = "[%(asctime)s] {%(relative_pathname)s:%(lineno)d} %(levelname)s \
+    if os.getenv("LOG_FORMAT", "text").lower() == "json":
+        formatter = JsonFormatter()
+    else:
+        log_format = "[%(asctime)s] {%(relative_pathname)s:%(lineno)d} %(levelname)s \
         - %(message)s"
-    date_format = "%d-%m-%Y %H:%M:%S"
-
-    formatter = logging.Formatter(log_format, date_format)
+        date_format = "%d-%m-%Y %H:%M:%S"
+        formatter = logging.Formatter(log_format, date_format)
 
     logger_setup = logging.getLogger()
     logger_setup.setLevel(log_level)
+    if multiprocessing.parent_process() is not None:
+        # A worker process, its records are sent to the parent with forward_logs
+        # so only one process writes and rotates the log file
+        return logger_setup
 
     log_dir = os.getenv("LOG_DIR", "./logs")
     log_file = os.path.join(log_dir, "opensurplusmanager.log")
@@ -65,10 +164,58 @@ def setup_logger() -> logging.Logger:
     file_handler.setFormatter(formatter)
     file_handler.addFilter(RelativePathNameFilter())
 
-    logger_setup.addHandler(console_handler)
-    logger_setup.addHandler(file_handler)
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(
+        log_queue, console_handler, file_handler, respect_handler_level=True
+    )
+    listener.start()
+    # Writes the records still in the queue at exit
+    atexit.register(listener.stop)
+
+    logger_setup.addHandler(logging.handlers.QueueHandler(log_queue))
 
     return logger_setup
 
 
+class ForwardedRecordHandler(logging.Handler):
+    """Handles the records forwarded by a worker process as if they were local."""
+
+    def emit(self, record):
+        """
+        Passes the record to the logger it was created by.
+
+        Parameters:
+            record (logging.LogRecord): The log record.
+        """
+        logging.getLogger(record.name).handle(record)
+
+
+def forward_logs(log_queue: Any):
+    """
+    Sends the records of a worker process to the parent process.
+
+    Parameters:
+        log_queue (multiprocessing.Queue): The queue read by `receive_logs` in the
+        parent process.
+    """
+    logging.getLogger().addHandler(logging.handlers.QueueHandler(log_queue))
+
+
+def receive_logs(log_queue: Any) -> logging.handlers.QueueListener:
+    """
+    Handles the records sent by worker processes with `forward_logs` in a listener
+    thread.
+
+    Parameters:
+        log_queue (multiprocessing.Queue): The queue shared with the workers.
+
+    Returns:
+        logging.handlers.QueueListener: The started listener, stop it before
+        closing the queue.
+    """
+    listener = logging.handlers.QueueListener(log_queue, ForwardedRecordHandler())
+    listener.start()
+    return listener
+
+
 logger = setup_logger()
@@ -0,0 +1,152 @@
+"""Tests of the Modbus TCP integration against the Modbus server of the simulator."""
+
+import asyncio
+import struct
+import unittest
+
+from opensurplusmanager.core import Core
+from opensurplusmanager.integrations.modbus_tcp import (
+    MBAP,
+    ModbusConnection,
+    ModbusError,
+    ModbusTCP,
+)
+from opensurplusmanager.simulator import (
+    MODBUS_SURPLUS,
+    ModbusServer,
+    Simulation,
+    build_devices,
+    modbus_address,
+)
+
+
+class ModbusTCPTest(unittest.IsolatedAsyncioTestCase):
+    """Reads of the integration from the simulated farm."""
+
+    async def asyncSetUp(self):
+        self.simulation = Simulation(devices=build_devices(3, seed=1), noise=0)
+        for device in self.simulation.devices.values():
+            self.simulation.switch(device, True)
+            device.consumption = device.target
+        self.simulation.step()
+        self.server = ModbusServer(self.simulation, port=0)
+        await self.server.start()
+
+    async def asyncTearDown(self):
+        await self.server.close()
+
+    def entity(self, address: int, **kwargs) -> dict:
+        return {
+            "name": "modbus_tcp",
+            "host": "localhost",
+            "port": self.server.port,
+            "address": address,
+            "data_type": "float32",
+            "register_type": "input",
+            **kwargs,
+        }
+
+    async def test_poll(self):
+        core = Core()
+        surplus = self.entity(MODBUS_SURPLUS)
+        # The surplus is configured under the name of the integration
+        del surplus["name"]
+        core.config = {
+            "integrations": {"modbus_tcp": {}},
+            "surplus": {"modbus_tcp": surplus},
+            "devices": [
+                {
+                    "name": device.name,
+                    "type": "switch",
+                    # Never fits the surplus, the cycles send no commands
+                    "expected_consumption": 1e9,
+                    "consumption_integration": self.entity(modbus_address(index)),
+                }
+                for index, device in enumerate(self.simulation.devices.values())
+            ],
+        }
+        core.load_config()
+        integration = ModbusTCP(core)
+        try:
+            await integration.poll()
+        finally:
+            await integration.close()
+        self.assertAlmostEqual(core.surplus, self.simulation.surplus, places=1)
+        for name, device in self.simulation.devices.items():
+            self.assertAlmostEqual(
+                core.get_device(name).consumption, device.consumption, places=1
+            )
+        # The surplus and the three devices are contiguous, read in one request
+        self.assertEqual(self.server.requests, 1)
+
+    async def test_exception_response(self):
+        connection = ModbusConnection("localhost", self.server.port, 1)
+        try:
+            with self.assertRaisesRegex(ModbusError, "exception 2"):
+                await connection.read(1, 4, modbus_address(3), 2)
+            # The connection is still usable
+            data = await connection.read(1, 3, MODBUS_SURPLUS, 2)
+        finally:
+            connection.close()
+        self.assertAlmostEqual(
+            struct.unpack(">f", data)[0], self.simulation.surplus, places=1
+        )
+
+
+class MalformedFrameTest(unittest.IsolatedAsyncioTestCase):
+    """Responses that do not follow the protocol."""
+
+    async def asyncSetUp(self):
+        # Length of the MBAP header of the next responses, popped per request
+        self.lengths = []
+
+        async def handle(reader, writer):
+            try:
+                while True:
+                    header = await reader.readexactly(MBAP.size)
+                    transaction, _, length, unit = MBAP.unpack(header)
+                    await reader.readexactly(length - 1)
+                    length = self.lengths.pop(0)
+                    pdu = bytes([4, 4]) + struct.pack(">f", 1.5)
+                    writer.write(MBAP.pack(transaction, 0, length, unit))
+                    writer.write(pdu[: max(length - 1, 0)])
+            except (asyncio.IncompleteReadError, ConnectionError):
+                pass
+            finally:
+                writer.close()
+
+        self.server = await asyncio.start_server(handle, "localhost", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.connection = ModbusConnection("localhost", self.port, 1)
+
+    async def asyncTearDown(self):
+        self.connection.close()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def test_zero_length(self):
+        self.lengths = [0, 7]
+        with self.assertRaisesRegex(ModbusError, "Invalid frame length"):
+            await self.connection.read(1, 4, 0, 2)
+        # The broken connection is replaced by a new one
+        data = await self.connection.read(1, 4, 0, 2)
+        self.assertEqual(struct.unpack(">f", data)[0], 1.5)
+
+    async def test_empty_pdu(self):
+        self.lengths = [1, 7]
+        with self.assertRaisesRegex(ModbusError, "Invalid frame length"):
+            await self.connection.read(1, 4, 0, 2)
+        data = await self.connection.read(1, 4, 0, 2)
+        self.assertEqual(struct.unpack(">f", data)[0], 1.5)
+
+    async def test_short_pdu(self):
+        # Only the function code
+        self.lengths = [2, 7]
+        with self.assertRaisesRegex(ModbusError, "too short"):
+            await self.connection.read(1, 4, 0, 2)
+        data = await self.connection.read(1, 4, 0, 2)
+        self.assertEqual(struct.unpack(">f", data)[0], 1.5)
+
+
+if __name__ == "__main__":
+    unittest.main()